@@ -0,0 +1,160 @@
+######################################################################################
+# -*- coding: utf-8 -*-
+# asyncio orchestration of the external tools (lilypond, fluidsynth, ffmpeg) of a build
+# Copyright (c) 2024 Stefano Franchi <stefano.franchi@gmail.com>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/licenses/gpl.html
+######################################################################################
+
+import asyncio
+import os
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class JobError(object):
+    """Why the render of one output of one chord failed, after all its attempts"""
+    item: str  # chord/voicing the output belongs to, e.g. 'CM7/FullStandardV'
+    output: str
+    reason: str  # 'failed' (non-zero exit), 'timeout' or 'not found'
+    returncode: int
+    stderr: str  # last lines of the tools' error output
+    attempts: int
+
+
+class ToolJob(object):
+    """
+    One output file to produce: a single command, or a pipeline of commands
+    (e.g. fluidsynth | ffmpeg) whose stdout feeds the next one's stdin
+    """
+
+    def __init__(self, item, commands, output, onDone=None):
+        """
+        :param onDone: optional callable(output, success) called when the job is over
+        """
+        self.item = item
+        self.commands = commands
+        self.output = output
+        self.onDone = onDone
+
+    def tools(self):
+        """Names of the tools this job runs, in a fixed order (semaphores are always taken in that order)"""
+        return sorted(set(os.path.basename(command[0]) for command in self.commands))
+
+
+class AsyncToolRunner(object):
+    """
+    Runs the queued lilypond, fluidsynth and ffmpeg jobs of a build as asyncio subprocesses,
+    so the images and audio of different chords are rendered at the same time.
+    Each tool has its own limit on the number of concurrent processes, each job a timeout.
+    Jobs whose tools fail or time out are retried (with a growing delay), and the jobs that
+    still fail are reported as JobErrors instead of stopping the build.
+    """
+
+    defaultLimits = {'lilypond': 2, 'fluidsynth': 4, 'ffmpeg': 4}
+    defaultLimit = 2  # for any other tool
+    stderrLines = 5
+
+    def __init__(self, limits=None, timeout=120.0, retries=2, retryDelay=0.5):
+        self.limits = dict(self.defaultLimits, **(limits or {}))
+        self.timeout = timeout
+        self.retries = retries
+        self.retryDelay = retryDelay
+        self.pending = []
+        self.errors = []
+
+    def add(self, item, commands, output, onDone=None):
+        """
+        Queue a job to run at the next flush
+        :param commands: list of command lines, piped into each other
+        """
+        self.pending.append(ToolJob(item, commands, output, onDone))
+
+    def flush(self):
+        """
+        Run all the pending jobs
+        :return: dictionary output -> True if produced (the failures are also added to self.errors)
+        """
+        jobs, self.pending = self.pending, []
+        if not jobs:
+            return {}
+        return asyncio.run(self.runAll(jobs))
+
+    async def runAll(self, jobs):
+        semaphores = {tool: asyncio.Semaphore(self.limits.get(tool, self.defaultLimit))
+                      for job in jobs for tool in job.tools()}
+        outcomes = await asyncio.gather(*[self.runJob(job, semaphores) for job in jobs])
+        results = {}
+        for job, error in zip(jobs, outcomes):
+            results[job.output] = error is None
+            if error is not None:
+                self.errors.append(error)
+            if job.onDone is not None:
+                job.onDone(job.output, error is None)
+        return results
+
+    async def runJob(self, job, semaphores):
+        """
+        Run a job until it succeeds or runs out of attempts
+        :return: None on success, otherwise a JobError
+        """
+        for attempt in range(1, self.retries + 2):
+            for tool in job.tools():
+                await semaphores[tool].acquire()
+            try:
+                reason, returncode, stderr = await self.runPipeline(job.commands)
+            finally:
+                for tool in job.tools():
+                    semaphores[tool].release()
+            if reason is None:
+                return None
+            if reason == 'not found' or attempt > self.retries:
+                return JobError(job.item, job.output, reason, returncode, stderr, attempt)
+            await asyncio.sleep(self.retryDelay * attempt)
+
+    async def runPipeline(self, commands):
+        """
+        Start the commands connected by pipes and wait for all of them, within the timeout
+        :return: (None or the failure reason, return code of the first failing command, its stderr tail)
+        """
+        processes = []
+        stdin = None
+        try:
+            for i, command in enumerate(commands):
+                if i < len(commands) - 1:
+                    readEnd, writeEnd = os.pipe()
+                else:
+                    readEnd, writeEnd = None, asyncio.subprocess.DEVNULL
+                try:
+                    processes.append(await asyncio.create_subprocess_exec(
+                        *command, stdin=stdin, stdout=writeEnd, stderr=asyncio.subprocess.PIPE))
+                except OSError:
+                    if readEnd is not None:
+                        os.close(readEnd)  # no next command will read it
+                    raise
+                finally:
+                    # the processes own their ends of the pipes now: each end is closed here, exactly once
+                    if stdin is not None:
+                        os.close(stdin)
+                    if readEnd is not None:
+                        os.close(writeEnd)
+                stdin = readEnd
+        except OSError:
+            for process in processes:
+                if process.returncode is None:
+                    process.kill()
+                await process.wait()
+            return 'not found', -1, ''
+        try:
+            outputs = await asyncio.wait_for(asyncio.gather(*[process.communicate() for process in processes]),
+                                             self.timeout)
+        except asyncio.TimeoutError:
+            for process in processes:
+                if process.returncode is None:
+                    process.kill()
+                await process.wait()
+            return 'timeout', -1, ''
+        for process, (out, err) in zip(processes, outputs):
+            if process.returncode != 0:
+                stderr = '\n'.join(err.decode('utf-8', 'replace').splitlines()[-self.stderrLines:])
+                return 'failed', process.returncode, stderr
+        return None, 0, ''
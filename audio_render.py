@@ -0,0 +1,344 @@
+######################################################################################
+# -*- coding: utf-8 -*-
+# Audio renderers turning mingus bars into mp3 files for the Anki notes
+# Copyright (c) 2024 Stefano Franchi <stefano.franchi@gmail.com>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/licenses/gpl.html
+######################################################################################
+
+import os
+import shutil
+import subprocess
+import tempfile
+from mingus.containers import Bar as mBar
+from mingus.containers import Track as mTrack
+from mingus.midi.midi_file_out import write_Bar as mMidiFileOut
+from mingus.midi.midi_file_out import write_Track as mMidiTrackOut
+from media_cache import soundFontDigest
+
+
+def barEvents(bar, bpm=80):
+    """
+    Flatten a mingus bar into timed events (rests are skipped)
+    :return: list of (start in seconds, end in seconds, [(MIDI pitch, velocity, channel), ...])
+    """
+    secondsPerWholeNote = 4 * 60.0 / bpm
+    events = []
+    for beat, duration, notes in bar:
+        if not notes:
+            continue
+        start = beat * secondsPerWholeNote
+        # mingus numbers octaves from 0 while MIDI middle C is 60, hence the +12 (as in mingus' MidiTrack)
+        events.append((start, start + secondsPerWholeNote / duration,
+                       [(int(n) + 12, n.velocity, n.channel) for n in notes]))
+    return events
+
+
+class FluidSynthRenderer(object):
+    """
+    Renders a bar with fluidsynth and streams the raw PCM it writes on stdout
+    straight into the mp3 encoder (ffmpeg), so that only the mp3 touches the disk.
+    The (tiny) MIDI file is the only temporary file: fluidsynth needs a seekable MIDI input.
+    """
+
+    sampleRate = 44100
+    channels = 2
+    encoderArgs = ['-codec:a', 'libmp3lame', '-q:a', '4']
+    subprocessPipeline = True  # renders with the fluidsynth | ffmpeg processes (see pipelineCommands)
+
+    def __init__(self, soundFont='/usr/share/soundfonts/FluidR3_GM.sf2'):
+        self.soundFont = soundFont
+
+    def cacheKey(self):
+        """Everything about this renderer that changes its output, for the media cache"""
+        return ('fluidsynth', soundFontDigest(self.soundFont), self.sampleRate, self.channels, tuple(self.encoderArgs))
+
+    def synthCommand(self, midiFile):
+        """fluidsynth command line writing 16 bit raw PCM to stdout"""
+        return ['fluidsynth', '-niq', '-T', 'raw', '-O', 's16', '-r', str(self.sampleRate),
+                '-F', '-', self.soundFont, midiFile]
+
+    def encoderCommand(self, mp3FileOut):
+        """ffmpeg command line encoding 16 bit raw PCM read from stdin to mp3FileOut"""
+        return (['ffmpeg', '-loglevel', 'error', '-y', '-f', 's16le', '-ar', str(self.sampleRate),
+                 '-ac', str(self.channels), '-i', 'pipe:0'] + self.encoderArgs + [mp3FileOut])
+
+    def renderBar(self, bar, mp3FileOut, bpm=80, scratchDir='.'):
+        """
+        Convert a mingus bar to an mp3 file
+        :return: True if the mp3 was written
+        """
+        midiFile = os.path.join(scratchDir, 'tmpMidi.mid')
+        mMidiFileOut(midiFile, bar, bpm)
+        try:
+            return self.pipeToEncoder(self.synthCommand(midiFile), mp3FileOut)
+        finally:
+            os.remove(midiFile)
+
+    def pipelineCommands(self, bar, mp3FileOut, bpm=80, scratchDir='.'):
+        """
+        Write the MIDI file of the bar, for running the synth and the encoder elsewhere (see async_jobs)
+        :return: ([synth command, encoder command], the MIDI file to remove once they are done)
+        """
+        fd, midiFile = tempfile.mkstemp(suffix='.mid', dir=scratchDir)
+        os.close(fd)
+        mMidiFileOut(midiFile, bar, bpm)
+        return [self.synthCommand(midiFile), self.encoderCommand(mp3FileOut)], midiFile
+
+    def encodePcm(self, pcm, mp3FileOut):
+        """
+        Feed an in-memory block of 16 bit raw PCM to the encoder
+        :return: True if the mp3 was written
+        """
+        try:
+            encoder = subprocess.run(self.encoderCommand(mp3FileOut), input=pcm,
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError as err:
+            print('audio encoding failed for ', mp3FileOut, ': ', err)
+            return False
+        return encoder.returncode == 0
+
+    def pipeToEncoder(self, synthCommand, mp3FileOut):
+        """
+        Run synthCommand with its stdout connected to the encoder's stdin
+        :return: True if both processes succeeded
+        """
+        try:
+            with subprocess.Popen(synthCommand, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as synth:
+                with subprocess.Popen(self.encoderCommand(mp3FileOut), stdin=synth.stdout,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) as encoder:
+                    synth.stdout.close()  # the encoder owns the pipe now
+                    encoder.wait()
+                synth.wait()
+        except OSError as err:
+            print('audio rendering failed for ', mp3FileOut, ': ', err)
+            return False
+        return synth.returncode == 0 and encoder.returncode == 0
+
+
+class WarmFluidSynthRenderer(FluidSynthRenderer):
+    """
+    Keeps one in-process fluidsynth (through the optional pyfluidsynth binding) with the
+    soundfont loaded for the whole build, and renders bars by playing their notes into it.
+    The synth is started on first use, once per process (so pool workers get their own).
+    """
+
+    releaseTime = 1.0  # seconds of audio kept after the last note off
+    subprocessPipeline = False
+
+    def __init__(self, soundFont='/usr/share/soundfonts/FluidR3_GM.sf2'):
+        FluidSynthRenderer.__init__(self, soundFont)
+        self.synth = None
+        self.pid = None
+
+    def __getstate__(self):
+        # pool workers start their own synth
+        state = dict(self.__dict__)
+        state['synth'] = None
+        return state
+
+    def cacheKey(self):
+        return ('fluidsynth-warm', soundFontDigest(self.soundFont), self.sampleRate,
+                self.releaseTime, tuple(self.encoderArgs))
+
+    def start(self):
+        """Start the synth and load the soundfont (only once per process)"""
+        if self.synth is not None and self.pid == os.getpid():
+            return
+        import fluidsynth
+        self.synth = fluidsynth.Synth(samplerate=float(self.sampleRate))
+        soundFontId = self.synth.sfload(self.soundFont)
+        if soundFontId == -1:
+            raise IOError('fluidsynth could not load the soundfont ' + self.soundFont)
+        for channel in range(16):
+            self.synth.program_select(channel, soundFontId, 0, 0)
+        self.pid = os.getpid()
+
+    def close(self):
+        """Release the synth and its soundfont"""
+        if self.synth is not None and self.pid == os.getpid():
+            self.synth.delete()
+        self.synth = None
+
+    def renderPcm(self, bar, bpm=80):
+        """Play the bar into the warm synth and return its audio as 16 bit raw PCM"""
+        self.start()
+        changes = []  # (time, isNoteOn, pitch, velocity, channel)
+        for start, end, notes in barEvents(bar, bpm):
+            for pitch, velocity, channel in notes:
+                changes.append((start, True, pitch, velocity, channel))
+                changes.append((end, False, pitch, velocity, channel))
+        changes.sort(key=lambda change: (change[0], change[1]))
+        blocks = []
+        now = 0
+        for time, isNoteOn, pitch, velocity, channel in changes:
+            frames = int(round(time * self.sampleRate)) - now
+            if frames > 0:
+                blocks.append(self.synth.get_samples(frames).astype('int16').tobytes())
+                now += frames
+            if isNoteOn:
+                self.synth.noteon(channel, pitch, velocity)
+            else:
+                self.synth.noteoff(channel, pitch)
+        blocks.append(self.synth.get_samples(int(self.releaseTime * self.sampleRate)).astype('int16').tobytes())
+        for channel in range(16):
+            self.synth.cc(channel, 120, 0)  # all sound off, so nothing leaks into the next bar
+        return b''.join(blocks)
+
+    def renderBar(self, bar, mp3FileOut, bpm=80, scratchDir='.'):
+        """
+        Convert a mingus bar to an mp3 file without starting any synth process
+        :return: True if the mp3 was written
+        """
+        return self.encodePcm(self.renderPcm(bar, bpm), mp3FileOut)
+
+
+class AudioReel(object):
+    """
+    Collects the bars of a build, writes them into one MIDI file (each bar followed by a
+    bar of rest for the release), synthesizes it with a single fluidsynth pass and cuts the
+    PCM stream into one mp3 per bar at the known sample offsets.
+    The stream is sliced on the fly, so the whole reel is never held in memory.
+    """
+
+    readSize = 1 << 16
+
+    def __init__(self, renderer=None):
+        self.renderer = renderer if renderer is not None else FluidSynthRenderer()
+        self.pending = []  # list of (bar, mp3FileOut, bpm, onDone)
+
+    def add(self, bar, mp3FileOut, bpm=80, onDone=None):
+        """
+        Queue a bar to be rendered into mp3FileOut at the next flush
+        :param onDone: optional callable(mp3FileOut, success) called once the clip is encoded
+        """
+        self.pending.append((bar, mp3FileOut, bpm, onDone))
+
+    def restBar(self):
+        """The silent bar separating two chords, leaving room for the release of the first"""
+        bar = mBar()
+        bar.place_rest(1)
+        return bar
+
+    def clipOffsets(self, bars, bpm):
+        """
+        Byte offsets of the clips in the PCM stream of the reel, computed from the
+        cumulative time of the bars so rounding never drifts along the reel
+        :return: list of len(bars) + 1 offsets
+        """
+        frameBytes = 2 * self.renderer.channels
+        secondsPerWholeNote = 4 * 60.0 / bpm
+        gap = self.restBar().current_beat
+        offsets = [0]
+        elapsed = 0.0
+        for bar in bars:
+            # mingus' MidiTrack advances by the notes and rests actually placed, not by the meter
+            elapsed += (bar.current_beat + gap) * secondsPerWholeNote
+            offsets.append(int(round(elapsed * self.renderer.sampleRate)) * frameBytes)
+        return offsets
+
+    def tailBytes(self, bpm):
+        """
+        Bytes of the rest closing the reel: mingus' MidiTrack writes no event after the last note-off,
+        so the synth stops that much before the offset of the last clip's end
+        """
+        seconds = self.restBar().current_beat * 4 * 60.0 / bpm
+        return int(round(seconds * self.renderer.sampleRate)) * 2 * self.renderer.channels
+
+    def flush(self):
+        """
+        Render all the pending bars, one reel per bpm
+        :return: dictionary mp3FileOut -> True if the clip was written
+        """
+        results = {}
+        byBpm = {}
+        for job in self.pending:
+            byBpm.setdefault(job[2], []).append(job)
+        self.pending = []
+        for bpm, jobs in byBpm.items():
+            results.update(self.renderReel(jobs, bpm))
+        return results
+
+    def renderReel(self, jobs, bpm):
+        """
+        Synthesize one reel and slice it into the jobs' mp3 files.
+        A clip only succeeds if it got all its bytes and the synth exited cleanly: when fluidsynth stops early
+        (bad soundfont, crash) its clips are failures, their partial mp3s are removed, and the onDone callbacks
+        (e.g. the media cache) are told so. The last clip is padded with silence for its closing rest (see tailBytes)
+        """
+        results = dict((job[1], False) for job in jobs)
+        scratchDir = tempfile.mkdtemp(prefix='audio-reel-')
+        midiFile = os.path.join(scratchDir, 'reel.mid')
+        track = mTrack()
+        for bar, mp3FileOut, jobBpm, onDone in jobs:
+            track.add_bar(bar)
+            track.add_bar(self.restBar())
+        mMidiTrackOut(midiFile, track, bpm)
+        offsets = self.clipOffsets([job[0] for job in jobs], bpm)
+        try:
+            with subprocess.Popen(self.renderer.synthCommand(midiFile), stdout=subprocess.PIPE,
+                                  stderr=subprocess.DEVNULL) as synth:
+                for i, (bar, mp3FileOut, jobBpm, onDone) in enumerate(jobs):
+                    padBytes = self.tailBytes(bpm) if i == len(jobs) - 1 else 0
+                    results[mp3FileOut] = self.encodeClip(synth.stdout, offsets[i + 1] - offsets[i], mp3FileOut,
+                                                          padBytes)
+                for block in iter(lambda: synth.stdout.read(self.readSize), b''):
+                    pass  # the tail of the last release: let the synth finish
+                synth.stdout.close()
+                synth.wait()
+            if synth.returncode != 0:
+                print('fluidsynth failed on the audio reel, exit code ', synth.returncode)
+                results = dict.fromkeys(results, False)
+        except OSError as err:
+            print('audio reel rendering failed: ', err)
+            results = dict.fromkeys(results, False)
+        finally:
+            shutil.rmtree(scratchDir, ignore_errors=True)
+        for bar, mp3FileOut, jobBpm, onDone in jobs:
+            if not results[mp3FileOut] and os.path.exists(mp3FileOut):
+                os.remove(mp3FileOut)  # never leave a truncated clip to be taken for a render
+            if onDone is not None:
+                onDone(mp3FileOut, results[mp3FileOut])
+        return results
+
+    def encodeClip(self, stream, clipBytes, mp3FileOut, padBytes=0):
+        """
+        Pipe the next clipBytes of the PCM stream into a new encoder. The clip's bytes are always consumed,
+        so the next clip starts at its own offset even when the encoder gives up
+        :param padBytes: up to this many missing bytes at the end of the stream are encoded as silence
+        :return: True if the mp3 was written from the whole clip (False if the synth stopped early)
+        """
+        with subprocess.Popen(self.renderer.encoderCommand(mp3FileOut), stdin=subprocess.PIPE,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) as encoder:
+            remaining = clipBytes
+            encoding = True
+            while remaining > 0:
+                chunk = stream.read(min(remaining, self.readSize))
+                if not chunk and remaining <= padBytes:
+                    chunk = bytes(remaining)
+                elif not chunk:
+                    break  # the synth stopped early: the clip is incomplete
+                remaining -= len(chunk)
+                if encoding:
+                    try:
+                        encoder.stdin.write(chunk)
+                    except BrokenPipeError:
+                        encoding = False
+            try:
+                encoder.stdin.close()
+            except BrokenPipeError:
+                pass
+            encoder.wait()
+        return remaining == 0 and encoder.returncode == 0
+
+
+def defaultAudioRenderer(soundFont='/usr/share/soundfonts/FluidR3_GM.sf2'):
+    """
+    The warm in-process renderer when pyfluidsynth is installed,
+    otherwise one fluidsynth process per bar
+    """
+    try:
+        import fluidsynth
+        fluidsynth.Synth
+    except (ImportError, OSError, AttributeError):
+        return FluidSynthRenderer(soundFont)
+    return WarmFluidSynthRenderer(soundFont)
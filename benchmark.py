@@ -0,0 +1,249 @@
+######################################################################################
+# -*- coding: utf-8 -*-
+# Benchmark suite: times every stage of a build, with the real tools or deterministic stand-ins
+# Copyright (c) 2024 Stefano Franchi <stefano.franchi@gmail.com>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/licenses/gpl.html
+######################################################################################
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import stat
+import sys
+import tempfile
+import time
+import genanki
+from chord_generation import GenAnkiChords, ChordItem, ChordNote, AnkiDeck
+from chord_spelling import ROOTS, QUALITIES
+from audio_render import FluidSynthRenderer
+
+# the stages of a build, in order
+STAGES = ['initDb', 'addVoicings', 'lilyPondStrings', 'png', 'mp3', 'package']
+
+# Stand-ins for the external tools: they accept the same command lines and write
+# deterministic output derived from their input, so that timings only measure our own code
+# plus a process start-up
+STAND_IN_TOOLS = {
+    'lilypond': '''
+import hashlib, os, sys
+args = sys.argv[1:]
+out = args[args.index('-o') + 1] if '-o' in args else None
+inputs = [a for a in args if a.endswith('.ly')]
+for ly in inputs:
+    digest = hashlib.sha1(open(ly, 'rb').read()).digest()
+    stem = os.path.splitext(os.path.basename(ly))[0]
+    if out is None:
+        png = os.path.splitext(ly)[0] + '.png'
+    elif len(inputs) > 1 or os.path.isdir(out):
+        png = os.path.join(out, stem + '.png')
+    else:
+        png = out + '.png'
+    with open(png, 'wb') as f:
+        f.write(b'\\x89PNG\\r\\n\\x1a\\n' + digest * 64)
+''',
+    'fluidsynth': '''
+import hashlib, struct, sys
+args = sys.argv[1:]
+data = open(args[-1], 'rb').read()
+rate = int(args[args.index('-r') + 1]) if '-r' in args else 44100
+
+def varLen(pos):
+    value = 0
+    while True:
+        value, pos = (value << 7) | (data[pos] & 0x7f), pos + 1
+        if data[pos - 1] < 0x80:
+            return value, pos
+
+# as long as the MIDI file: the time of its last event
+division = struct.unpack('>H', data[12:14])[0]
+seconds, pos, tempo = 0.0, 14, 500000
+while pos + 8 <= len(data):
+    chunkId, end = data[pos:pos + 4], pos + 8 + struct.unpack('>I', data[pos + 4:pos + 8])[0]
+    pos, trackSeconds, status = pos + 8, 0.0, 0
+    while chunkId == b'MTrk' and pos < end:
+        delta, pos = varLen(pos)
+        trackSeconds += delta * tempo / 1e6 / division
+        if data[pos] >= 0x80:
+            status, pos = data[pos], pos + 1
+        if status == 0xff:
+            kind = data[pos]
+            length, pos = varLen(pos + 1)
+            if kind == 0x51:
+                tempo = int.from_bytes(data[pos:pos + 3], 'big')
+            pos += length
+        elif status in (0xf0, 0xf7):
+            length, pos = varLen(pos)
+            pos += length
+        else:
+            pos += 1 if (status & 0xf0) in (0xc0, 0xd0) else 2
+    seconds, pos = max(seconds, trackSeconds), end
+pcmBytes = int(round(seconds * rate)) * 4
+digest = hashlib.sha1(data).digest()[:16]
+sys.stdout.buffer.write((digest * (pcmBytes // 16 + 1))[:pcmBytes])
+''',
+    'ffmpeg': '''
+import hashlib, sys
+pcm = sys.stdin.buffer.read()
+with open(sys.argv[-1], 'wb') as f:
+    f.write(b'ID3' + hashlib.sha1(pcm).digest() * (1 + len(pcm) // 2000))
+''',
+}
+
+
+@contextlib.contextmanager
+def standInTools():
+    """Put the stand-in lilypond, fluidsynth and ffmpeg first on the PATH for the duration of the block"""
+    binDir = tempfile.mkdtemp(prefix='genankichords-bin-')
+    for name, source in STAND_IN_TOOLS.items():
+        script = os.path.join(binDir, name)
+        with open(script, 'w') as f:
+            f.write('#!' + sys.executable + '\n' + source)
+        os.chmod(script, os.stat(script).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    oldPath = os.environ.get('PATH', '')
+    os.environ['PATH'] = binDir + os.pathsep + oldPath
+    try:
+        yield binDir
+    finally:
+        os.environ['PATH'] = oldPath
+        shutil.rmtree(binDir, ignore_errors=True)
+
+
+def syntheticChordsDb(size):
+    """
+    A chordsDb of size items, cycling over all the roots and qualities
+    (68 is the default deck: 17 roots x 4 qualities)
+    """
+    chords = [(root, quality) for root in ROOTS for quality in QUALITIES]
+    chordsDb = {}
+    for i in range(size):
+        root, quality = chords[i % len(chords)]
+        chordsDb['%s%s-%06d' % (root, quality, i)] = ChordItem(root, quality)
+    return chordsDb
+
+
+class Benchmark(object):
+    """
+    Runs the stages of a build on a synthetic chord set and records how long each one takes.
+    The media stages (png, mp3) start one process per chord, so they only run on the first
+    mediaSample chords; their time per item is what gets compared against the baseline.
+    """
+
+    def __init__(self, size=68, mediaSample=20, soundFont='/usr/share/soundfonts/FluidR3_GM.sf2'):
+        self.size = size
+        self.mediaSample = mediaSample
+        self.soundFont = soundFont
+        self.results = {}
+        self.app = None
+
+    def timeStage(self, stage, items, stageFunc):
+        """Run stageFunc() and record its wall time"""
+        start = time.perf_counter()
+        stageFunc()
+        seconds = time.perf_counter() - start
+        self.results[stage] = dict(seconds=seconds, items=items, perItem=seconds / items if items else 0.0)
+
+    def run(self):
+        """
+        Run all the stages in a scratch directory (the media files are written to the current directory)
+        :return: dictionary stage -> dict(seconds, items, perItem)
+        """
+        cwd = os.getcwd()
+        workDir = tempfile.mkdtemp(prefix='genankichords-bench-')
+        os.chdir(workDir)
+        try:
+            self.app = GenAnkiChords([], [], ['FullStandardV', 'ShellV'])
+            self.timeStage('initDb', self.size, self.initDb)
+            self.timeStage('addVoicings', self.size, self.addVoicings)
+            self.timeStage('lilyPondStrings', self.size, self.lilyPondStrings)
+            sample = list(self.app.chordsDb.values())[:self.mediaSample]
+            self.timeStage('png', len(sample), lambda: [chordItem.voicings['FullStandardV'].fullStandardVPng
+                                                        for chordItem in sample])
+            self.timeStage('mp3', len(sample), lambda: [chordItem.voicings['FullStandardV'].fullStandardVMp3
+                                                        for chordItem in sample])
+            self.timeStage('package', self.size, self.package)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(workDir, ignore_errors=True)
+        return self.results
+
+    def initDb(self):
+        self.app.chordsDb = syntheticChordsDb(self.size)
+
+    def addVoicings(self):
+        self.app.addVoicings(['fullStandardVNotes', 'shellVOff3rdNotes', 'shellVOff7thNotes'])
+        for chordItem in self.app.chordsDb.values():
+            chordItem.voicings['FullStandardV'].audioRenderer = FluidSynthRenderer(self.soundFont)
+
+    def lilyPondStrings(self):
+        for chordItem in self.app.chordsDb.values():
+            chordItem.voicings['FullStandardV'].fullStandardVLilyPond
+            chordItem.voicings['ShellV'].shellVOff3rdLilypond
+            chordItem.voicings['ShellV'].shellVOff7thLilypond
+
+    def package(self):
+        model = genanki.Model(AnkiDeck.modelId, 'Chords',
+                              fields=[{'name': name} for name in ['SortId', 'Name', 'Root', 'Quality',
+                                                                  'Rootless_V_Off_3rd', 'Image', 'Sound']],
+                              templates=AnkiDeck.cardTemplates[:1])
+        deck = AnkiDeck(self.app.chordsDb, '.')
+        for i, (key, chordItem) in enumerate(self.app.chordsDb.items()):
+            voicing = chordItem.voicings['FullStandardV']
+            media = [voicing.fullStandardVPng, voicing.fullStandardVMp3] if i < self.mediaSample else ['', '']
+            notes = ' '.join(note.name for note in chordItem.voicings['ShellV'].shellVOff3rdNotes)
+            deck.ankiNotes.append(ChordNote(model=model, fields=[str(i), key, chordItem.root, chordItem.quality, notes]
+                                                                + [tag or '' for tag in media]))
+        deck.writePackage(deck.ankiNotes, 'benchmark.apkg')
+
+
+def compareToBaseline(results, baseline, threshold=0.25, minSeconds=0.05):
+    """
+    :param results: stage timings of this run (see Benchmark.run)
+    :param baseline: stage timings of a reference run
+    :param threshold: allowed relative slow-down of the time per item
+    :param minSeconds: slow-downs adding up to less than this over the whole stage are timer noise, not regressions
+    :return: list of (stage, baseline perItem, current perItem) for the stages that regressed
+    """
+    regressions = []
+    for stage in STAGES:
+        if stage in results and stage in baseline:
+            before, after = baseline[stage]['perItem'], results[stage]['perItem']
+            if after > before * (1 + threshold) and (after - before) * results[stage]['items'] > minSeconds:
+                regressions.append((stage, before, after))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time every stage of a GenAnkiChords build')
+    parser.add_argument('--size', type=int, default=68, help='number of chords (68 up to 100000)')
+    parser.add_argument('--media-sample', type=int, default=20, help='chords rendered in the png and mp3 stages')
+    parser.add_argument('--tools', choices=['stand-in', 'real'], default='stand-in',
+                        help='use deterministic stand-ins or the installed lilypond/fluidsynth/ffmpeg')
+    parser.add_argument('--soundfont', default='/usr/share/soundfonts/FluidR3_GM.sf2')
+    parser.add_argument('--output', default=None, help='write the results to this json file')
+    parser.add_argument('--baseline', default=None, help='json results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slow-down per item (0.25 = 25%%)')
+    parser.add_argument('--update-baseline', action='store_true', help='store this run as the new baseline')
+    args = parser.parse_args()
+    benchmark = Benchmark(args.size, args.media_sample, args.soundfont)
+    with (standInTools() if args.tools == 'stand-in' else contextlib.nullcontext()):
+        results = benchmark.run()
+    report = dict(size=args.size, tools=args.tools, python=platform.python_version(), stages=results)
+    for stage in STAGES:
+        print('%-16s %8.3f s  %8.3f ms/item  (%d items)' % (stage, results[stage]['seconds'],
+                                                           results[stage]['perItem'] * 1000, results[stage]['items']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    if args.baseline and args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=1)
+    elif args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compareToBaseline(results, baseline['stages'], args.threshold)
+        for stage, before, after in regressions:
+            print('REGRESSION %s: %.3f ms/item -> %.3f ms/item' % (stage, before * 1000, after * 1000))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,80 @@
+######################################################################################
+# -*- coding: utf-8 -*-
+# Incremental builds: per-stage manifest of input fingerprints and saved stage outputs
+# Copyright (c) 2024 Stefano Franchi <stefano.franchi@gmail.com>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/licenses/gpl.html
+######################################################################################
+
+import json
+import os
+import pickle
+import tempfile
+
+
+class BuildGraph(object):
+    """
+    Remembers, for every stage of the build and every item in it (e.g. one voicing of one chord),
+    the fingerprint of the inputs it was built from and the files it produced.
+    An item is clean when its fingerprint is unchanged and all its output files still exist;
+    clean items are loaded back from their saved artifact instead of being rebuilt.
+    The manifest is a json file in stateDir, the artifacts are pickles next to it.
+    """
+
+    def __init__(self, stateDir='.build'):
+        self.stateDir = stateDir
+        self.manifestFile = os.path.join(stateDir, 'manifest.json')
+        os.makedirs(os.path.join(stateDir, 'artifacts'), exist_ok=True)
+        try:
+            with open(self.manifestFile) as f:
+                self.manifest = json.load(f)
+        except (OSError, ValueError):
+            self.manifest = {}
+        self.rebuilt = {}  # stage -> number of items rebuilt in this run
+
+    def isDirty(self, stage, item, fingerprint):
+        """True if item must be rebuilt: new, changed inputs, or missing outputs"""
+        entry = self.manifest.get(stage, {}).get(item)
+        if entry is None or entry['fingerprint'] != fingerprint:
+            return True
+        return not all(os.path.exists(output) for output in entry['outputs'])
+
+    def record(self, stage, item, fingerprint, outputs=(), artifact=None):
+        """Remember that item was built from fingerprint, producing outputs (and an optional artifact to reload)"""
+        if artifact is not None:
+            with open(self.artifactPath(stage, item), 'wb') as f:
+                pickle.dump(artifact, f)
+        self.manifest.setdefault(stage, {})[item] = dict(fingerprint=fingerprint, outputs=list(outputs))
+        self.rebuilt[stage] = self.rebuilt.get(stage, 0) + 1
+
+    def cleanArtifact(self, stage, item, fingerprint):
+        """
+        :return: the saved artifact of item if it is clean, otherwise None
+        """
+        if self.isDirty(stage, item, fingerprint):
+            return None
+        try:
+            with open(self.artifactPath(stage, item), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            return None
+
+    def runStage(self, stage, item, fingerprint, stageFunc, outputs=()):
+        """
+        Run a whole-stage step (e.g. writing one package) only if its inputs or outputs changed
+        :return: True if the stage was run
+        """
+        if not self.isDirty(stage, item, fingerprint):
+            return False
+        stageFunc()
+        self.record(stage, item, fingerprint, outputs)
+        return True
+
+    def artifactPath(self, stage, item):
+        return os.path.join(self.stateDir, 'artifacts', '%s-%s.pickle' % (stage, item.replace('/', '-')))
+
+    def save(self):
+        """Write the manifest atomically"""
+        fd, tmpManifest = tempfile.mkstemp(dir=self.stateDir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(tmpManifest, self.manifestFile)
@@ -0,0 +1,203 @@
+######################################################################################
+# -*- coding: utf-8 -*-
+# Build tracing: per-chord, per-stage timings and resources, exported as json lines or a Chrome trace
+# Copyright (c) 2024 Stefano Franchi <stefano.franchi@gmail.com>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/licenses/gpl.html
+######################################################################################
+
+import json
+import os
+import sys
+import time
+import tracemalloc
+try:
+    import resource
+except ImportError:  # not available on Windows: no subprocess times there
+    resource = None
+
+
+def childrenCpuTime():
+    """User plus system time of all the finished subprocesses (lilypond, fluidsynth, ffmpeg, ...) so far"""
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Span(object):
+    """One traced step: a stage of the build for one item (chord/voicing, media file, package)"""
+
+    def __init__(self, tracer, stage, item):
+        self.tracer = tracer
+        self.stage = stage
+        self.item = item
+        self.outputs = []
+
+    def addOutput(self, fileName):
+        """Count the size of fileName (once written) in the bytes of this span"""
+        self.outputs.append(fileName)
+
+    def __enter__(self):
+        if self.tracer.traceMemory:
+            # tracemalloc has a single peak: keep the one of the enclosing span, then measure this span's own
+            self.peakBefore = tracemalloc.get_traced_memory()[1]
+            self.childrenPeak = 0
+            tracemalloc.reset_peak()
+            self.tracer.openSpans.append(self)
+        self.children = childrenCpuTime()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        wall = time.perf_counter() - self.start
+        written = 0
+        for fileName in self.outputs:
+            try:
+                written += os.path.getsize(fileName)
+            except OSError:
+                pass
+        if self.tracer.traceMemory:
+            peakMemory = max(tracemalloc.get_traced_memory()[1], self.childrenPeak)
+            self.tracer.openSpans.pop()
+            if self.tracer.openSpans:
+                parent = self.tracer.openSpans[-1]
+                parent.childrenPeak = max(parent.childrenPeak, self.peakBefore, peakMemory)
+        else:
+            peakMemory = None
+        self.tracer.records.append(dict(stage=self.stage, item=self.item, start=self.start - self.tracer.origin,
+                                        wall=wall, subprocess=childrenCpuTime() - self.children, bytes=written,
+                                        peakMemory=peakMemory, pid=os.getpid(), failed=excType is not None))
+        return False
+
+
+class NullSpan(object):
+    """The span of a disabled tracer: does nothing"""
+
+    def addOutput(self, fileName):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class NullTracer(object):
+    """
+    The tracer used when tracing is off. Every call returns at once, so that the
+    instrumented code costs one method call per span
+    """
+    enabled = False
+
+    def span(self, stage, item=''):
+        return NULL_SPAN
+
+    def startProgress(self, total, label=''):
+        pass
+
+    def advance(self, steps=1):
+        pass
+
+    def endProgress(self):
+        pass
+
+
+NULL_TRACER = NullTracer()
+
+
+class BuildTracer(NullTracer):
+    """
+    Records, for each stage of the build and each item in it, the wall time, the cpu time of
+    the subprocesses it ran, the bytes it wrote and the peak memory.
+    Peak memory is only measured with traceMemory, as the peak of the Python allocations during the span
+    (tracemalloc slows the build down); otherwise it is None, as the process' resident high-water mark
+    says nothing about a single span.
+    Optionally shows a progress line with an ETA on stderr.
+    """
+    enabled = True
+
+    def __init__(self, traceMemory=False, showProgress=False, progressStream=None):
+        self.records = []
+        self.origin = time.perf_counter()
+        self.traceMemory = traceMemory
+        self.openSpans = []  # the spans entered and not exited yet, innermost last
+        self.showProgress = showProgress
+        self.progressStream = progressStream or sys.stderr
+        self.progressTotal = 0
+        self.progressDone = 0
+        self.progressLabel = ''
+        self.progressStart = 0.0
+        self.startedTracemalloc = traceMemory and not tracemalloc.is_tracing()
+        if self.startedTracemalloc:
+            tracemalloc.start()
+
+    def close(self):
+        """Stop tracing the Python allocations, if this tracer started it"""
+        if self.startedTracemalloc:
+            tracemalloc.stop()
+            self.startedTracemalloc = False
+
+    def span(self, stage, item=''):
+        """
+        Trace a step: use as `with tracer.span('png', 'CM7/FullStandardV') as span: ...`
+        """
+        return Span(self, stage, item)
+
+    def startProgress(self, total, label=''):
+        """Start counting total steps for the progress display"""
+        self.progressTotal = total
+        self.progressDone = 0
+        self.progressLabel = label
+        self.progressStart = time.perf_counter()
+
+    def advance(self, steps=1):
+        """Count finished steps and refresh the progress line"""
+        self.progressDone += steps
+        if self.showProgress and self.progressTotal:
+            elapsed = time.perf_counter() - self.progressStart
+            eta = elapsed / self.progressDone * (self.progressTotal - self.progressDone)
+            self.progressStream.write('\r%6d/%d %s  %.1f s elapsed, ETA %.1f s ' %
+                                      (self.progressDone, self.progressTotal, self.progressLabel, elapsed, eta))
+            self.progressStream.flush()
+
+    def endProgress(self):
+        if self.showProgress and self.progressTotal:
+            self.progressStream.write('\n')
+        self.progressTotal = 0
+
+    def summary(self):
+        """
+        Totals per stage: dictionary stage -> dict(count, wall, subprocess, bytes, peakMemory)
+        (peakMemory is None when the memory was not traced)
+        """
+        stages = {}
+        for record in self.records:
+            total = stages.setdefault(record['stage'],
+                                      dict(count=0, wall=0.0, subprocess=0.0, bytes=0, peakMemory=None))
+            total['count'] += 1
+            total['wall'] += record['wall']
+            total['subprocess'] += record['subprocess']
+            total['bytes'] += record['bytes']
+            if record['peakMemory'] is not None:
+                total['peakMemory'] = max(total['peakMemory'] or 0, record['peakMemory'])
+        return stages
+
+    def writeJsonLines(self, fileName):
+        """One json object per traced span"""
+        with open(fileName, 'w') as f:
+            for record in self.records:
+                f.write(json.dumps(record) + '\n')
+
+    def writeChromeTrace(self, fileName):
+        """The spans as complete events of the Chrome trace format (chrome://tracing, Perfetto)"""
+        events = [dict(name=record['stage'], cat='build', ph='X', pid=record['pid'], tid=0,
+                       ts=record['start'] * 1e6, dur=record['wall'] * 1e6,
+                       args=dict(item=record['item'], subprocess=record['subprocess'], bytes=record['bytes'],
+                                 peakMemory=record['peakMemory'], failed=record['failed']))
+                  for record in self.records]
+        with open(fileName, 'w') as f:
+            json.dump(dict(traceEvents=events, displayTimeUnit='ms'), f)
@@ -0,0 +1,124 @@
+######################################################################################
+# -*- coding: utf-8 -*-
+# Card-template dependency analysis: which note fields (and so which renders) a deck really uses
+# Copyright (c) 2024 Stefano Franchi <stefano.franchi@gmail.com>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/licenses/gpl.html
+######################################################################################
+
+import csv
+import re
+
+# fields Anki fills in by itself, never taken from the note
+SPECIAL_FIELDS = {'FrontSide', 'Tags', 'Type', 'Deck', 'Subdeck', 'Card', 'CardFlag', 'CardID'}
+
+# voicing families of the field names (Fieldnames.txt, ChordsData.csv) and the Voicing generating them.
+# The rootless shell fields are filled by the ShellV voicing
+VOICING_FAMILIES = {'Rootless': 'ShellV', 'GuideTones': 'GuideTones', 'FourNotesSh_Ext': 'FourNotesShExt'}
+
+# field name suffix -> kind of Voicing artifact it shows
+FIELD_KINDS = {'': 'Notes', '-lilypond': 'Lilypond', '_LilyPond': 'Lilypond',
+               '-lilypondimg': 'Png', '_LilyPond_Image': 'Png', '_RH': 'Keyboard', '_LH': 'Keyboard',
+               '_ABC': 'ABC', '_ABC_mp3': 'Mp3'}
+
+VOICING_FIELD = re.compile(r'^(' + '|'.join(VOICING_FAMILIES) + r')_V_Off_(3rd|7th)(.*)$')
+TEMPLATE_TAG = re.compile(r'{{(.*?)}}')
+
+
+def templateFields(templates):
+    """
+    Names of the note fields referenced by the qfmt/afmt of card templates
+    ({{Field}}, {{#Field}}/{{^Field}}/{{/Field}} sections and filters such as {{text:Field}})
+    :param templates: list of genanki template dictionaries
+    :return: set of field names
+    """
+    fields = set()
+    for template in templates:
+        for side in ('qfmt', 'afmt'):
+            for tag in TEMPLATE_TAG.findall(template.get(side, '')):
+                name = tag.strip().lstrip('#^/').split(':')[-1].strip()
+                if name and name not in SPECIAL_FIELDS:
+                    fields.add(name)
+    return fields
+
+
+def declaredFields(fileName):
+    """
+    Field names declared in Fieldnames.txt (one {'name': ...} per line) or in the header of a ;-separated csv
+    :return: list of field names, in order and without repetitions
+    """
+    with open(fileName, newline='', encoding='utf-8') as f:
+        if fileName.endswith('.txt'):
+            names = re.findall(r"'name':\s*'([^']+)'", f.read())
+        else:
+            names = next(csv.reader(f, delimiter=';'), [])
+    return list(dict.fromkeys(name.strip() for name in names if name.strip()))
+
+
+def fieldArtifact(field, voicingArtifacts):
+    """
+    The Voicing artifact a field is filled from
+    :param voicingArtifacts: the artifacts of each voicing, as in Voicing.voicingArtifacts
+    :return: (voicing, artifact name), (voicing, None) if the voicing cannot render that field yet,
+             or None for a plain data field (Name, Root, ...)
+    """
+    match = VOICING_FIELD.match(field)
+    if match is None:
+        return None
+    family, position, suffix = match.groups()
+    voicing = VOICING_FAMILIES[family]
+    kind = FIELD_KINDS.get(suffix)
+    if kind is None:
+        return voicing, None
+    wanted = (voicing[0].lower() + voicing[1:] + 'Off' + position + kind).lower()
+    for artifact in voicingArtifacts.get(voicing, []):
+        if artifact.lower() == wanted:
+            return voicing, artifact
+    return voicing, None
+
+
+class FieldPlan(object):
+    """
+    What a set of card templates needs from the build: the fields they can reach and,
+    for each voicing, the artifacts filling those fields. Declared fields that no template
+    shows are skipped, so their media are never rendered.
+    """
+
+    def __init__(self, templates, declared, voicingArtifacts):
+        """
+        :param templates: list of genanki template dictionaries
+        :param declared: list of the declared field names (see declaredFields)
+        :param voicingArtifacts: the artifacts of each voicing, as in Voicing.voicingArtifacts
+        """
+        self.declared = list(declared)
+        self.reachable = templateFields(templates)
+        self.skipped = [field for field in self.declared if field not in self.reachable]
+        self.undeclared = sorted(self.reachable.difference(self.declared))
+        self.artifacts = {}  # voicing -> list of artifact names
+        self.unrenderable = []  # reachable fields that no Voicing can fill yet
+        for field in sorted(self.reachable):
+            source = fieldArtifact(field, voicingArtifacts)
+            if source is None:
+                continue
+            voicing, artifact = source
+            if artifact is None:
+                self.unrenderable.append(field)
+            elif artifact not in self.artifacts.setdefault(voicing, []):
+                self.artifacts[voicing].append(artifact)
+
+    def voicings(self):
+        """The voicings with at least one artifact to render"""
+        return [voicing for voicing, artifacts in self.artifacts.items() if artifacts]
+
+    def artifactNames(self):
+        """All the artifacts to render, as expected by GenAnkiChords.addVoicings"""
+        return [artifact for artifacts in self.artifacts.values() for artifact in artifacts]
+
+    def report(self):
+        """Print the fields skipped, and those shown by a template but not declared or not renderable"""
+        print(len(self.reachable), 'fields used by the card templates,', len(self.skipped), 'declared fields skipped:')
+        for field in self.skipped:
+            print('   skipped: ', field)
+        for field in self.undeclared:
+            print('   used but not declared: ', field)
+        for field in self.unrenderable:
+            print('   used but not rendered by any voicing: ', field)
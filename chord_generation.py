@@ -8,23 +8,47 @@
 
 # Import the library needed to manipulate and create an Anki deck
 import genanki
-import csv
 from string import Template
-import html
 import re
-from mingus.core import chords as mChords
-from mingus.containers import Note as mNote
+import chord_spelling
+import pitch_matrix
+import fingering
+import keyboard_diagram
+import lilypond_batch
+import audio_render
 from mingus.containers import NoteContainer as mNote_container
 from mingus.containers import Bar as mBar
 from mingus.extra import lilypond as LilyPond
-from mingus.midi.midi_file_out import write_Bar as mMidiFileOut
-from  pydub  import AudioSegment
-import subprocess
+import os
+import shutil
+import tempfile
+import inspect
+import hashlib
+import json
+import sqlite3
+import zipfile
+import zlib
+import itertools
+import time
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
+from functools import cached_property
+from media_cache import renderKey, MediaDedup
+from async_jobs import AsyncToolRunner
+from card_fields import FieldPlan, declaredFields
+from chord_import import ChordImporter
+from note_names import translationPairs, translateColumns
+from build_trace import NULL_TRACER
+from chord_vocabulary import ChordVocabulary
+from voice_leading import FAMILY_SHAPES, leadInAllKeys
 #################################################################################################
 #                                                Globals                                        #
 #################################################################################################
 def initGlobals():
+    """
+    The settings of the app. The note name tables map every English spelling to its Italian [ASCII, Unicode]
+    names and back (e.g. engl2ItNotes['Af'] == ['Lab', 'La♭']), see note_names.translationPairs
+    """
     chordsDatafile = "ChordsData.csv"
     ankiLocalPath = '/home/stefano/.local/share/Anki2/Stefano/'
     ankiMediaRepo = 'collection.media'
@@ -33,7 +57,7 @@ def initGlobals():
     deck_id= 1393751746  # randomly generated with import random; random.randrange(1 << 30, 1 << 31)
     deckName= "Comping Chords"
     deckFileName= "Comping-Chords.apkg"
-    engl2ItNotes, it2EnglNotes = createEnglItTransDicts()
+    engl2ItNotes, it2EnglNotes = translationPairs('english', 'italian'), translationPairs('italian', 'english')
     soundFont = '/usr/share/soundfonts/FluidR3_GM.sf2'
     return chordsDatafile,  model_id, deck_id, deckName, deckFileName, engl2ItNotes, it2EnglNotes, soundFont
 
@@ -46,6 +70,11 @@ def initGlobals():
     # for fieldNames generation in chordItems
     extraFields = 'sortId'
 
+# the modules whose code shapes the notes and media of every voicing (see Voicing.definitionSource)
+DEFINITION_MODULES = [chord_spelling, pitch_matrix, fingering, keyboard_diagram, lilypond_batch, audio_render]
+# memo of Voicing.definitionSource, the sources do not change during a build
+_definitionSources = {}
+
 #########################################################################################
 #                                      CLASSES                                          #
 #########################################################################################
@@ -67,37 +96,273 @@ class GenAnkiChords():
 
     """
 
-    def __init__(self, roots, qualities, voicings):
+    def __init__(self, roots, qualities, voicings, mediaCache=None, batchLilyPond=False, workers=1,
+                 audioReel=False, audioRenderer=None, buildGraph=None, dedupMedia=False, tracer=None,
+                 asyncJobs=False):
         """
         Initialize variables and all the parameters of the app, then build all the ChordItems
+        :param mediaCache: optional MediaCache, so that unchanged chords are not rendered again
+        :param batchLilyPond: engrave all the pngs of chordsDb with a few lilypond calls at the end of addVoicings
+        :param workers: number of processes generating the voicings (None for one per cpu)
+        :param audioReel: synthesize all the mp3s of chordsDb in a single fluidsynth pass at the end of addVoicings
+        :param audioRenderer: renderer for the mp3s (e.g. numpy_synth.NumpySynthRenderer), default Voicing.audioRenderer
+        :param buildGraph: optional BuildGraph, so that only the voicings whose inputs changed are generated again
+        :param dedupMedia: render identical-sounding (e.g. enharmonic) or identically engraved media once, and share the file
+        :param tracer: optional build_trace.BuildTracer recording the time and resources of every stage and chord
+        :param asyncJobs: run lilypond and fluidsynth/ffmpeg for all the chords concurrently at the end of addVoicings
+                          (see async_jobs.AsyncToolRunner); the failed renders are listed in self.asyncRunner.errors
         """
+        if workers != 1 and (batchLilyPond or audioReel or dedupMedia or asyncJobs):
+            raise ValueError("batchLilyPond, audioReel, dedupMedia and asyncJobs need to see every render of the build, "
+                             "they cannot be used with worker processes")
         self.roots = roots
         self.qualities = qualities
         self.voicings = voicings
+        self.mediaCache = mediaCache
+        self.lilyPondBatch = lilypond_batch.LilyPondBatch() if batchLilyPond else None
+        self.workers = workers
+        self.audioReel = audio_render.AudioReel() if audioReel else None
+        self.audioRenderer = audioRenderer
+        self.buildGraph = buildGraph
+        self.mediaDedup = MediaDedup() if dedupMedia else None
+        self.tracer = tracer if tracer is not None else NULL_TRACER
+        self.asyncRunner = AsyncToolRunner() if asyncJobs else None
         self.chordsDb = {}
 
+    def renderOptions(self):
+        """The rendering set-up of this build, handed to every Voicing"""
+        return dict(mediaCache=self.mediaCache, lilyPondBatch=self.lilyPondBatch,
+                    audioReel=self.audioReel, audioRenderer=self.audioRenderer, mediaDedup=self.mediaDedup,
+                    tracer=self.tracer, asyncRunner=self.asyncRunner)
+
+    def syncRenderOptions(self):
+        """
+        The rendering set-up of the voicings once addVoicings is over: the batch, reel and runner are flushed
+        by then, so the artifacts read later are rendered right away
+        """
+        return dict(self.renderOptions(), lilyPondBatch=None, audioReel=None, asyncRunner=None)
+
     def initDb(self):
         # create the chordsDb with a row for each chord as a chordItem
-        self.chordsDb = {r+q:ChordItem(r,q) for r in self.roots for q in self.qualities}
+        with self.tracer.span('initDb'):
+            self.chordsDb = {r+q:ChordItem(r,q) for r in self.roots for q in self.qualities}
+
+    def importDb(self, fileName, sheet=None, importer=None):
+        """
+        Fill the chordsDb from a chord table (ChordsData.csv, ChordData.ods or a voicing library)
+        instead of roots x qualities. The table is streamed row by row, and malformed rows are skipped
+        :param sheet: sheet of an ods file, default the first one
+        :param importer: optional ChordImporter (e.g. a strict one)
+        :return: the importer, holding the errors with their line numbers
+        """
+        importer = importer if importer is not None else ChordImporter()
+        with self.tracer.span('importDb', fileName):
+            for line, root, quality, inversion, row in importer.chords(fileName, sheet):
+                chordItem = ChordItem(root, quality, inversion=inversion)
+                self.chordsDb[root+quality+('/'+inversion if inversion else '')] = chordItem
+        return importer
+
+    def enumerateDb(self, vocabulary=None):
+        """
+        Fill the chordsDb with the extended vocabulary (9ths, 11ths, 13ths, altered, sus chords and their
+        inversions) instead of roots x qualities: only the chords that sound different get an item, with
+        the voicings that fit the keyboard range (see chord_vocabulary.ChordVocabulary); with dedupMedia
+        the voicings two chords share are rendered once
+        :param vocabulary: optional ChordVocabulary, default every root, quality and inversion in self.voicings
+        :return: the vocabulary, counting the candidates dropped
+        """
+        vocabulary = vocabulary if vocabulary is not None else ChordVocabulary(voicings=self.voicings)
+        with self.tracer.span('enumerateDb'):
+            for chord in vocabulary.chords():
+                self.chordsDb[chord.key] = ChordItem(chord.root, chord.quality, list(chord.voicings), chord.inversion)
+        return vocabulary
+
 
+    def leadProgressions(self, progressions=('ii-V-I',), bars=16):
+        """
+        Voice progressions in all keys with the least voice movement, in each voicing family of the build
+        that voice_leading knows (ShellV, GuideTones, FourNotesShExt)
+        :param progressions: names from voice_leading.PROGRESSIONS
+        :param bars: length of each progression, repeating its chords
+        :return: dictionary (progression, family) -> dictionary key -> voice_leading.LeadSheet
+        """
+        leadSheets = {}
+        with self.tracer.span('leadProgressions'):
+            for name in progressions:
+                for family in self.voicings:
+                    if family in FAMILY_SHAPES:
+                        leadSheets[(name, family)] = leadInAllKeys(name, family, bars)
+        return leadSheets
 
-    def addVoicings(self):
+    def addVoicings(self, artifacts=None, chordVoicings=None):
         """
         Create all voicings for each chordItem
-        :return:
+        In batch (reel) mode the pngs (mp3s) are only queued by the voicings and rendered together at the end.
+        With a buildGraph, voicings whose inputs did not change are loaded back from the previous build
+        :param artifacts: names of the Voicing artifacts to render now (e.g. ['fullStandardVNotes']), None for all;
+                          the others are left to be rendered on first access
+        :param chordVoicings: dictionary chordsDb key -> voicings to create for that chord (e.g. the union of
+                              several decks, see multi_deck), default the voicings of the build each chord needs
+        :return: the dictionary media filename -> True if rendered, for the batched media
+        """
+        with self.tracer.span('addVoicings'):
+            return self.addPendingVoicings(artifacts, chordVoicings)
+
+    def addPendingVoicings(self, artifacts=None, chordVoicings=None):
+        """Body of addVoicings"""
+        pending = self.pendingVoicings(artifacts, chordVoicings)
+        results = {}
+        self.tracer.startProgress(len(pending), 'voicings')
+        if self.workers != 1:
+            self.addVoicingsParallel(pending, artifacts)
+        else:
+            for key, voicing in pending:
+                with self.tracer.span('voicing', key+'/'+voicing):
+                    self.chordsDb[key].addVoicing(voicing, self.voicingArtifacts(voicing, artifacts),
+                                                  **self.renderOptions())
+                self.tracer.advance()
+            if self.lilyPondBatch is not None:
+                with self.tracer.span('lilyPondBatch'):
+                    results.update(self.lilyPondBatch.flush())
+            if self.audioReel is not None:
+                with self.tracer.span('audioReel'):
+                    results.update(self.audioReel.flush())
+            if self.asyncRunner is not None:
+                with self.tracer.span('asyncJobs'):
+                    results.update(self.asyncRunner.flush())
+            for key, voicing in pending:
+                self.chordsDb[key].voicings[voicing].setRenderOptions(**self.syncRenderOptions())
+        self.tracer.endProgress()
+        if self.buildGraph is not None:
+            for key, voicing in pending:
+                newVoicing = self.chordsDb[key].voicings[voicing]
+                outputs = newVoicing.mediaFiles()
+                if all(os.path.exists(output) for output in outputs):  # a failed render is built again next time
+                    self.buildGraph.record('voicings', key+'/'+voicing,
+                                           self.voicingFingerprint(self.chordsDb[key], voicing), outputs, newVoicing)
+            self.buildGraph.save()
+        return results
+
+    def pruneToTemplates(self, templates=None, fieldsFile='ChordsData.csv'):
+        """
+        Keep only the voicings the card templates show, and work out which of their artifacts to render,
+        reporting the declared fields no template uses
+        :param templates: genanki card templates, default AnkiDeck.cardTemplates
+        :param fieldsFile: Fieldnames.txt or ChordsData.csv, declaring all the note fields
+        :return: FieldPlan, whose artifactNames() are meant for addVoicings
+        """
+        plan = FieldPlan(AnkiDeck.cardTemplates if templates is None else templates,
+                         declaredFields(fieldsFile), Voicing.voicingArtifacts)
+        self.voicings = [voicing for voicing in self.voicings if voicing in plan.voicings()]
+        plan.report()
+        return plan
+
+    def voicingArtifacts(self, voicing, artifacts=None):
+        """The artifacts of voicing among artifacts (all of them if artifacts is None)"""
+        return [name for name in Voicing.voicingArtifacts.get(voicing, []) if artifacts is None or name in artifacts]
+
+    def pendingVoicings(self, artifacts=None, chordVoicings=None):
+        """
+        List the (chordsDb key, voicing) pairs to generate, filling in the clean ones from the buildGraph
+        (a saved voicing is only clean if it holds all the artifacts asked for)
+        :param chordVoicings: see addVoicings
+        """
+        pending = []
+        for key, chordItem in self.chordsDb.items():
+            voicings = self.itemVoicings(chordItem) if chordVoicings is None else chordVoicings.get(key, [])
+            for voicing in voicings:
+                if self.buildGraph is not None:
+                    previous = self.buildGraph.cleanArtifact('voicings', key+'/'+voicing,
+                                                             self.voicingFingerprint(chordItem, voicing))
+                    if previous is not None and previous.hasArtifacts(self.voicingArtifacts(voicing, artifacts)):
+                        previous.setRenderOptions(**self.syncRenderOptions())  # not pickled with the voicing
+                        chordItem.voicings[voicing] = previous
+                        continue
+                pending.append((key, voicing))
+        return pending
+
+    def itemVoicings(self, chordItem):
+        """The voicings of the build a chordItem needs (all of them unless the item lists its own)"""
+        return [voicing for voicing in self.voicings
+                if not chordItem.voicingsNeeded or voicing in chordItem.voicingsNeeded]
+
+    def voicingFingerprint(self, chordItem, voicing):
+        """
+        Fingerprint of everything a voicing is generated from: chord, voicing definition, template, soundfont
+        (of the renderer that writes its mp3s, the reel's when there is one, as in Voicing.barToMp3)
+        """
+        if self.audioReel is not None:
+            rendererKey = ('reel',) + self.audioReel.renderer.cacheKey()
+        else:
+            audioRenderer = self.audioRenderer if self.audioRenderer is not None else Voicing.audioRenderer
+            rendererKey = audioRenderer.cacheKey()
+        quality = chordItem.quality + ('/'+chordItem.inversion if chordItem.inversion else '')
+        return renderKey(chordItem.root, quality, voicing, Voicing.definitionSource(voicing), rendererKey)
+
+    def addVoicingsParallel(self, pending=None, artifacts=None):
         """
-        for chordItem in self.chordsDb.values():
-            for voicing in self.voicings:
-                chordItem.addVoicing(voicing)
+        Create all voicings (or the pending (key, voicing) pairs) for each chordItem on a pool of worker processes.
+        Only the given artifacts (default all) are rendered by the workers.
+        Every chord/voicing job renders in its own scratch directory and the finished
+        Voicing instances are gathered back into the chordItems' voicings dictionaries.
+        The media are rendered by the workers themselves (which is why __init__ does not accept batchLilyPond,
+        audioReel, asyncJobs or dedupMedia with workers), the hits and misses of the workers' copies of the
+        mediaCache are added to self.mediaCache, and the tracer only counts the voicings gathered back
+        (the workers' own spans are not traced). The gathered voicings get the build's render set-up back,
+        for the artifacts read later.
+        """
+        if pending is None:
+            pending = [(key, voicing) for key, chordItem in self.chordsDb.items()
+                       for voicing in self.itemVoicings(chordItem)]
+        renderOptions = self.renderOptions()
+        renderOptions.update(lilyPondBatch=None, audioReel=None, mediaDedup=None, tracer=None, asyncRunner=None)
+        jobs = [(key, self.chordsDb[key].root, self.chordsDb[key].quality, self.chordsDb[key].inversion, voicing,
+                 renderOptions, self.voicingArtifacts(voicing, artifacts)) for key, voicing in pending]
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            for key, voicing, newVoicing, cacheCounts in pool.map(renderVoicingJob, jobs):
+                newVoicing.setRenderOptions(**self.syncRenderOptions())
+                self.chordsDb[key].voicings[voicing] = newVoicing
+                if cacheCounts is not None:
+                    self.mediaCache.mergeCounts(cacheCounts)
+                self.tracer.advance()
+
+
+def renderVoicingJob(job):
+    """
+    Worker side of GenAnkiChords.addVoicingsParallel: generate one voicing of one chord
+    inside a private scratch directory, so that concurrent jobs never share temporary files
+    :param job: (chordsDb key, root, quality, inversion, voicing name, render options, artifact names to render)
+    :return: (chordsDb key, voicing name, Voicing instance, what the job added to the counters of the
+              mediaCache or None without one)
+    """
+    key, root, quality, inversion, voicing, renderOptions, artifacts = job
+    if not hasattr(Voicing, 'gen'+voicing):
+        raise NotImplementedError("Class `Voicing` does not implement `{}`".format('gen'+voicing))
+    newVoicing = Voicing(root, quality, inversion, **renderOptions)
+    mediaCache = renderOptions.get('mediaCache')
+    countsBefore = mediaCache.counts() if mediaCache is not None else None
+    newVoicing.scratchDir = tempfile.mkdtemp(prefix='genankichords-')
+    try:
+        newVoicing.materialize(voicing, artifacts)
+    finally:
+        shutil.rmtree(newVoicing.scratchDir, ignore_errors=True)
+        del newVoicing.scratchDir
+    cacheCounts = None
+    if mediaCache is not None:
+        cacheCounts = {name: count - countsBefore[name] for name, count in mediaCache.counts().items()}
+    return key, voicing, newVoicing, cacheCounts
 
 
 @dataclass
 class ChordItem(object):
     __slots__ = ['id' 'sortId', 'name', 'root', 'quality', 'chord', 'inversion', 'voicingsNeeded', 'voicings']
 
-    def __init__(self,root, quality,voicings=[]):
+    def __init__(self,root, quality,voicings=[], inversion=''):
         self.root = root
         self.quality = quality
+        # a ValueError here rather than when the voicings are rendered
+        chord_spelling.bassDegree(root, quality, inversion)
+        self.inversion = inversion # the bass note of an inverted chord, '' in root position
         self.voicingsNeeded = voicings # The list of voicings this instance can generate
         self.voicings = {}  # The dictionary actually containing the voicings
         self.name = self.addName()
@@ -109,7 +374,7 @@ class ChordItem(object):
         :param quality:
         :return: name
         """
-        return self.root+'-'+self.quality
+        return self.root+'-'+self.quality+('/'+self.inversion if self.inversion else '')
 
     def genVoicings(self, voicing):
         """Generate all the voicings for each chordItem"""
@@ -117,20 +382,21 @@ class ChordItem(object):
             v = self.addVoicing(voicing)
         return True
 
-    def addVoicing(self, voicing):
+    def addVoicing(self, voicing, artifacts=(), **renderOptions):
         """
-            Add a voicing (including all necessary media files) to the chordItem
+            Add a voicing to the chordItem. Its notes, lilypond source and media files are
+            rendered on first access (see Voicing.voicingArtifacts), except for those listed in artifacts
+            :param artifacts: names of the artifacts to render right away
+            :param renderOptions: rendering set-up passed on to the Voicing (see Voicing.renderOptionNames)
             :return: True if successful
         """
-        try:
-            newVoicing = Voicing(self.root,self.quality)
-            genVoicingMethod = getattr(Voicing,'gen'+voicing)
-            genVoicingMethod(newVoicing)
-            self.voicings[voicing]=(newVoicing)
-            return True
-        except AttributeError:
+        if not hasattr(Voicing, 'gen'+voicing):
             raise NotImplementedError(
-                "Class `{}` does not implement `{}`".format(Voicing.__class__.__name__, genVoicingMethod))
+                "Class `{}` does not implement `{}`".format(Voicing.__name__, 'gen'+voicing))
+        newVoicing = Voicing(self.root,self.quality,self.inversion,**renderOptions)
+        newVoicing.materialize(voicing, artifacts)
+        self.voicings[voicing]=(newVoicing)
+        return True
 
 
 
@@ -138,7 +404,6 @@ class ChordItem(object):
 class Voicing():
     """
     TODO: Add translations of notes for every voicing
-    TODO: add generation of fingering (from construction of keyboard on)
     TODO: complete shell voicing generation
     TODO: add guide tones voicing generation
     TODO: add four notes shell extended voicing
@@ -153,37 +418,269 @@ class Voicing():
     auxiliaryFieldsSuffixes = ['LH', 'RH', 'LilyPond', 'LilyPondMidiLink', 'LilyPondSndLink']
     tmpPng = '' # temporary file holding the LilyPond-generated png file
     tmpMIDI = '' # temporary file holding the mingus--generated MIDI file
-    tmpMp3 = '' # temporary file holding the fluidsynth-generated and pydub-converted mp3 file
+    tmpMp3 = '' # temporary file holding the fluidsynth-generated and ffmpeg-encoded mp3 file
+    inversion = '' # bass note of an inverted chord
+    bassDegree = 0 # chord degree in the bass
+    audioRenderer = audio_render.defaultAudioRenderer() # turns bars into mp3 files, shared by all the voicings
+    mediaCache = None # optional MediaCache shared by all the voicings of a build
+    lilyPondBatch = None # optional LilyPondBatch collecting the pngs to engrave
+    audioReel = None # optional AudioReel collecting the bars to synthesize
+    mediaDedup = None # optional MediaDedup sharing one file between identical renders
+    scratchDir = '.' # directory for the temporary MIDI and audio files of this voicing
+    tracer = NULL_TRACER # build_trace tracer timing the renders
+    asyncRunner = None # optional AsyncToolRunner collecting the lilypond and synth jobs to run concurrently
+    renderOptionNames = ['mediaCache', 'lilyPondBatch', 'audioReel', 'audioRenderer', 'mediaDedup', 'scratchDir',
+                         'tracer', 'asyncRunner']
+    # the lazily rendered artifacts (cached properties) of each voicing
+    voicingArtifacts = {
+        'FullStandardV': ['fullStandardVNotes', 'fullStandardVLilyPond', 'fullStandardVPng', 'fullStandardVMp3',
+                          'fullStandardVFingering', 'fullStandardVKeyboard'],
+        'ShellV': ['shellVOff3rdNotes', 'shellVOff7thNotes', 'shellVOff3rdLilypond', 'shellVOff7thLilypond',
+                   'shellVOff3rdFingering', 'shellVOff7thFingering', 'shellVOff3rdKeyboard', 'shellVOff7thKeyboard'],
+    }
 
-    def __init__(self,root,quality):
+    def __init__(self,root,quality,inversion='',**renderOptions):
+        """
+        :param inversion: bass note of an inverted chord (only FullStandardV is inverted)
+        :param renderOptions: overrides of the class-level rendering set-up (see renderOptionNames), None keeps the default
+        """
         self.root = root
         self.quality = quality
-        self.chord = mChords.from_shorthand(root+quality)
-        self.lilyPondTemplate = self.getLilyPondTemplate()
+        self.setRenderOptions(**renderOptions)
+        self.chord = chord_spelling.chordNotes(root, quality)
+        self.inversion = inversion
+        self.bassDegree = chord_spelling.bassDegree(root, quality, inversion)
+
+    def __getstate__(self):
+        # the render set-up belongs to the build, not to the voicing: leave it out of pickles
+        return {k: v for k, v in self.__dict__.items() if k not in self.renderOptionNames}
+
+    def setRenderOptions(self, **renderOptions):
+        """
+        Set up the rendering of the artifacts not rendered yet
+        :param renderOptions: overrides of the class-level rendering set-up (see renderOptionNames),
+                              None restores the default
+        """
+        for option, value in renderOptions.items():
+            if option not in self.renderOptionNames:
+                raise TypeError("Voicing got an unknown render option `{}`".format(option))
+            if value is not None:
+                setattr(self, option, value)
+            else:
+                self.__dict__.pop(option, None)
 
     ############### Utilities methods ######################################
+    @classmethod
+    def definitionSource(cls, voicing):
+        """
+        Source code of everything a voicing is rendered by (for build fingerprints): its own gen methods,
+        the methods shared by all the voicings (lilypond template, png and mp3 rendering, fingering, keyboards)
+        and the DEFINITION_MODULES. The gen methods of the other voicings are left out
+        """
+        if voicing not in _definitionSources:
+            functions = [getattr(getattr(cls, name), '__func__', getattr(cls, name)) for name in sorted(vars(cls))
+                         if not name.startswith('gen') or name.startswith('gen'+voicing)]
+            # the methods written here, not the ones @dataclass generates
+            functions = [function for function in functions
+                         if inspect.isfunction(function) and function.__code__.co_filename == __file__]
+            _definitionSources[voicing] = ''.join([inspect.getsource(function) for function in functions] +
+                                                  [inspect.getsource(module) for module in DEFINITION_MODULES])
+        return _definitionSources[voicing]
+
+    def materialize(self, voicing, artifacts=None):
+        """
+        Render now the artifacts of voicing (default all of them) that were not rendered yet.
+        A voicing without lazy artifacts is generated by its gen method
+        :param artifacts: names from voicingArtifacts[voicing]
+        """
+        if voicing not in self.voicingArtifacts:
+            getattr(self, 'gen'+voicing)()
+            return
+        for name in self.voicingArtifacts.get(voicing, []):
+            if artifacts is None or name in artifacts:
+                getattr(self, name)
+
+    def hasArtifacts(self, artifacts):
+        """True if all the named artifacts have already been rendered"""
+        return all(name in self.__dict__ for name in artifacts)
+
+    def fingeredHands(self, notes):
+        """
+        Split notes between the hands (octave 3 and below to the left one) and finger them
+        (see fingering.chordFingering); a hand that cannot reach its notes gets no fingers
+        :return: dictionary 'LH'/'RH' -> list of (mingus Note, finger or None), lowest first
+        """
+        hands = dict(LH=sorted((n for n in notes if n.octave <= 3), key=int),
+                     RH=sorted((n for n in notes if n.octave > 3), key=int))
+        # mingus' int(Note) is 12 below the MIDI pitch
+        fingers = fingering.chordFingering([int(n) + 12 for n in hands['LH']], [int(n) + 12 for n in hands['RH']])
+        return {hand: list(zip(hands[hand], fingers[hand] or [None] * len(hands[hand]))) for hand in hands}
+
+    def fingeringFields(self, notes):
+        """The RH and LH fields of a voicing: the fingers of each hand from the lowest note up ('1 3 5')"""
+        return {hand: ' '.join(str(finger) for note, finger in fingered if finger is not None)
+                for hand, fingered in self.fingeredHands(notes).items()}
+
+    def keyboardFields(self, notes, voicingName):
+        """
+        The LH and RH image fields of a voicing: a keyboard diagram per hand with its keys and fingers
+        (see keyboard_diagram), '' for a hand that plays nothing. The diagrams go where the other media go,
+        through the media cache when there is one (they are drawn in-process, never queued to the asyncRunner).
+        With a mediaDedup, a diagram already drawn in this build is linked instead of drawn again
+        """
+        fields = {}
+        for hand, fingered in self.fingeredHands(notes).items():
+            if not fingered:
+                fields[hand] = ''
+                continue
+            pitches = [int(note) + 12 for note, finger in fingered]
+            fingers = [finger for note, finger in fingered]
+            fileOut = self.fileStem()+'-'+voicingName+'-'+hand+'.png'
+            key = renderKey('keyboard', hand, pitches, fingers, keyboard_diagram.keyboardDiagram().cacheKey())
+            isNew = True
+            if self.mediaDedup is not None:
+                fileOut, isNew = self.mediaDedup.sharedFile(key, fileOut)
+            if isNew and (self.mediaCache is None or not self.mediaCache.fetch(key, fileOut)):
+                with self.tracer.span('keyboard', fileOut) as span:
+                    keyboard_diagram.keyboardDiagram().writeDiagram(fileOut, pitches, fingers, hand)
+                    span.addOutput(fileOut)
+                self.renderDone(key)(fileOut, True)
+            fields[hand] = '<img src=\"{filename}\"\\>'.format(filename=fileOut)
+        return fields
+
+    @staticmethod
+    def lilyPondNote(note, finger=None):
+        """A mingus Note in absolute lilypond english notation, with its fingering (C4, 1 -> c'-1)"""
+        name = note.name[0].lower() + note.name[1:].replace('#', 's').replace('b', 'f')
+        octave = note.octave - 3
+        return name + ("'" * octave if octave > 0 else ',' * -octave) + ('-{}'.format(finger) if finger else '')
+
+    def fileStem(self):
+        """Start of the media file names of the chord (CM7, CM7-on-E for its first inversion)"""
+        return self.root+self.quality+('-on-'+self.inversion if self.inversion else '')
+
+    def mediaFiles(self):
+        """Names of the media files referenced by the img/snd tags of the artifacts rendered so far"""
+        texts = [text for value in self.__dict__.values()
+                 for text in (value.values() if isinstance(value, dict) else [value]) if isinstance(text, str)]
+        return sorted(set(name for text in texts for name in re.findall(r'src="([^"]+)"', text)))
+
+    def barSignature(self, bar):
+        """Return the sounding content of a mingus bar as plain values (for cache keys)"""
+        return [(beat, duration, sorted((int(n), n.velocity, n.channel) for n in notes or []))
+                for beat, duration, notes in bar]
+
     def barToMp3(self, bar, mp3FileOut: str, bpm=80):
-        """ TODO: Find out while .wav and .mp3 files don't get closed"
-        Convert a mingus bar to mp3 file using pydub and fluidsynth"""
-        tempMIDIout = 'tmpMidi.mid'
-        tempAudioOut =   'tmpWav.wav'
-        try:
-            mMidiFileOut(tempMIDIout, bar, bpm)
-            p = subprocess.run(["fluidsynth", "-ni", '/usr/share/soundfonts/FluidR3_GM.sf2', tempMIDIout, "-F", tempAudioOut])
-            print('flac file written as: ', tempAudioOut, "with results: ", p)
-        except:
-            print('Conversion of MIDI to flac failed')
+        """
+        Convert a mingus bar to mp3 file, going through the media cache when there is one.
+        With an audioReel (or an asyncRunner) the bar is only queued, and synthesized when the reel (runner) is flushed.
+        With a mediaDedup, a bar sounding exactly like one already rendered (by the same renderer) links to that mp3
+        """
+        if self.audioReel is not None:
+            rendererKey = ('reel',) + self.audioReel.renderer.cacheKey()
+        else:
+            rendererKey = self.audioRenderer.cacheKey()
+        key = renderKey('mp3', self.barSignature(bar), bpm, rendererKey)
+        if self.mediaDedup is not None:
+            mp3FileOut, isNew = self.mediaDedup.sharedFile(key, mp3FileOut)
+            if not isNew:
+                return '<snd src="'+mp3FileOut+'" \\>'
+        sndTag = '<snd src="'+mp3FileOut+'" \\>'
+        if self.mediaCache is not None and self.mediaCache.fetch(key, mp3FileOut):
+            return sndTag
+        queueToRunner = self.asyncRunner is not None and self.audioRenderer.subprocessPipeline
+        if self.audioReel is not None or queueToRunner:
+            if self.audioReel is not None:
+                self.audioReel.add(bar, mp3FileOut, bpm, self.renderDone(key))
+            else:
+                self.queueMp3Job(bar, mp3FileOut, bpm, self.renderDone(key))
+            return sndTag
+        with self.tracer.span('mp3', mp3FileOut) as span:
+            result = self.renderBarToMp3(bar, mp3FileOut, bpm)
+            span.addOutput(mp3FileOut)
+        self.renderDone(key)(mp3FileOut, bool(result))
+        return result
 
-        # read back wav and save it as mp3 with pydub
-        try:
-            temp = AudioSegment.from_wav(tempAudioOut)
-            temp.export(mp3FileOut, format="mp3")
-            sndTag = '<snd src="'+mp3FileOut+'" \\>'
+    def renderDone(self, key):
+        """
+        The callback(fileOut, success) closing a render: a successful one goes into the mediaCache,
+        and the mediaDedup is told how it went (so that a failed render is not shared)
+        """
+        def onDone(fileOut, success):
+            if success and self.mediaCache is not None:
+                self.mediaCache.store(key, fileOut)
+            if self.mediaDedup is not None:
+                self.mediaDedup.renderDone(key, success)
+        return onDone
+
+    def queueMp3Job(self, bar, mp3FileOut, bpm=80, onDone=None):
+        """Queue the synth | encoder pipeline of a bar to the asyncRunner, removing its MIDI file once done"""
+        commands, midiFile = self.audioRenderer.pipelineCommands(bar, mp3FileOut, bpm, self.scratchDir)
+
+        def jobDone(fileOut, success):
+            os.remove(midiFile)
+            if onDone is not None:
+                onDone(fileOut, success)
+        self.asyncRunner.add(self.fileStem(), commands, mp3FileOut, jobDone)
+
+    def renderBarToMp3(self, bar, mp3FileOut: str, bpm=80):
+        """Convert a mingus bar to mp3 file with the voicing's audio renderer"""
+        if self.audioRenderer.renderBar(bar, mp3FileOut, bpm, self.scratchDir):
             print('mp3 file written out as: ', mp3FileOut)
-            return sndTag
-        except:
-            print('mp3 production failed')
+            return '<snd src="'+mp3FileOut+'" \\>'
+        print('mp3 production failed')
+
 
+    def lilyPondToPng(self, lilyPondString, pngFileOut):
+        """
+        Engrave a lilypond string to png, going through the media cache when there is one.
+        With a lilyPondBatch (or an asyncRunner) the png is only queued, and written when the batch (runner) is flushed.
+        With a mediaDedup, a string already engraved in this build is not engraved again
+        :return: the name of the png file to link to
+        """
+        key = renderKey('png', lilyPondString, lilypond_batch.LilyPondBatch.lilyPondCmd)
+        if self.mediaDedup is not None:
+            pngFileOut, isNew = self.mediaDedup.sharedFile(key, pngFileOut)
+            if not isNew:
+                return pngFileOut
+        if self.lilyPondBatch is not None or self.asyncRunner is not None:
+            if self.mediaCache is not None and self.mediaCache.fetch(key, pngFileOut):
+                return pngFileOut
+            if self.lilyPondBatch is not None:
+                self.lilyPondBatch.add(lilyPondString, pngFileOut, self.renderDone(key))
+            else:
+                self.queueLilyPondJob(lilyPondString, pngFileOut, self.renderDone(key))
+        else:
+            with self.tracer.span('png', pngFileOut) as span:
+                if self.mediaCache is None:
+                    success = lilypond_batch.LilyPondBatch.engrave(lilyPondString, pngFileOut, self.scratchDir)
+                else:
+                    success = self.mediaCache.getOrRender(
+                        key, pngFileOut,
+                        lambda: lilypond_batch.LilyPondBatch.engrave(lilyPondString, pngFileOut, self.scratchDir))
+                span.addOutput(pngFileOut)
+            if self.mediaDedup is not None:
+                self.mediaDedup.renderDone(key, success)
+        return pngFileOut
+
+    def queueLilyPondJob(self, lilyPondString, pngFileOut, onDone=None):
+        """Queue the engraving of a lilypond string to the asyncRunner, in a scratch directory of its own"""
+        lyDir = tempfile.mkdtemp(prefix='lilypond-job-', dir=self.scratchDir)
+        lyFile = os.path.join(lyDir, 'chord.ly')
+        with open(lyFile, 'w') as f:
+            f.write(lilyPondString)
+
+        def jobDone(fileOut, success):
+            success = success and lilypond_batch.LilyPondBatch.collectPng(lyFile, fileOut)
+            shutil.rmtree(lyDir, ignore_errors=True)
+            if onDone is not None:
+                onDone(fileOut, success)
+        command = lilypond_batch.LilyPondBatch.lilyPondCmd + ['-o', os.path.join(lyDir, 'chord'), lyFile]
+        self.asyncRunner.add(self.fileStem(), [command], pngFileOut, jobDone)
+
+    @cached_property
+    def lilyPondTemplate(self):
+        return self.getLilyPondTemplate()
 
     def getLilyPondTemplate(self):
         """"""
@@ -209,73 +706,145 @@ class Voicing():
                                     """)
         return templ
 
+    ############### Artifacts: rendered on first access, then kept ######################################
+    @cached_property
+    def fullStandardVNotes(self):
+        return self.genFullStandardVNotes()
+
+    @cached_property
+    def fullStandardVLilyPond(self):
+        return self.genFullStandardVLilyPond()
+
+    @cached_property
+    def fullStandardVPng(self):
+        return self.genFullStandardVPng()
+
+    @cached_property
+    def fullStandardVMp3(self):
+        return self.genFullStandardVMp3()
+
+    @cached_property
+    def fullStandardVFingering(self):
+        return self.genFullStandardVFingering()
+
+    @cached_property
+    def fullStandardVKeyboard(self):
+        return self.genFullStandardVKeyboard()
+
+    @cached_property
+    def shellVOff3rdNotes(self):
+        return self.genShellVOff3rdNotes()
+
+    @cached_property
+    def shellVOff7thNotes(self):
+        return self.genShellVOff7thNotes()
+
+    @cached_property
+    def shellVOff3rdLilypond(self):
+        return self.genShellVOff3rdLilyPond()
+
+    @cached_property
+    def shellVOff7thLilypond(self):
+        return self.genShellVOff7thLilyPond()
+
+    @cached_property
+    def shellVOff3rdFingering(self):
+        return self.genShellVOff3rdFingering()
+
+    @cached_property
+    def shellVOff7thFingering(self):
+        return self.genShellVOff7thFingering()
+
+    @cached_property
+    def shellVOff3rdKeyboard(self):
+        return self.genShellVOff3rdKeyboard()
+
+    @cached_property
+    def shellVOff7thKeyboard(self):
+        return self.genShellVOff7thKeyboard()
+
     #########################    Methods ###############################################################
 
     def genShellV(self):
         """ Generate lilypond, mp3, png, and fingerings for both off-3rd and off-7th  shell voicings"""
-        self.shellVOff3rdLilypond = self.genShellVOff3rdLilyPond()
-        self.shellVOff7thLilypond = self.genShellVOff7thLilyPond()
+        self.materialize('ShellV')
 
     def genFullStandardV(self):
         """ Generate lilypond, mp3, png, and fingerings for standard root position voicing of a 4 notes 7th chord"""
-        self.fullStandardVLilyPond = self.genFullStandardVLilyPond()
-        self.fullStandardVPng = self.genFullStandardVPng()
-        self.fullStandardVMp3 = self.genFullStandardVMp3()
-        self.fullStandardVFingering = self.genFullStandardVFingering()
+        self.materialize('FullStandardV')
 
 
     def genFullStandardVNotes(self):
-        notes = [mNote(self.chord[0],3),mNote(self.chord[1], 4),
-                 mNote(self.chord[2],4), mNote(self.chord[3],4)]
-        return notes
+        "Root in octave 3, the other chord tones in octave 4 (see pitch_matrix.VOICING_SHAPES)"
+        return pitch_matrix.pitchMatrix().notes(self.root, self.quality, 'FullStandardV', self.bassDegree)
 
 
     def genShellVOff3rdNotes(self):
         "Choose the right notes and octave for the off-3rd voicing for the given chord"
-        notes = [mNote(self.chord[0],3),mNote(self.chord[1],3)]
-        return notes
+        return pitch_matrix.pitchMatrix().notes(self.root, self.quality, 'ShellVOff3rd')
 
     def genShellVOff7thNotes(self):
-        "Choose the right notes and octave for the off-3rd voicing for the given chord"
-        notes = [mNote(self.chord[0],3),mNote(self.chord[3],3)]
-        return notes
+        "Choose the right notes and octave for the off-7th voicing for the given chord"
+        return pitch_matrix.pitchMatrix().notes(self.root, self.quality, 'ShellVOff7th')
 
     def genFullStandardVLilyPond(self):
-        """Generate the lilypond string for the voicing"""
-        bar = mBar()
-        lilyPondString = self.lilyPondTemplate.substitute(bassClefNotes = "c-1", trebleClefNotes = "e'-1 g'-3 b'-5")
+        """Generate the lilypond string for the voicing, with the fingering of both hands"""
+        hands = self.fingeredHands(self.fullStandardVNotes)
+        lilyPondString = self.lilyPondTemplate.substitute(
+            bassClefNotes=' '.join(self.lilyPondNote(note, finger) for note, finger in hands['LH']),
+            trebleClefNotes=' '.join(self.lilyPondNote(note, finger) for note, finger in hands['RH']))
         return lilyPondString
 
     def genShellVOff3rdLilyPond(self):
         """Generate the lilypond string for the voicing"""
         bar = mBar()
-        bar.place_notes(self.genShellVOff3rdNotes(),1)
+        bar.place_notes(self.shellVOff3rdNotes,1)
         return LilyPond.from_Bar(bar)
 
     def genShellVOff7thLilyPond(self):
         """Generate the lilypond string for the voicing"""
         bar = mBar()
-        bar.place_notes(mNote_container(self.genShellVOff7thNotes()),1)
+        bar.place_notes(mNote_container(self.shellVOff7thNotes),1)
         return LilyPond.from_Bar(bar)
 
     def genFullStandardVPng(self):
         "generate the png file for the voicing"
-        fileOut = self.root+self.quality+'-FullStandardV'+'.png'
-        LilyPond.to_png(self.genFullStandardVLilyPond(), fileOut)
+        fileOut = self.fileStem()+'-FullStandardV'+'.png'
+        fileOut = self.lilyPondToPng(self.fullStandardVLilyPond, fileOut)
         imgTag = '<img src=\"{filename}\"\\>'.format(filename=fileOut)
         return imgTag
 
     def genFullStandardVMp3(self):
         "Use mingus to generate the mp3 file for the voicing from its chord"
-        fileOut = self.root+self.quality+'-FullStandardV'+'.mp3'
+        fileOut = self.fileStem()+'-FullStandardV'+'.mp3'
         bar = mBar()
-        bar.place_notes(mNote_container(self.genFullStandardVNotes()), 1)
+        bar.place_notes(mNote_container(self.fullStandardVNotes), 1)
         sndTag = self.barToMp3(bar, fileOut)
         return sndTag
 
     def genFullStandardVFingering(self):
-        """TODO: use DrawSVG lib for both SVG production and rasterization (d.rasterize())
-        Generate the svg file fo the keyboard with highlighted fingerings for both RH and LH"""
+        """Fingering of the voicing: dictionary with the RH and LH fields (see fingeringFields)"""
+        return self.fingeringFields(self.fullStandardVNotes)
+
+    def genFullStandardVKeyboard(self):
+        """Keyboard diagrams of the voicing with its fingering: dictionary with the LH and RH image fields"""
+        return self.keyboardFields(self.fullStandardVNotes, 'FullStandardV')
+
+    def genShellVOff3rdKeyboard(self):
+        """Keyboard diagrams of the off-3rd shell voicing"""
+        return self.keyboardFields(self.shellVOff3rdNotes, 'ShellVOff3rd')
+
+    def genShellVOff7thKeyboard(self):
+        """Keyboard diagrams of the off-7th shell voicing"""
+        return self.keyboardFields(self.shellVOff7thNotes, 'ShellVOff7th')
+
+    def genShellVOff3rdFingering(self):
+        """Fingering of the off-3rd shell voicing (left hand only)"""
+        return self.fingeringFields(self.shellVOff3rdNotes)
+
+    def genShellVOff7thFingering(self):
+        """Fingering of the off-7th shell voicing (left hand only)"""
+        return self.fingeringFields(self.shellVOff7thNotes)
 
 
     def genGuideTonesV(self):
@@ -302,19 +871,57 @@ class AnkiDeck(object):
     """
     Holds all the components of an Anki Deck to be packaged and saved to disk
     """
-    def __init__(self, chordsDb :GenAnkiChords.chordsDb, mediaDir):
+    modelId = 1149467492
+    deckId = 1393751746
+    deckName = "Comping Chords"
+    fileName = "Comping-Chords.apkg"
+    updateFileName = "Comping-Chords-update.apkg" # delta package with only the new or changed notes
+    compressLevel = 6 # deflate level for the collection database
+    storedSuffixes = ('.png', '.mp3', '.jpg', '.jpeg', '.gif', '.webp', '.ogg') # already compressed media, stored as is
+    properNotationFields = ["Root_it", "Rootless_V_Off_3rd", "Rootless_V_Off_7th",
+                            "GuideTones_V_Off_3rd", "GuideTones_V_Off_7th",
+                            "FourNotesSh_Ext_V_Off_3rd", "FourNotesSh_Ext_V_Off_7th"] # fields holding Italian note names
+    cardTemplates = [ # the card templates of the Chords model (they decide which fields get rendered, see card_fields)
+        {
+            'name': 'NotesRootless3',
+            'qfmt': '<center><font size=8>Notes in </font><hr> <font size=14>Rootless shell voicing, <br> <bold>off 3rd</bold> for: </font><hr> <font size=16>{{Name}}',
+            'afmt': '{{FrontSide}}<hr id="answer">{{Rootless_V_Off_3rd}} <hr><center>{{Rootless_V_Off_3rd-lilypond}}</center>',
+        },
+        {
+            'name': 'NotesRootless7',
+            'qfmt': '<center><font size=8>Notes in </font><hr> <font size=14>Rootless shell voicing, <br> <bold>off 7th</bold> for: </font><hr><font size=16>{{Name}}',
+            'afmt': '{{FrontSide}}<hr id="answer">{{Rootless_V_Off_7th}}<hr><center>{{Rootless_V_Off_7th-lilypond}}</center>',
+        },
+        {
+            'name': 'NotesGuideTones3',
+            'qfmt': '<center><font size=8>Notes in </font><hr> <font size=14>Lead tones 3-note voicing, <br> <bold>off 3rd</bold> for: </font><hr><font size=16>{{Name}}',
+            'afmt': '{{FrontSide}}<hr id="answer">{{GuideTones_V_Off_3rd}}<hr><center>{{GuideTones_V_Off_3rd-lilypond}}</center>',
+        },
+        {
+            'name': 'NotesGuideTones7',
+            'qfmt': '<center><font size=8>Notes in </font><hr> <font size=14>Lead tones 3-note voicing, <br> <bold>off 7th</bold> for: </font><hr><font size=16>{{Name}}',
+            'afmt': '{{FrontSide}}<hr id="answer">{{GuideTones_V_Off_7th}}<hr><center>{{GuideTones_V_Off_7th-lilypond}}</center>',
+        },
+    ]
+
+    def __init__(self, chordsDb :dict, mediaDir, tracer=None, buildGraph=None):
         """
         Instantiates the main instance variable to a chords database and creates an Anki deck
         :param chordsDb:
+        :param tracer: optional build_trace.BuildTracer timing the packaging
+        :param buildGraph: optional BuildGraph, skipping the packages whose notes and media did not change
         """
         self.chordsDb = chordsDb
         self.mediaDir = mediaDir
+        self.tracer = tracer if tracer is not None else NULL_TRACER
+        self.buildGraph = buildGraph
+        self.chordRecords = []  # the chords as rows field -> value (as in ChordsData.csv), the source of the notes
+        self.ankiNotes = []
     def genDeckFromChordsDb(self):
         self.filename = self.genFilename()
         self.fields = self.getFieldsFromChordsDb()
         self.createChordModel()
-        self.engl2ItNotes, self.it2EnglNotes = self.createEnglItTransDicts()
-        self.useProperMusicNotation()
+        self.useProperMusicNotation(self.chordRecords)
         self.ankiDeck = self.createAnkiDeck()
         self.addCardsToDeck()
 
@@ -338,8 +945,140 @@ class AnkiDeck(object):
         Packages the ankiDeck  as .apkg file and saves it to disk
         :return:
         """
-        genanki.Package(self.ankiDeck).write_to_file(self.fileName)
-        print(len(self.ankiNotes), "cards generated and saved into deck ", self.fileName)
+        if self.writePackage(self.ankiNotes, self.fileName):
+            print(len(self.ankiNotes), "cards generated and saved into deck ", self.fileName)
+        else:
+            print("Deck ", self.fileName, "is up to date")
+
+    def saveDeltaDeck(self, previousFileName=None, updateFileName=None):
+        """
+        Packages only the notes that are new or changed since a previously written deck
+        (compared by GUID and a checksum of all their fields), together with the media files
+        they reference that are new or changed (compared by the CRC stored in the old package)
+        :param previousFileName: the .apkg written by the previous build, default self.fileName
+        :param updateFileName: where to write the update package, default self.updateFileName
+        :return: the list of notes written
+        """
+        previousNotes, previousMedia = self.readPreviousDeck(previousFileName or self.fileName)
+        changedNotes = [note for note in self.ankiNotes
+                        if previousNotes.get(note.guid) != self.noteChecksum(note.fields)]
+        changedMedia = [fileName for fileName in self.notesMediaFiles(changedNotes)
+                        if previousMedia.get(os.path.basename(fileName)) != self.fileCrc(fileName)]
+        self.writePackage(changedNotes, updateFileName or self.updateFileName, changedMedia)
+        print(len(changedNotes), "new or changed cards saved into update deck ", updateFileName or self.updateFileName)
+        return changedNotes
+
+    def writePackage(self, notes, fileName, mediaFiles=None):
+        """
+        Write notes (and by default all the media they reference) to an .apkg file.
+        Unlike genanki.Package.write_to_file, only the collection database is deflated:
+        media are streamed from disk into the zip, already compressed formats (png, mp3, ...) without re-deflating.
+        With a buildGraph the package is only written if its fingerprint (see packageFingerprint) changed
+        or the file is missing
+        :return: True if the package was written
+        """
+        if mediaFiles is None:
+            mediaFiles = self.notesMediaFiles(notes)
+        with self.tracer.span('package', fileName) as span:
+            if self.buildGraph is None:
+                self.writePackageFile(notes, fileName, mediaFiles)
+                written = True
+            else:
+                written = self.buildGraph.runStage('package', fileName, self.packageFingerprint(notes, mediaFiles),
+                                                   lambda: self.writePackageFile(notes, fileName, mediaFiles),
+                                                   [fileName])
+                self.buildGraph.save()
+            span.addOutput(fileName)
+        return written
+
+    def packageFingerprint(self, notes, mediaFiles):
+        """
+        Fingerprint of the inputs of a package: the deck, the note types, the fields of every note
+        and the size and modification time of every media file
+        """
+        # names and formats only: genanki numbers the fields and templates of a model in place when writing it
+        models = {note.model.model_id: (note.model.name, [field['name'] for field in note.model.fields],
+                                        [(template['name'], template['qfmt'], template['afmt'])
+                                         for template in note.model.templates], note.model.css) for note in notes}
+        return renderKey(self.deckId, self.deckName, sorted(models.items()),
+                         [(note.guid, self.noteChecksum(note.fields)) for note in notes],
+                         [(os.path.basename(mediaFile), os.stat(mediaFile).st_size, os.stat(mediaFile).st_mtime_ns)
+                          for mediaFile in mediaFiles])
+
+    def writePackageFile(self, notes, fileName, mediaFiles=None):
+        """Body of writePackage"""
+        deck = self.createAnkiDeck()
+        for note in notes:
+            deck.add_note(note)
+        if mediaFiles is None:
+            mediaFiles = self.notesMediaFiles(notes)
+        fd, dbFileName = tempfile.mkstemp(suffix='.anki2')
+        os.close(fd)
+        try:
+            connection = sqlite3.connect(dbFileName)
+            try:
+                timestamp = time.time()
+                genanki.Package(deck).write_to_db(connection.cursor(), timestamp, itertools.count(int(timestamp * 1000)))
+                connection.commit()
+            finally:
+                connection.close()
+            with zipfile.ZipFile(fileName, 'w', zipfile.ZIP_DEFLATED, compresslevel=self.compressLevel) as apkg:
+                apkg.write(dbFileName, 'collection.anki2')
+                apkg.writestr('media', json.dumps({str(i): os.path.basename(mediaFile)
+                                                   for i, mediaFile in enumerate(mediaFiles)}))
+                for i, mediaFile in enumerate(mediaFiles):
+                    if mediaFile.lower().endswith(self.storedSuffixes):
+                        apkg.write(mediaFile, str(i), compress_type=zipfile.ZIP_STORED)
+                    else:
+                        apkg.write(mediaFile, str(i))
+        finally:
+            os.remove(dbFileName)
+
+    def readPreviousDeck(self, fileName):
+        """
+        Read back the notes and media of an .apkg file
+        :return: (dictionary guid -> fields checksum, dictionary media name -> CRC), both empty if there is no such file
+        """
+        if not os.path.exists(fileName):
+            return {}, {}
+        with zipfile.ZipFile(fileName) as apkg:
+            mediaNames = json.loads(apkg.read('media').decode('utf-8'))
+            media = {mediaNames[info.filename]: info.CRC for info in apkg.infolist() if info.filename in mediaNames}
+            fd, dbFileName = tempfile.mkstemp(suffix='.anki2')
+            with os.fdopen(fd, 'wb') as dbFile:
+                dbFile.write(apkg.read('collection.anki2'))
+        try:
+            connection = sqlite3.connect(dbFileName)
+            try:
+                rows = connection.execute('select guid, flds from notes').fetchall()
+            finally:
+                connection.close()
+        finally:
+            os.remove(dbFileName)
+        return {guid: self.noteChecksum(flds.split('\x1f')) for guid, flds in rows}, media
+
+    @staticmethod
+    def noteChecksum(fields):
+        """Checksum of all the fields of a note (Anki's own csum only covers the sort field)"""
+        return hashlib.sha1('\x1f'.join(fields).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def fileCrc(fileName):
+        """CRC32 of a file, as stored for it in a zip archive"""
+        crc = 0
+        with open(fileName, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                crc = zlib.crc32(block, crc)
+        return crc
+
+    def notesMediaFiles(self, notes):
+        """Media files referenced by the img/snd tags and [sound:] links in the fields of notes"""
+        fileNames = set()
+        for note in notes:
+            for field in note.fields:
+                fileNames.update(re.findall(r'src="([^"]+)"', field))
+                fileNames.update(re.findall(r'\[sound:([^\]]+)\]', field))
+        return sorted(fileName for fileName in fileNames if os.path.exists(fileName))
 
     def moveMediaToMediaDir(self):
         """
@@ -359,74 +1098,16 @@ class AnkiDeck(object):
         """ Generate the model, i.e.,  the note type and the card templates
         """
 
-        chordModel = genanki.Model(self.modelId,'Chords',fields=self.fields,
-            templates=[
-                {
-                    'name': 'NotesRootless3',
-                    'qfmt': '<center><font size=8>Notes in </font><hr> <font size=14>Rootless shell voicing, <br> <bold>off 3rd</bold> for: </font><hr> <font size=16>{{Name}}',
-                    'afmt': '{{FrontSide}}<hr id="answer">{{Rootless_V_Off_3rd}} <hr><center>{{Rootless_V_Off_3rd-lilypond}}</center>',
-                },
-                {
-                    'name': 'NotesRootless7',
-                    'qfmt': '<center><font size=8>Notes in </font><hr> <font size=14>Rootless shell voicing, <br> <bold>off 7th</bold> for: </font><hr><font size=16>{{Name}}',
-                    'afmt': '{{FrontSide}}<hr id="answer">{{Rootless_V_Off_7th}}<hr><center>{{Rootless_V_Off_7th-lilypond}}</center>',
-                },
-                {
-                    'name': 'NotesGuideTones3',
-                    'qfmt': '<center><font size=8>Notes in </font><hr> <font size=14>Lead tones 3-note voicing, <br> <bold>off 3rd</bold> for: </font><hr><font size=16>{{Name}}',
-                    'afmt': '{{FrontSide}}<hr id="answer">{{GuideTones_V_Off_3rd}}<hr><center>{{GuideTones_V_Off_3rd-lilypond}}</center>',
-                },
-                {
-                    'name': 'NotesGuideTones7',
-                    'qfmt': '<center><font size=8>Notes in </font><hr> <font size=14>Lead tones 3-note voicing, <br> <bold>off 7th</bold> for: </font><hr><font size=16>{{Name}}',
-                    'afmt': '{{FrontSide}}<hr id="answer">{{GuideTones_V_Off_7th}}<hr><center>{{GuideTones_V_Off_7th-lilypond}}</center>',
-                },
-
-            ])
+        chordModel = genanki.Model(self.modelId,'Chords',fields=self.fields, templates=self.cardTemplates)
         return chordModel
 
-    def createEnglItTransDicts(self):
-        """
-        Instantiate two dictionaries for English to Italian and Italian to English translations
-        of note names, using proper unicode symbols for sharps and flats
-        """
-
-        engl2ItNotes = dict(A="La", Af="Lab", As="Lad", B="Si", Bf="Sib", Bs="Sid", C="Do", Cf="Dob", Cs="Dod", D="Re",
-                            Df="Reb",
-                            Ds="Red", E="Mi", Ef="Mib", Es="Mid", F="Fa", Fs="Fad", Ff="Fab", G="Sol", Gs="Sold",
-                            Gb="Solb")
-        it2EnglNotes = {y: x for x, y in engl2ItNotes.items()}
-
-        for key, note in engl2ItNotes.items():
-            oldNote = note
-            note = re.sub(r"b$", "\u266D", note)
-            note = re.sub(r"d$", "\u266F", note)
-            engl2ItNotes[key] = [oldNote, note]
-
-        for key, note in it2EnglNotes.items():
-            oldNote = note
-            note = re.sub(r"f$", "\u266D", note)
-            note = re.sub(r"s$", "\u266F", note)
-            it2EnglNotes[key] = [oldNote, note]
-        return engl2ItNotes, it2EnglNotes
-
-    def useProperMusicNotation(self):
-        """
-        TODO: fix function to work as a method of class AnkiDeck
-        Replace accidental abbreviations with proper musical notation in root and voicing fields.
-        """
-
-        fields = ["Root_it", "Rootless_V_Off_3rd", "Rootless_V_Off_7th",
-                  "GuideTones_V_Off_3rd", "GuideTones_V_Off_7th",
-                  "FourNotesSh_Ext_V_Off_3rd", "FourNotesSh_Ext_V_Off_7th"]
-        newChordRecord = chordRecord
-        properNotationDict = dict(createEnglItTransDicts()[0].values())
-        for field in fields:
-            newField = []
-            if len(newChordRecord[field]) > 0:
-                for note in newChordRecord[field].split():
-                    print(field, ' --> ', note)
-                    newField.append(properNotationDict[note])
-                newChordRecord[field] = ' '.join(newField)
-        return newChordRecord
+    def useProperMusicNotation(self, records, fields=None):
+        """
+        Replace accidental abbreviations with proper musical notation (Dod -> Do♯) in root and voicing fields,
+        for all the records at once
+        :param records: list of dictionaries field -> value, e.g. the rows of ChordsData.csv
+        :param fields: the fields to translate, default properNotationFields
+        :return: records
+        """
+        return translateColumns(records, fields or self.properNotationFields, 'italian', True, 'italian')
 
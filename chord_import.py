@@ -0,0 +1,210 @@
+######################################################################################
+# -*- coding: utf-8 -*-
+# Streaming import of chord tables (ChordsData.csv, ChordData.ods, user voicing libraries)
+# Copyright (c) 2024 Stefano Franchi <stefano.franchi@gmail.com>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/licenses/gpl.html
+######################################################################################
+
+import csv
+import re
+import sys
+import zipfile
+import xml.etree.ElementTree as ElementTree
+from card_fields import VOICING_FIELD
+from chord_spelling import chordNotes
+
+TABLE_NS = '{urn:oasis:names:tc:opendocument:xmlns:table:1.0}'
+ODS_ROW = TABLE_NS + 'table-row'
+ODS_CELLS = (TABLE_NS + 'table-cell', TABLE_NS + 'covered-table-cell')
+
+ENGLISH_NOTE = re.compile(r'^[A-G](#{1,2}|b{1,2})?$')
+NOTE_NAME = re.compile(r'^([A-G]|Do|Re|Mi|Fa|Sol|La|Si)(#{1,2}|b{1,2}|d{1,2}|x|♯|♭)?$')
+
+# figured-bass inversions of a seventh chord, spaces and slashes removed ('6 /4' -> '64') -> chord degree in the bass.
+# ChordsData.csv writes the first two inversions as 6 and 6/4, the full figures are accepted too
+FIGURED_BASS = {'': 0, '7': 0, '6': 1, '65': 1, '64': 2, '43': 2, '42': 3, '2': 3}
+
+
+class RowError(ValueError):
+    """A malformed row of a chord table"""
+
+    def __init__(self, line, field, message):
+        ValueError.__init__(self, 'line {}, {}: {}'.format(line, field, message))
+        self.line = line
+        self.field = field
+        self.message = message
+
+
+class ChordImporter(object):
+    """
+    Reads a chord table row by row (csv, or ods without any office library) and validates
+    every row against the field schema: Root and Quality are required, SortId is a number,
+    the Inversion is figured bass or a chord tone (it is imported as the bass note) and
+    the voicing note fields are lists of note names. Roots, qualities and inversions are
+    interned, so a library of many rows shares a single copy of each.
+    Only the current row is ever held in memory; malformed rows are skipped and reported
+    with their line number (or, when strict, stop the import).
+    """
+
+    # spreadsheet quality names -> chord_spelling/mingus qualities
+    qualityNames = {'M7': 'M7', 'maj7': 'M7', 'min 7': 'm7', 'm7': 'm7', '7': 'dom7', 'dom7': 'dom7',
+                    'half dim': 'm7b5', 'm7b5': 'm7b5', 'dim': 'dim7', 'dim7': 'dim7'}
+    requiredFields = ['Root', 'Quality']
+
+    def __init__(self, strict=False, maxErrors=100):
+        """
+        :param strict: raise the first RowError instead of skipping the row
+        :param maxErrors: number of errors kept in self.errors (all of them are counted in self.errorCount)
+        """
+        self.strict = strict
+        self.maxErrors = maxErrors
+        self.errors = []
+        self.errorCount = 0
+        self.rowCount = 0
+        self.columns = ()
+        self.noteColumns = []
+
+    def reportError(self, error):
+        if self.strict:
+            raise error
+        self.errorCount += 1
+        if len(self.errors) < self.maxErrors:
+            self.errors.append(error)
+
+    def rows(self, fileName, sheet=None):
+        """
+        Rows of a .csv (;-separated) or .ods file as (line number, dictionary field -> text)
+        :param sheet: name of the ods sheet to read, default the first one
+        """
+        if fileName.lower().endswith('.ods'):
+            records = self.odsRecords(fileName, sheet)
+        else:
+            records = self.csvRecords(fileName)
+        header = None
+        for line, cells in records:
+            if header is None:
+                header = [sys.intern(name.strip()) for name in cells]
+                missing = [name for name in self.requiredFields if name not in header]
+                if missing:
+                    raise RowError(line, ', '.join(missing), 'required column missing from the header')
+                continue
+            if len(cells) > len(header):
+                if any(cell.strip() for cell in cells[len(header):]):
+                    self.reportError(RowError(line, '-', '{} cells beyond the header'.format(len(cells) - len(header))))
+                    continue
+                cells = cells[:len(header)]
+            yield line, dict(zip(header, cells + [''] * (len(header) - len(cells))))
+
+    def csvRecords(self, fileName, delimiter=';'):
+        """Lists of cells of a csv file, with the line each record ends on"""
+        with open(fileName, newline='', encoding='utf-8') as f:
+            reader = csv.reader(f, delimiter=delimiter, quotechar='"')
+            for cells in reader:
+                if any(cell.strip() for cell in cells):
+                    yield reader.line_num, cells
+
+    def odsRecords(self, fileName, sheet=None):
+        """
+        Lists of cells of one sheet of an ods file, with the row number.
+        The xml is parsed incrementally and each row is dropped once read.
+        """
+        with zipfile.ZipFile(fileName) as ods, ods.open('content.xml') as content:
+            parents = []
+            inSheet = None
+            rowNumber = 0
+            for event, element in ElementTree.iterparse(content, events=('start', 'end')):
+                if event == 'start':
+                    if element.tag == TABLE_NS + 'table' and inSheet is None:
+                        inSheet = sheet is None or element.get(TABLE_NS + 'name') == sheet
+                        rowNumber = 0
+                    parents.append(element)
+                    continue
+                parents.pop()
+                if element.tag == TABLE_NS + 'table':
+                    if inSheet:
+                        return
+                    inSheet = None
+                elif element.tag == ODS_ROW and inSheet:
+                    cells = self.odsCells(element)
+                    repeat = int(element.get(TABLE_NS + 'number-rows-repeated', '1'))
+                    for i in range(repeat if cells else 0):
+                        yield rowNumber + i + 1, cells
+                    rowNumber += repeat
+                    parents[-1].remove(element)
+
+    def odsCells(self, row):
+        """Texts of the cells of an ods row (trailing empty cells dropped, repeated ones expanded)"""
+        cells = []
+        emptyRun = 0
+        for cell in row:
+            if cell.tag not in ODS_CELLS:
+                continue
+            text = '\n'.join(''.join(paragraph.itertext()) for paragraph in cell)
+            repeat = int(cell.get(TABLE_NS + 'number-columns-repeated', '1'))
+            if text:
+                cells.extend([''] * emptyRun + [text] * repeat)
+                emptyRun = 0
+            else:
+                emptyRun += repeat
+        return cells
+
+    def noteFields(self, row):
+        """The voicing note fields (e.g. Rootless_V_Off_3rd) among the columns of row, worked out once per header"""
+        columns = tuple(row)
+        if columns != self.columns:
+            self.columns = columns
+            self.noteColumns = [field for field in columns
+                                if VOICING_FIELD.match(field) and VOICING_FIELD.match(field).group(3) == '']
+        return self.noteColumns
+
+    def validate(self, line, row):
+        """
+        Check a row against the schema
+        :return: (root, quality, inversion), interned
+        """
+        root = ''.join(row['Root'].split())  # 'F #' -> 'F#'
+        if not ENGLISH_NOTE.match(root):
+            raise RowError(line, 'Root', 'not a note name: {!r}'.format(root))
+        quality = row['Quality'].strip()
+        if quality not in self.qualityNames:
+            raise RowError(line, 'Quality', 'unknown quality: {!r}'.format(quality))
+        sortId = row.get('SortId', '').strip()
+        if sortId and not sortId.isdigit():
+            raise RowError(line, 'SortId', 'not a number: {!r}'.format(sortId))
+        for field in self.noteFields(row):
+            for note in row[field].split():
+                if not NOTE_NAME.match(note):
+                    raise RowError(line, field, 'not a note name: {!r}'.format(note))
+        quality = self.qualityNames[quality]
+        return sys.intern(root), sys.intern(quality), sys.intern(self.bassNote(line, root, quality, row))
+
+    def bassNote(self, line, root, quality, row):
+        """
+        The bass note of the Inversion of a row, written as figured bass ('6', '6 /4', '4 / 2') or as a chord tone
+        :return: the note name, '' in root position
+        """
+        inversion = row.get('Inversion', '').strip()
+        notes = chordNotes(root, quality)
+        figures = ''.join(inversion.replace('/', ' ').split())
+        if figures in FIGURED_BASS and FIGURED_BASS[figures] < len(notes):
+            degree = FIGURED_BASS[figures]
+        elif inversion in notes:
+            degree = notes.index(inversion)
+        else:
+            raise RowError(line, 'Inversion', 'neither figured bass nor a note of {}{}: {!r}'.format(root, quality,
+                                                                                                  inversion))
+        return notes[degree] if degree else ''
+
+    def chords(self, fileName, sheet=None):
+        """
+        The valid chords of a table, one at a time
+        :return: generator of (line number, root, quality, inversion, row)
+        """
+        for line, row in self.rows(fileName, sheet):
+            self.rowCount += 1
+            try:
+                root, quality, inversion = self.validate(line, row)
+            except RowError as error:
+                self.reportError(error)
+                continue
+            yield line, root, quality, inversion, row
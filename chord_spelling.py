@@ -0,0 +1,148 @@
+######################################################################################
+# -*- coding: utf-8 -*-
+# Precomputed chord spellings: roots x qualities looked up instead of parsed by mingus
+# Copyright (c) 2024 Stefano Franchi <stefano.franchi@gmail.com>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/licenses/gpl.html
+######################################################################################
+
+from dataclasses import dataclass
+from mingus.core import chords as mChords
+from mingus.core import notes as mNotes
+
+LETTERS = 'CDEFGAB'
+NATURALS = dict(C=0, D=2, E=4, F=5, G=7, A=9, B=11)
+SHARP_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+FLAT_NAMES = ['C', 'Db', 'D', 'Eb', 'E', 'F', 'Gb', 'G', 'Ab', 'A', 'Bb', 'B']
+
+# every root we spell: the seven letters, each natural, sharp and flat
+ROOTS = [letter + accidental for letter in LETTERS for accidental in ['', '#', 'b']]
+
+# chord degrees of each supported quality as (letter steps, semitones) above the root
+QUALITIES = {
+    'M7': [(0, 0), (2, 4), (4, 7), (6, 11)],
+    'm7': [(0, 0), (2, 3), (4, 7), (6, 10)],
+    'dom7': [(0, 0), (2, 4), (4, 7), (6, 10)],
+    'm7b5': [(0, 0), (2, 3), (4, 6), (6, 10)],
+}
+
+# the extended vocabulary (see chord_vocabulary), in the same format: root, 3rd (or 4th), 5th, 7th (or 6th)
+# always come first, then the extensions as compound intervals. Unlike mingus' shorthands, the 11th and
+# 13th chords keep all their chord tones (mingus' 11 has no 3rd, its m13 no 11th)
+EXTENDED_QUALITIES = {
+    '6': [(0, 0), (2, 4), (4, 7), (5, 9)],
+    'm6': [(0, 0), (2, 3), (4, 7), (5, 9)],
+    'mM7': [(0, 0), (2, 3), (4, 7), (6, 11)],
+    'dim7': [(0, 0), (2, 3), (4, 6), (6, 9)],
+    '7sus4': [(0, 0), (3, 5), (4, 7), (6, 10)],
+    '7b5': [(0, 0), (2, 4), (4, 6), (6, 10)],
+    '7#5': [(0, 0), (2, 4), (4, 8), (6, 10)],
+    'M7#5': [(0, 0), (2, 4), (4, 8), (6, 11)],
+    '69': [(0, 0), (2, 4), (4, 7), (5, 9), (8, 14)],
+    'M9': [(0, 0), (2, 4), (4, 7), (6, 11), (8, 14)],
+    '9': [(0, 0), (2, 4), (4, 7), (6, 10), (8, 14)],
+    'm9': [(0, 0), (2, 3), (4, 7), (6, 10), (8, 14)],
+    '9sus4': [(0, 0), (3, 5), (4, 7), (6, 10), (8, 14)],
+    '7b9': [(0, 0), (2, 4), (4, 7), (6, 10), (8, 13)],
+    '7#9': [(0, 0), (2, 4), (4, 7), (6, 10), (8, 15)],
+    '7#11': [(0, 0), (2, 4), (4, 7), (6, 10), (10, 18)],
+    'M7#11': [(0, 0), (2, 4), (4, 7), (6, 11), (10, 18)],
+    '7b13': [(0, 0), (2, 4), (4, 7), (6, 10), (12, 20)],
+    '11': [(0, 0), (2, 4), (4, 7), (6, 10), (8, 14), (10, 17)],
+    'm11': [(0, 0), (2, 3), (4, 7), (6, 10), (8, 14), (10, 17)],
+    '13': [(0, 0), (2, 4), (4, 7), (6, 10), (8, 14), (12, 21)],
+    'M13': [(0, 0), (2, 4), (4, 7), (6, 11), (8, 14), (12, 21)],
+    '13sus4': [(0, 0), (3, 5), (4, 7), (6, 10), (8, 14), (12, 21)],
+    '7alt': [(0, 0), (2, 4), (4, 8), (6, 10), (8, 13), (8, 15)],
+    'm13': [(0, 0), (2, 3), (4, 7), (6, 10), (8, 14), (10, 17), (12, 21)],
+}
+
+
+@dataclass(frozen=True)
+class ChordSpelling(object):
+    """
+    One chord of the table: its notes spelled one letter per degree (as mingus does),
+    the same notes with double accidentals and E#/B#/Cb/Fb simplified for display,
+    and their MIDI pitch classes
+    """
+    notes: tuple
+    simpleNotes: tuple
+    pitchClasses: tuple
+
+
+def pitchClass(note):
+    """Pitch class (0-11) of a note name with any number of sharps or flats"""
+    return (NATURALS[note[0]] + note.count('#') - note.count('b')) % 12
+
+
+def spellDegree(root, letterSteps, semitones):
+    """Spell the note letterSteps letters and semitones semitones above root"""
+    letter = LETTERS[(LETTERS.index(root[0]) + letterSteps) % 7]
+    offset = (pitchClass(root) + semitones - NATURALS[letter] + 6) % 12 - 6
+    return letter + ('#' * offset if offset > 0 else 'b' * -offset)
+
+
+def simplify(note):
+    """Enharmonic spelling of note with at most one accidental and no E#/B#/Cb/Fb (C## -> D, Fb -> E)"""
+    names = FLAT_NAMES if 'b' in note[1:] else SHARP_NAMES
+    return names[pitchClass(note)]
+
+
+def spellChord(root, quality):
+    """Build the table entry for root and quality (mingus is only used for unsupported qualities)"""
+    degrees = QUALITIES.get(quality, EXTENDED_QUALITIES.get(quality))
+    if degrees is not None:
+        notes = tuple(spellDegree(root, letterSteps, semitones) for letterSteps, semitones in degrees)
+    else:
+        notes = tuple(mChords.from_shorthand(root + quality))
+    return ChordSpelling(notes, tuple(simplify(note) for note in notes),
+                         tuple(mNotes.note_to_int(note) for note in notes))
+
+
+CHORD_TABLE = {(root, quality): spellChord(root, quality) for root in ROOTS for quality in QUALITIES}
+EXTENDED_TABLE = {}  # the extended chords spelled so far, kept apart as they are not spelled as mingus does
+
+
+def chordSpelling(root, quality):
+    """
+    O(1) lookup of the spelling of a chord; chords outside the table are spelled once and added to it
+    :return: ChordSpelling
+    """
+    try:
+        return CHORD_TABLE[(root, quality)]
+    except KeyError:
+        table = EXTENDED_TABLE if quality in EXTENDED_QUALITIES else CHORD_TABLE
+        if (root, quality) not in table:
+            table[(root, quality)] = spellChord(root, quality)
+        return table[(root, quality)]
+
+
+def chordNotes(root, quality):
+    """Drop-in replacement of mingus' chords.from_shorthand(root+quality): a new list of note names"""
+    return list(chordSpelling(root, quality).notes)
+
+
+def bassDegree(root, quality, bass):
+    """
+    Chord degree in the bass of an inversion
+    :param bass: the bass note, spelled as in the chord ('' in root position)
+    :return: the index of bass in the chord notes
+    """
+    notes = chordSpelling(root, quality).notes
+    if bass and bass not in notes:
+        raise ValueError("{} is not a note of {}{} ({}), it cannot be the bass of an inversion".format(
+            bass, root, quality, ' '.join(notes)))
+    return notes.index(bass) if bass else 0
+
+
+if __name__ == '__main__':
+    # microbenchmark against the mingus path used by Voicing before the table
+    import timeit
+    chords = [(root, quality) for root in ['Gb', 'Db', 'Ab', 'Eb', 'Bb', 'F', 'C', 'G', 'D', 'A', 'E', 'B',
+                                           'F#', 'C#', 'G#', 'D#', 'A#'] for quality in QUALITIES]
+    runs = 200
+    mingusTime = timeit.timeit(lambda: [mChords.from_shorthand(r + q) for r, q in chords], number=runs)
+    tableTime = timeit.timeit(lambda: [chordNotes(r, q) for r, q in chords], number=runs)
+    perChord = runs * len(chords)
+    print('mingus from_shorthand: %.2f us/chord' % (mingusTime / perChord * 1e6))
+    print('chord table lookup:    %.2f us/chord' % (tableTime / perChord * 1e6))
+    print('speed-up: %.0fx' % (mingusTime / tableTime))
@@ -0,0 +1,132 @@
+######################################################################################
+# -*- coding: utf-8 -*-
+# Extended chord vocabulary: lazy enumeration of roots x qualities x inversions, deduplicated by sound
+# Copyright (c) 2024 Stefano Franchi <stefano.franchi@gmail.com>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/licenses/gpl.html
+######################################################################################
+
+from dataclasses import dataclass
+from chord_spelling import ROOTS, QUALITIES, EXTENDED_QUALITIES, chordSpelling
+from pitch_matrix import voicingShape, pitchMatrix
+
+# the pitch_matrix shapes each voicing family renders, and the families that can be inverted
+VOICING_FAMILY_SHAPES = {'FullStandardV': ['FullStandardV'], 'ShellV': ['ShellVOff3rd', 'ShellVOff7th']}
+INVERTIBLE_VOICINGS = ['FullStandardV']
+NATURAL_FIFTHS = dict(F=-1, C=0, G=1, D=2, A=3, E=4, B=5)
+
+
+def fifths(root):
+    """Position of root on the line of fifths (C 0, G 1, F -1, F# 6, Gb -6): the size of its key signature"""
+    return NATURAL_FIFTHS[root[0]] + 7 * (root.count('#') - root.count('b'))
+
+
+def preferredRoots(roots):
+    """roots ordered from the simplest key signature, flats before sharps (Db before C#, B before Cb)"""
+    return sorted(roots, key=lambda root: (abs(fifths(root)), fifths(root) > 0))
+
+
+@dataclass(frozen=True)
+class VocabularyChord(object):
+    """A chord of the vocabulary that sounds like no chord before it, with the voicings that fit its range"""
+    root: str
+    quality: str
+    inversion: str  # the bass note, '' in root position
+    pitchClasses: int  # bit i set if pitch class i is in the chord
+    bass: int  # pitch class of the bass
+    voicings: tuple
+
+    @property
+    def key(self):
+        """chordsDb key, as in GenAnkiChords.importDb"""
+        return self.root + self.quality + ('/' + self.inversion if self.inversion else '')
+
+
+class ChordVocabulary(object):
+    """
+    Enumerates roots x qualities x inversions (every chord tone in the bass), one chord at a time.
+    Each candidate is reduced to its pitch-class set plus bass before anything is rendered: a chord
+    that sounds like one already seen (C#M7 after DbM7, Am7/C after C6, Ebdim7 after Cdim7/Eb) is dropped.
+    A kept chord gets every voicing family that fits the keyboard range, even when another chord plays the
+    same notes (the shell voicing of C9 is the one of C7): its card still needs them, and identical media
+    are rendered once by GenAnkiChords' dedupMedia. The candidates come in order of preference:
+    root positions first, then the qualities in table order, then the roots with the simplest key signature.
+    """
+
+    def __init__(self, roots=ROOTS, qualities=None, voicings=('FullStandardV', 'ShellV'), inversions=True,
+                 lowest=36, highest=84, maxSpan=24):
+        """
+        :param qualities: names from chord_spelling.QUALITIES and EXTENDED_QUALITIES, default all of them
+        :param voicings: the voicing families to render (the ones chord_vocabulary does not know are ignored)
+        :param inversions: also enumerate the inversions
+        :param lowest: lowest MIDI pitch a voicing may use
+        :param highest: highest MIDI pitch a voicing may use
+        :param maxSpan: widest interval a voicing may span, in semitones
+        """
+        self.roots = preferredRoots(roots)
+        self.qualities = list(qualities) if qualities is not None else list(QUALITIES) + list(EXTENDED_QUALITIES)
+        self.voicings = [voicing for voicing in voicings if voicing in VOICING_FAMILY_SHAPES]
+        self.inversions = inversions
+        self.lowest = lowest
+        self.highest = highest
+        self.maxSpan = maxSpan
+        self.counts = dict(candidates=0, duplicates=0, outOfRange=0, unvoiced=0, unique=0)
+
+    def candidates(self):
+        """
+        Every (root, quality, bass degree), lazily, in order of preference
+        :return: generator of (root, quality, bass degree, ChordSpelling)
+        """
+        spellings = {quality: [chordSpelling(root, quality) for root in self.roots] for quality in self.qualities}
+        maxDegrees = max(len(spelling[0].notes) for spelling in spellings.values())
+        for bassDegree in range(maxDegrees if self.inversions else 1):
+            for quality in self.qualities:
+                for root, spelling in zip(self.roots, spellings[quality]):
+                    if bassDegree < len(spelling.notes):
+                        yield root, quality, bassDegree, spelling
+
+    def voicingSound(self, voicing, root, quality, bassDegree):
+        """
+        What a voicing family plays for a chord: the pitch-class set and bass of each of its shapes
+        (their pitches are the rows of the pitch matrix)
+        :return: tuple of (pitch-class bits, bass pitch class), or None if a shape is out of range
+        """
+        sound = []
+        for shape in VOICING_FAMILY_SHAPES[voicing]:
+            pitches = pitchMatrix().voicingPitches(root, quality, shape, bassDegree)
+            if min(pitches) < self.lowest or max(pitches) > self.highest or max(pitches) - min(pitches) > self.maxSpan:
+                return None
+            sound.append((sum(1 << pitchClass for pitchClass in set(pitch % 12 for pitch in pitches)), pitches[0] % 12))
+        return tuple(sound)
+
+    def chords(self):
+        """
+        The unique chords of the vocabulary, lazily; self.counts tells how many candidates were dropped and why
+        :return: generator of VocabularyChord
+        """
+        seenChords = set()
+        for root, quality, bassDegree, spelling in self.candidates():
+            self.counts['candidates'] += 1
+            pitchClasses = sum(1 << pitchClass for pitchClass in set(spelling.pitchClasses))
+            bass = spelling.pitchClasses[bassDegree]
+            if (pitchClasses, bass) in seenChords:
+                self.counts['duplicates'] += 1
+                continue
+            seenChords.add((pitchClasses, bass))
+            voicings = []
+            outOfRange = False
+            for voicing in self.voicings:
+                if bassDegree and voicing not in INVERTIBLE_VOICINGS:
+                    continue
+                if max(degree for shape in VOICING_FAMILY_SHAPES[voicing]
+                       for degree, octave in voicingShape(shape, len(spelling.notes))) >= len(spelling.notes):
+                    continue
+                if self.voicingSound(voicing, root, quality, bassDegree) is None:
+                    outOfRange = True
+                else:
+                    voicings.append(voicing)
+            if not voicings:
+                self.counts['outOfRange' if outOfRange else 'unvoiced'] += 1
+                continue
+            self.counts['unique'] += 1
+            yield VocabularyChord(root, quality, spelling.notes[bassDegree] if bassDegree else '', pitchClasses, bass,
+                                  tuple(voicings))
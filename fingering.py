@@ -0,0 +1,97 @@
+######################################################################################
+# -*- coding: utf-8 -*-
+# Piano fingering of voicings from a hand-span cost model, memoized per interval shape
+# Copyright (c) 2024 Stefano Franchi <stefano.franchi@gmail.com>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/licenses/gpl.html
+######################################################################################
+
+import itertools
+from functools import lru_cache
+
+BLACK_KEYS = {1, 3, 6, 8, 10}
+
+# Comfortable and playable distances in semitones between two fingers of the right hand
+# (Parncutt et al., 1997): MinPrac, MinComf, MinRel, MaxRel, MaxComf, MaxPrac. The left hand mirrors them
+FINGER_SPANS = {
+    (1, 2): (-5, -3, 1, 5, 8, 10), (1, 3): (-4, -2, 3, 7, 10, 12), (1, 4): (-3, -1, 5, 9, 12, 14),
+    (1, 5): (-1, 1, 7, 10, 13, 15), (2, 3): (1, 1, 1, 2, 3, 5), (2, 4): (1, 1, 3, 4, 5, 7),
+    (2, 5): (2, 2, 5, 6, 8, 10), (3, 4): (1, 1, 1, 2, 2, 4), (3, 5): (1, 1, 3, 4, 5, 7),
+    (4, 5): (1, 1, 1, 2, 3, 5),
+}
+# cost of playing a single note with each finger: the thumb, then the outer fingers
+SINGLE_NOTE = {1: 0, 2: 1, 3: 1, 4: 1, 5: 1}
+BLACK_THUMB = 1  # extra cost of the thumb on a black key
+WEAK_FINGER = 1  # extra cost of using the fourth finger
+
+
+def isBlack(pitch):
+    return pitch % 12 in BLACK_KEYS
+
+
+def spanCost(fingers, distance):
+    """
+    Cost of two fingers (thumb side first) holding notes distance semitones apart, None if unplayable:
+    2 per semitone outside the comfortable span, plus 1 per semitone outside the relaxed one
+    (doubled when it is too small for the thumb or too large for two fingers)
+    """
+    minPrac, minComf, minRel, maxRel, maxComf, maxPrac = FINGER_SPANS[fingers]
+    if distance < minPrac or distance > maxPrac:
+        return None
+    thumb = fingers[0] == 1
+    cost = 2 * max(0, minComf - distance, distance - maxComf)
+    cost += max(0, minRel - distance) * (2 if thumb else 1)
+    cost += max(0, distance - maxRel) * (1 if thumb else 2)
+    return cost
+
+
+@lru_cache(maxsize=None)
+def shapeFingering(hand, intervals, blackPattern):
+    """
+    The cheapest fingering of a chord shape, solved once per shape
+    :param hand: 'RH' or 'LH'
+    :param intervals: semitones of each note above the lowest one
+    :param blackPattern: True for each note on a black key
+    :return: finger of each note, from the lowest up (None if the shape cannot be played by one hand)
+    """
+    best, bestCost = None, None
+    for fingers in itertools.combinations(range(1, 6), len(intervals)):
+        # the right hand plays upwards from the thumb, the left hand downwards
+        fingers = fingers if hand == 'RH' else tuple(reversed(fingers))
+        cost = 0
+        if len(fingers) == 1:
+            cost = SINGLE_NOTE[fingers[0]]
+        for (i, a), (j, b) in itertools.combinations(enumerate(fingers), 2):
+            if a < b:
+                pair = spanCost((a, b), intervals[j] - intervals[i])
+            else:
+                pair = spanCost((b, a), intervals[j] - intervals[i])
+            if pair is None:
+                break
+            cost += pair
+        else:
+            cost += sum(BLACK_THUMB for finger, black in zip(fingers, blackPattern) if finger == 1 and black)
+            cost += WEAK_FINGER * fingers.count(4)
+            if bestCost is None or cost < bestCost:
+                best, bestCost = fingers, cost
+    return best
+
+
+def handFingering(pitches, hand):
+    """
+    Fingers for MIDI pitches (lowest first) played by one hand
+    :return: tuple of fingers, or None if out of reach
+    """
+    if not pitches:
+        return ()
+    return shapeFingering(hand, tuple(pitch - pitches[0] for pitch in pitches),
+                          tuple(isBlack(pitch) for pitch in pitches))
+
+
+def chordFingering(left, right):
+    """
+    Fingering of a voicing played with both hands
+    :param left: MIDI pitches of the left hand, lowest first
+    :param right: MIDI pitches of the right hand, lowest first
+    :return: dictionary 'LH'/'RH' -> tuple of fingers of the notes of that hand, lowest first
+    """
+    return dict(LH=handFingering(left, 'LH'), RH=handFingering(right, 'RH'))
@@ -0,0 +1,128 @@
+######################################################################################
+# -*- coding: utf-8 -*-
+# Keyboard diagrams: highlighted keys and finger numbers composited on a keyboard rasterized once
+# Copyright (c) 2024 Stefano Franchi <stefano.franchi@gmail.com>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/licenses/gpl.html
+######################################################################################
+
+import struct
+import zlib
+import numpy as np
+
+WHITE_STEPS = [0, 2, 4, 5, 7, 9, 11]  # pitch classes of the white keys
+HAND_COLORS = {'LH': (60, 120, 215), 'RH': (215, 75, 60)}
+GLYPH_COLOR = (255, 255, 255)
+
+# the finger numbers, as 3x5 bitmaps
+DIGITS = {
+    1: ['.#.', '##.', '.#.', '.#.', '###'],
+    2: ['##.', '..#', '.#.', '#..', '###'],
+    3: ['##.', '..#', '.#.', '..#', '##.'],
+    4: ['#.#', '#.#', '###', '..#', '..#'],
+    5: ['###', '#..', '##.', '..#', '##.'],
+}
+
+
+def writePng(fileName, image):
+    """Write an RGB uint8 array (height x width x 3) as an 8-bit truecolor png"""
+    height, width, _ = image.shape
+    rows = np.zeros((height, 1 + 3 * width), dtype=np.uint8)  # each row starts with filter type 0 (none)
+    rows[:, 1:] = image.reshape(height, 3 * width)
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    with open(fileName, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)))
+        f.write(chunk(b'IEND', b''))
+
+
+class KeyboardDiagram(object):
+    """
+    Draws keyboards with the keys of a voicing highlighted and numbered with their fingers.
+    The plain keyboard, the area of every key and the digit glyphs are rasterized once;
+    a diagram is a copy of the keyboard with a few key areas filled and glyphs stamped in,
+    all as numpy array operations, written straight to png
+    """
+
+    def __init__(self, lowest=36, highest=84, whiteWidth=16, whiteHeight=80, blackWidth=10, blackHeight=50,
+                 glyphScale=2):
+        """
+        :param lowest: MIDI pitch of the first key (a white key), default C2
+        :param highest: MIDI pitch of the last key (a white key), default C6
+        """
+        self.lowest = lowest
+        self.highest = highest
+        self.geometry = (lowest, highest, whiteWidth, whiteHeight, blackWidth, blackHeight, glyphScale)
+        self.glyphs = {finger: np.kron(np.array([[c == '#' for c in row] for row in rows]),
+                                       np.ones((glyphScale, glyphScale), dtype=bool))
+                       for finger, rows in DIGITS.items()}
+        whiteKeys = [pitch for pitch in range(lowest, highest + 1) if pitch % 12 in WHITE_STEPS]
+        height, width = whiteHeight, whiteWidth * len(whiteKeys) + 1
+        # key rectangles (top, bottom, left, right), inside a one pixel border
+        rectangles = {}
+        for i, pitch in enumerate(whiteKeys):
+            rectangles[pitch] = (0, whiteHeight - 1, i * whiteWidth + 1, (i + 1) * whiteWidth)
+            if pitch + 1 <= highest and (pitch + 1) % 12 not in WHITE_STEPS:
+                center = (i + 1) * whiteWidth
+                rectangles[pitch + 1] = (0, blackHeight, center - blackWidth // 2, center + blackWidth // 2)
+        area = np.zeros((height, width), dtype=np.int16)  # MIDI pitch of the key shown at each pixel, 0 for borders
+        for pitch in sorted(rectangles, key=lambda pitch: pitch % 12 not in WHITE_STEPS):  # black keys on top
+            top, bottom, left, right = rectangles[pitch]
+            area[top:bottom, left:right] = pitch
+        self.base = np.full((height, width, 3), 40, dtype=np.uint8)
+        self.base[area > 0] = 255
+        for pitch, (top, bottom, left, right) in rectangles.items():
+            if pitch % 12 not in WHITE_STEPS:
+                self.base[top:bottom, left - 1:right + 1] = 40
+                area[top:bottom, left - 1:right + 1] = 0
+                area[top:bottom - 1, left:right] = pitch
+        # flat pixel indices of each key and where its finger glyph goes (bottom of the key, centered)
+        flatArea = area.ravel()
+        order = np.argsort(flatArea, kind='stable')
+        starts = np.searchsorted(flatArea[order], list(rectangles), side='left')
+        ends = np.searchsorted(flatArea[order], list(rectangles), side='right')
+        self.masks = {pitch: order[start:end] for pitch, start, end in zip(rectangles, starts, ends)}
+        glyphHeight, glyphWidth = self.glyphs[1].shape
+        self.glyphAnchors = {pitch: (bottom - glyphHeight - 4, (left + right - glyphWidth) // 2)
+                             for pitch, (top, bottom, left, right) in rectangles.items()}
+
+    def cacheKey(self):
+        """Everything about this keyboard that changes its diagrams, for the media cache"""
+        return ('keyboard',) + self.geometry
+
+    def render(self, pitches, fingers=None, hand='RH'):
+        """
+        :param pitches: MIDI pitches to highlight (the ones outside the keyboard are left out)
+        :param fingers: finger of each pitch, or None for no numbers
+        :return: RGB uint8 array
+        """
+        image = self.base.copy()
+        pixels = image.reshape(-1, 3)
+        fingers = fingers or [None] * len(pitches)
+        for pitch, finger in zip(pitches, fingers):
+            if pitch not in self.masks:
+                continue
+            pixels[self.masks[pitch]] = HAND_COLORS[hand]
+            if finger in self.glyphs:
+                glyph = self.glyphs[finger]
+                top, left = self.glyphAnchors[pitch]
+                image[top:top + glyph.shape[0], left:left + glyph.shape[1]][glyph] = GLYPH_COLOR
+        return image
+
+    def writeDiagram(self, fileName, pitches, fingers=None, hand='RH'):
+        """Render a diagram and write it as png"""
+        writePng(fileName, self.render(pitches, fingers, hand))
+        return fileName
+
+
+_defaultDiagram = None
+
+
+def keyboardDiagram():
+    """The keyboard of the cards, rasterized on first use"""
+    global _defaultDiagram
+    if _defaultDiagram is None:
+        _defaultDiagram = KeyboardDiagram()
+    return _defaultDiagram
@@ -0,0 +1,112 @@
+######################################################################################
+# -*- coding: utf-8 -*-
+# Batched LilyPond compilation: engrave many chords with a single lilypond process
+# Copyright (c) 2024 Stefano Franchi <stefano.franchi@gmail.com>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/licenses/gpl.html
+######################################################################################
+
+import glob
+import os
+import shutil
+import subprocess
+import tempfile
+
+
+class LilyPondBatch(object):
+    """
+    Collects the lilypond snippets of a build and engraves them with as few
+    lilypond invocations as possible (lilypond accepts several input files per call),
+    so that the Guile/font startup cost is paid once per batch instead of once per chord.
+    Each png is then moved to the file name the voicing asked for.
+    """
+
+    # the command line of every png of a build, batched, queued (see async_jobs) or engraved one by one,
+    # so that all the paths give the same image; it is part of the png cache key
+    lilyPondCmd = ['lilypond', '-fpng', '-dresolution=150']
+
+    def __init__(self, maxFilesPerCall=200):
+        self.maxFilesPerCall = maxFilesPerCall
+        self.pending = []  # list of (lilyPondString, pngFileOut, onDone)
+
+    def add(self, lilyPondString, pngFileOut, onDone=None):
+        """
+        Queue a snippet to be engraved into pngFileOut at the next flush
+        :param onDone: optional callable(pngFileOut, success) called after the flush
+        """
+        self.pending.append((lilyPondString, pngFileOut, onDone))
+
+    def commands(self, scratchDir):
+        """
+        Split the pending jobs into lilypond command lines, one per chunk of maxFilesPerCall
+        :return: list of (command, [(lyFile, lilyPondString, pngFileOut, onDone), ...])
+        """
+        chunks = []
+        for start in range(0, len(self.pending), self.maxFilesPerCall):
+            jobs = []
+            for i, (lilyPondString, pngFileOut, onDone) in enumerate(self.pending[start:start + self.maxFilesPerCall]):
+                lyFile = os.path.join(scratchDir, 'chord%05d.ly' % (start + i))
+                jobs.append((lyFile, lilyPondString, pngFileOut, onDone))
+            command = self.lilyPondCmd + ['-o', scratchDir] + [job[0] for job in jobs]
+            chunks.append((command, jobs))
+        return chunks
+
+    def flush(self):
+        """
+        Engrave all the pending snippets and move the pngs to their destinations
+        :return: dictionary pngFileOut -> True if the png was produced
+        """
+        results = {}
+        if not self.pending:
+            return results
+        scratchDir = tempfile.mkdtemp(prefix='lilypond-batch-')
+        try:
+            for command, jobs in self.commands(scratchDir):
+                for lyFile, lilyPondString, pngFileOut, onDone in jobs:
+                    with open(lyFile, 'w') as f:
+                        f.write(lilyPondString)
+                try:
+                    subprocess.run(command, cwd=scratchDir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                except OSError:
+                    print('lilypond could not be run: ', ' '.join(command[:1]))
+                for lyFile, lilyPondString, pngFileOut, onDone in jobs:
+                    results[pngFileOut] = self.collectPng(lyFile, pngFileOut)
+                    if onDone is not None:
+                        onDone(pngFileOut, results[pngFileOut])
+        finally:
+            shutil.rmtree(scratchDir, ignore_errors=True)
+            self.pending = []
+        return results
+
+    @classmethod
+    def engrave(cls, lilyPondString, pngFileOut, scratchDir=None):
+        """
+        Engrave a single snippet right away, with the same command line as the batches
+        :param scratchDir: directory for the temporary .ly file and lilypond output, default the system one
+        :return: True if the png was produced
+        """
+        lyDir = os.path.abspath(tempfile.mkdtemp(prefix='lilypond-', dir=scratchDir))
+        try:
+            lyFile = os.path.join(lyDir, 'chord.ly')
+            with open(lyFile, 'w') as f:
+                f.write(lilyPondString)
+            command = cls.lilyPondCmd + ['-o', os.path.join(lyDir, 'chord'), lyFile]
+            try:
+                subprocess.run(command, cwd=lyDir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            except OSError:
+                print('lilypond could not be run: ', ' '.join(command[:1]))
+                return False
+            return cls.collectPng(lyFile, pngFileOut)
+        finally:
+            shutil.rmtree(lyDir, ignore_errors=True)
+
+    @staticmethod
+    def collectPng(lyFile, pngFileOut):
+        """Move the png engraved from lyFile to pngFileOut (first page only for multi-page output)"""
+        base = os.path.splitext(lyFile)[0]
+        candidates = [base + '.png'] + sorted(glob.glob(base + '-page*.png'))
+        for candidate in candidates:
+            if os.path.exists(candidate):
+                shutil.move(candidate, pngFileOut)
+                return True
+        print('lilypond produced no image for ', pngFileOut)
+        return False
@@ -0,0 +1,229 @@
+######################################################################################
+# -*- coding: utf-8 -*-
+# Content-addressed on-disk store for the media files rendered by chord_generation
+# Copyright (c) 2024 Stefano Franchi <stefano.franchi@gmail.com>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/licenses/gpl.html
+######################################################################################
+
+import argparse
+import hashlib
+import os
+import shutil
+import tempfile
+
+# memo of soundfont digests, keyed by (path, size, mtime) so that we hash each font only once
+_soundFontDigests = {}
+
+
+def renderKey(*parts):
+    """
+    Build the key of a render from everything that went into it
+    (lilypond text, notes, bpm, soundfont digest, encoder settings, ...)
+    :param parts: any sequence of values with a stable repr
+    :return: hex digest
+    """
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def soundFontDigest(soundFont):
+    """
+    Return the sha1 of the soundfont file, computing it only once per build
+    (and again only if the file on disk changes)
+    """
+    try:
+        stat = os.stat(soundFont)
+    except OSError:
+        return None
+    memoKey = (soundFont, stat.st_size, stat.st_mtime)
+    if memoKey not in _soundFontDigests:
+        sha = hashlib.sha1()
+        with open(soundFont, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        _soundFontDigests[memoKey] = sha.hexdigest()
+    return _soundFontDigests[memoKey]
+
+
+class MediaCache(object):
+    """
+    Persistent store of rendered media files (png, mp3), in the spirit of the
+    lilypondCache/checksum scheme of the old LilyPond add-on.
+    Each file is stored under the hash of its render inputs, so an unchanged chord
+    is copied out of the store instead of being rendered again.
+    Recency of use is kept in the files' mtime (touched on every hit), which lets
+    several build processes share the same store without a common index.
+    When the store grows beyond maxBytes the least recently used files are evicted.
+    """
+    lowWaterMark = 0.9  # eviction trims the store to this fraction of maxBytes, so that it walks the store rarely
+
+    def __init__(self, cacheDir='.mediaCache', maxBytes=512 * 1024 * 1024):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.cacheDir, exist_ok=True)
+        # running size of the store, as seen by this instance (evict() walks the store and corrects it)
+        self.totalBytes = sum(size for mtime, size, path in self.blobs())
+
+    counterNames = ['hits', 'misses', 'evictions', 'totalBytes']  # what a copy of the cache in a worker reports back
+
+    def counts(self):
+        """The counters of this instance (see counterNames)"""
+        return {name: getattr(self, name) for name in self.counterNames}
+
+    def mergeCounts(self, counts):
+        """Add what a copy of this cache (e.g. in a pool worker) counted to the counters of this instance"""
+        for name in self.counterNames:
+            setattr(self, name, getattr(self, name) + counts[name])
+
+    def blobPath(self, key, suffix):
+        """Path of the stored file for key (fanned out on the first two hex digits)"""
+        return os.path.join(self.cacheDir, key[:2], key + suffix)
+
+    def fetch(self, key, fileOut):
+        """
+        Copy the stored file for key to fileOut
+        :return: True on a hit, False on a miss
+        """
+        blob = self.blobPath(key, os.path.splitext(fileOut)[1])
+        try:
+            shutil.copyfile(blob, fileOut)
+            os.utime(blob)
+        except OSError:
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def store(self, key, fileIn):
+        """
+        Add a freshly rendered file to the store, then evict old files if needed
+        :return: True if the file was stored
+        """
+        if not os.path.isfile(fileIn):
+            return False
+        blob = self.blobPath(key, os.path.splitext(fileIn)[1])
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        previousSize = os.path.getsize(blob) if os.path.isfile(blob) else 0
+        # copy to a temporary name first so concurrent builds never see half-written files
+        fd, tmpBlob = tempfile.mkstemp(dir=os.path.dirname(blob))
+        os.close(fd)
+        shutil.copyfile(fileIn, tmpBlob)
+        os.replace(tmpBlob, blob)
+        self.totalBytes += os.path.getsize(blob) - previousSize
+        if self.totalBytes > self.maxBytes:
+            self.evict()
+        return True
+
+    def getOrRender(self, key, fileOut, renderFunc):
+        """
+        Fetch fileOut from the store or, on a miss, call renderFunc() and store its output.
+        Only a successful render is stored: renderFunc must return a true value and write fileOut
+        (a fileOut left over by an earlier run is removed first, so it can never be taken for the render)
+        :return: True on a hit, otherwise whatever renderFunc returned
+        """
+        if self.fetch(key, fileOut):
+            return True
+        if os.path.isfile(fileOut):
+            os.remove(fileOut)
+        result = renderFunc()
+        if result and os.path.isfile(fileOut):
+            self.store(key, fileOut)
+        return result
+
+    def blobs(self):
+        """List (mtime, size, path) for all the files in the store"""
+        entries = []
+        for dirPath, dirNames, fileNames in os.walk(self.cacheDir):
+            for fileName in fileNames:
+                path = os.path.join(dirPath, fileName)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        """Remove least recently used files until the store fits in lowWaterMark * maxBytes"""
+        entries = sorted(self.blobs())
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if total <= self.maxBytes * self.lowWaterMark:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+        self.totalBytes = total
+
+    def invalidate(self, key=None):
+        """
+        Remove the stored files for key, or the whole store if no key is given
+        :return: number of files removed
+        """
+        removed = 0
+        for mtime, size, path in self.blobs():
+            if key is None or os.path.basename(path).startswith(key):
+                os.remove(path)
+                self.totalBytes -= size
+                removed += 1
+        return removed
+
+    def stats(self):
+        """Hit/miss statistics of this instance plus the current size of the store"""
+        entries = self.blobs()
+        lookups = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    hitRate=self.hits / lookups if lookups else 0.0,
+                    files=len(entries), bytes=sum(size for mtime, size, path in entries),
+                    maxBytes=self.maxBytes)
+
+
+class MediaDedup(object):
+    """
+    Within one build, remembers the file rendered for each sounding or engraved content
+    (MIDI pitches, durations, bpm and renderer for audio, lilypond source for images), so that
+    equivalent requests, such as the enharmonic roots Gb/F#, share one file instead of
+    rendering their own. A file is shared as soon as its render is under way (e.g. queued to a batch);
+    if that render fails the content is forgotten, so that the next request renders it again,
+    and the file is listed in failed (the requests already linked to it are missing their media)
+    """
+
+    def __init__(self):
+        self.files = {}  # content -> file rendered, or being rendered, for it
+        self.shared = 0
+        self.failed = []
+
+    def sharedFile(self, content, fileOut):
+        """
+        :param content: key of what the file sounds/looks like (see renderKey)
+        :return: (file to link to, True if this is the first request for content and it must be rendered)
+        """
+        if content in self.files:
+            self.shared += 1
+            return self.files[content], False
+        self.files[content] = fileOut
+        return fileOut, True
+
+    def renderDone(self, content, success):
+        """Report the outcome of the render of content (asked for by sharedFile)"""
+        if not success and content in self.files:
+            self.failed.append(self.files.pop(content))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect or invalidate the GenAnkiChords media cache')
+    parser.add_argument('command', choices=['stats', 'invalidate'])
+    parser.add_argument('key', nargs='?', default=None, help='only invalidate the files rendered for this key')
+    parser.add_argument('--dir', default='.mediaCache', help='cache directory')
+    args = parser.parse_args()
+    cache = MediaCache(args.dir)
+    if args.command == 'stats':
+        for name, value in cache.stats().items():
+            print(name, ': ', value)
+    else:
+        print(cache.invalidate(args.key), 'files removed from', args.dir)
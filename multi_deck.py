@@ -0,0 +1,197 @@
+######################################################################################
+# -*- coding: utf-8 -*-
+# Multi-deck builds: several decks published from one shared generation pass
+# Copyright (c) 2024 Stefano Franchi <stefano.franchi@gmail.com>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/licenses/gpl.html
+######################################################################################
+
+import hashlib
+import genanki
+from chord_generation import AnkiDeck, ChordNote, Voicing
+from card_fields import FieldPlan, declaredFields, fieldArtifact
+from note_names import translate, translateField
+
+# the plain data fields every deck starts with (Name and Root make the note GUID, see ChordNote)
+DATA_FIELDS = ['SortId', 'Name', 'Root', 'Root_it', 'Quality', 'Inversion']
+
+
+class DeckDefinition(object):
+    """
+    One deck to publish: its name and ids, the chords and voicings it shows and its card templates
+    """
+
+    def __init__(self, name, deckId, roots=None, qualities=None, voicings=None, templates=None, fileName=None,
+                 modelId=None):
+        """
+        :param roots: roots of the chords in the deck, None for all of them
+        :param qualities: qualities of the chords in the deck, None for all of them
+        :param voicings: voicings the deck may show, None for all those its templates use
+        :param templates: genanki card templates, default AnkiDeck.cardTemplates
+        :param fileName: the .apkg to write, default the name with dashes
+        :param modelId: id of the note type, default AnkiDeck.modelId for the main deck and one derived
+                        from the name for the others (each deck has its own fields and templates)
+        """
+        self.name = name
+        self.deckId = deckId
+        self.roots = roots
+        self.qualities = qualities
+        self.voicings = voicings
+        self.templates = templates if templates is not None else AnkiDeck.cardTemplates
+        self.fileName = fileName or name.replace(' ', '-') + '.apkg'
+        if modelId is None:
+            modelId = AnkiDeck.modelId if deckId == AnkiDeck.deckId else \
+                (1 << 30) + int(hashlib.sha1(name.encode('utf-8')).hexdigest(), 16) % (1 << 30)
+        self.modelId = modelId
+
+    def accepts(self, chordItem):
+        """True if the chord belongs in this deck"""
+        return ((self.roots is None or chordItem.root in self.roots) and
+                (self.qualities is None or chordItem.quality in self.qualities))
+
+
+class DeckNote(ChordNote):
+    """A ChordNote whose GUID also depends on the deck, so the same chord can be in several decks"""
+    deckId = AnkiDeck.deckId
+
+    @property
+    def guid(self):
+        if self.deckId == AnkiDeck.deckId:
+            return genanki.guid_for(self.fields[1], self.fields[2])
+        return genanki.guid_for(self.deckId, self.fields[1], self.fields[2])
+
+
+class MultiDeckBuild(object):
+    """
+    Builds several decks from one GenAnkiChords: the chords and voicing artifacts all the decks need
+    are generated once, in a single addVoicings, and every .apkg is then written from the shared chordsDb
+    and media files. A build costs the union of the decks' content, not the sum.
+    The union is kept here: the app's chordsDb, voicings and the chords' voicingsNeeded are left as they are.
+    """
+
+    def __init__(self, app, decks, fieldsFile='ChordsData.csv'):
+        """
+        :param app: GenAnkiChords; its chordsDb is filled with initDb if empty
+        :param decks: list of DeckDefinition
+        :param fieldsFile: Fieldnames.txt or ChordsData.csv, declaring all the note fields
+        """
+        self.app = app
+        self.decks = decks
+        declared = declaredFields(fieldsFile)
+        self.plans = {deck.name: FieldPlan(deck.templates, declared, Voicing.voicingArtifacts) for deck in decks}
+        self.declared = declared
+        self.chords = {}  # chordsDb key -> chordItem of every chord in some deck, see prepare
+        self.voicings = []  # the voicings some deck shows
+        self.chordVoicings = {}  # chordsDb key -> the voicings to create for the chord, see prepare
+
+    def deckVoicings(self, deck):
+        """The voicings a deck shows: those its templates use, within the deck's filter"""
+        return [voicing for voicing in self.plans[deck.name].voicings()
+                if deck.voicings is None or voicing in deck.voicings]
+
+    def deckArtifacts(self, deck):
+        """The artifacts a deck shows"""
+        voicings = self.deckVoicings(deck)
+        return [artifact for voicing, artifacts in self.plans[deck.name].artifacts.items() if voicing in voicings
+                for artifact in artifacts]
+
+    def deckFields(self, deck):
+        """The fields of a deck's note type: the data fields, then those its templates use, in declared order"""
+        reachable = self.plans[deck.name].reachable
+        return DATA_FIELDS + [field for field in self.declared if field in reachable and field not in DATA_FIELDS] + \
+            [field for field in sorted(reachable) if field not in self.declared and field not in DATA_FIELDS]
+
+    def prepare(self):
+        """
+        Work out the union of the decks: the chords some deck accepts, each with the voicings
+        of the decks accepting it (self.chords, self.chordVoicings), and the artifacts some deck shows
+        :return: the artifact names to render (see GenAnkiChords.addVoicings)
+        """
+        if not self.app.chordsDb:
+            self.app.initDb()
+        self.voicings = []
+        artifacts = []
+        for deck in self.decks:
+            self.voicings.extend(voicing for voicing in self.deckVoicings(deck) if voicing not in self.voicings)
+            artifacts.extend(artifact for artifact in self.deckArtifacts(deck) if artifact not in artifacts)
+        self.chords = {}
+        self.chordVoicings = {}
+        for key, chordItem in self.app.chordsDb.items():
+            decks = [deck for deck in self.decks if deck.accepts(chordItem)]
+            if not decks:
+                continue
+            self.chords[key] = chordItem
+            self.chordVoicings[key] = [voicing for voicing in self.voicings
+                                       if any(voicing in self.deckVoicings(deck) for deck in decks)
+                                       and (not chordItem.voicingsNeeded or voicing in chordItem.voicingsNeeded)]
+        for plan in self.plans.values():
+            plan.report()
+        return artifacts
+
+    def fieldValue(self, deck, chordItem, field, sortId):
+        """
+        Text of a field of a chord's note: data fields from the chordItem, voicing fields from the
+        Voicing artifacts (notes in Italian, as in the ChordsData.csv, keyboard diagrams of the field's hand),
+        empty for the voicings the deck does not show
+        """
+        data = dict(SortId=str(sortId), Name=chordItem.name, Root=chordItem.root,
+                    Root_it=translate(chordItem.root, 'italian', True), Quality=chordItem.quality,
+                    Inversion=chordItem.inversion)
+        if field in data:
+            return data[field]
+        source = fieldArtifact(field, Voicing.voicingArtifacts)
+        if source is None or source[1] is None or source[0] not in chordItem.voicings or \
+                source[0] not in self.deckVoicings(deck):
+            return ''
+        value = getattr(chordItem.voicings[source[0]], source[1])
+        if isinstance(value, dict):
+            return value.get(field[-2:], '')
+        if isinstance(value, list):
+            return translateField(' '.join(note.name for note in value), 'italian', True)
+        return value or ''
+
+    def deckNotes(self, deck):
+        """The notes of a deck, from the shared chords (a SortId is the same in every deck)"""
+        fields = self.deckFields(deck)
+        model = genanki.Model(deck.modelId, deck.name, fields=[{'name': field} for field in fields],
+                              templates=deck.templates)
+        notes = []
+        for sortId, chordItem in enumerate(self.chords.values()):
+            if deck.accepts(chordItem):
+                note = DeckNote(model=model, fields=[self.fieldValue(deck, chordItem, field, sortId) for field in fields])
+                note.deckId = deck.deckId
+                notes.append(note)
+        return notes
+
+    def writeDecks(self):
+        """
+        Write the .apkg of every deck, each with the media its notes reference
+        :return: dictionary file name -> number of notes
+        """
+        written = {}
+        for deck in self.decks:
+            ankiDeck = AnkiDeck(self.chords, '.', self.app.tracer, self.app.buildGraph)
+            ankiDeck.deckId, ankiDeck.deckName, ankiDeck.cardTemplates = deck.deckId, deck.name, deck.templates
+            ankiDeck.ankiNotes = self.deckNotes(deck)
+            ankiDeck.writePackage(ankiDeck.ankiNotes, deck.fileName)
+            written[deck.fileName] = len(ankiDeck.ankiNotes)
+        return written
+
+    def run(self):
+        """
+        Generate the union of the decks once, then write them all
+        :return: dictionary file name -> number of notes
+        """
+        self.app.addVoicings(self.prepare(), self.chordVoicings)
+        return self.writeDecks()
+
+
+# the decks published from the chord material
+BEGINNER_ROOTS = ['C', 'F', 'G', 'D', 'Bb']
+STANDARD_DECKS = [
+    DeckDefinition('Comping Chords', AnkiDeck.deckId, fileName=AnkiDeck.fileName),
+    DeckDefinition('Comping Chords Beginner', 1262384711, roots=BEGINNER_ROOTS),
+    DeckDefinition('Comping Chords Rootless', 1718029633, voicings=['ShellV'],
+                   templates=[template for template in AnkiDeck.cardTemplates if 'Rootless' in template['name']]),
+    DeckDefinition('Comping Chords Guide Tones', 1934577032, voicings=['GuideTones'],
+                   templates=[template for template in AnkiDeck.cardTemplates if 'GuideTones' in template['name']]),
+]
@@ -0,0 +1,137 @@
+######################################################################################
+# -*- coding: utf-8 -*-
+# Note-name translation between naming systems, with tables built once at import
+# Copyright (c) 2024 Stefano Franchi <stefano.franchi@gmail.com>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/licenses/gpl.html
+######################################################################################
+
+from chord_spelling import LETTERS
+
+SYSTEMS = ('english', 'italian', 'french', 'german')
+ALTERATIONS = (-2, -1, 0, 1, 2)  # double flat .. double sharp
+UNICODE_ACCIDENTALS = {-2: '\U0001D12B', -1: '♭', 0: '', 1: '♯', 2: '\U0001D12A'}
+
+SYLLABLES = dict(italian=['Do', 'Re', 'Mi', 'Fa', 'Sol', 'La', 'Si'],
+                 french=['Do', 'Ré', 'Mi', 'Fa', 'Sol', 'La', 'Si'])
+GERMAN = dict(C='C', D='D', E='E', F='F', G='G', A='A', B='H')
+GERMAN_FLATS = {('E', -1): 'Es', ('E', -2): 'Eses', ('A', -1): 'As', ('A', -2): 'Asas',
+                ('B', -1): 'B', ('B', -2): 'Heses'}
+
+
+def englishSpelling(letter, alteration):
+    """The ASCII English spelling used everywhere else in GenAnkiChords (C#, Db, C##, Dbb)"""
+    return letter + ('#' * alteration if alteration > 0 else 'b' * -alteration)
+
+
+def spellings(system, letter, alteration):
+    """
+    All the names of a note in a naming system
+    :return: (ASCII name, Unicode name, [other accepted input spellings])
+    """
+    sharps, flats = '#' * max(alteration, 0), 'b' * max(-alteration, 0)
+    unicodeAccidental = UNICODE_ACCIDENTALS[alteration]
+    if system == 'english':
+        ascii = englishSpelling(letter, alteration)
+        # lilypond english names (Cs, Cf, Css, Cff) and x for double sharps
+        aliases = [letter + ('s' * alteration if alteration > 0 else 'f' * -alteration)]
+        if alteration == 2:
+            aliases.append(letter + 'x')
+        aliases.append(letter + '♯' * max(alteration, 0) + '♭' * max(-alteration, 0))
+        return ascii, letter + unicodeAccidental, aliases
+    if system == 'german':
+        if (letter, alteration) in GERMAN_FLATS:
+            name = GERMAN_FLATS[(letter, alteration)]
+        else:
+            name = GERMAN[letter] + ('is' * alteration if alteration > 0 else 'es' * -alteration)
+        aliases = ['Bes'] if (letter, alteration) == ('B', -2) else []
+        return name, name, aliases
+    syllable = SYLLABLES[system][LETTERS.index(letter)]
+    plainSyllable = syllable.replace('é', 'e')
+    if system == 'italian':
+        # d(iesis) and b(emolle), as in ChordsData.csv: Dod, Lab
+        ascii = plainSyllable + ('d' * alteration if alteration > 0 else 'b' * -alteration)
+    else:
+        ascii = plainSyllable + sharps + flats
+    aliases = [plainSyllable + sharps + flats, syllable + sharps + flats, syllable + unicodeAccidental,
+               plainSyllable + unicodeAccidental, syllable + '♯' * max(alteration, 0) + '♭' * max(-alteration, 0)]
+    return ascii, syllable + unicodeAccidental, aliases
+
+
+def buildTables():
+    """
+    :return: (dictionary (system, unicode) -> {English spelling: name},
+              dictionary system -> {any accepted name: English spelling})
+    """
+    names = {}
+    readers = {}
+    for system in SYSTEMS:
+        names[(system, False)] = {}
+        names[(system, True)] = {}
+        reader = readers[system] = {}
+        for letter in LETTERS:
+            for alteration in ALTERATIONS:
+                spelling = englishSpelling(letter, alteration)
+                ascii, unicode, aliases = spellings(system, letter, alteration)
+                names[(system, False)][spelling] = ascii
+                names[(system, True)][spelling] = unicode
+                for name in aliases + [unicode, ascii]:
+                    reader[name] = spelling
+    return names, readers
+
+
+NAMES, READERS = buildTables()
+
+# every source/target/script combination, precomposed: a translation is a single dictionary lookup
+TRANSLATIONS = {(source, target, unicode): {name: NAMES[(target, unicode)][spelling]
+                                            for name, spelling in READERS[source].items()}
+                for source in SYSTEMS for target in SYSTEMS for unicode in (False, True)}
+
+
+def translationTable(source='english', target='italian', unicode=False):
+    """
+    The dictionary translating every spelling of source into target
+    :param unicode: target names with ♭/♯ (and the double flat/sharp signs) instead of ASCII
+    """
+    return TRANSLATIONS[(source, target, unicode)]
+
+
+def translationPairs(source='english', target='italian'):
+    """
+    The dictionary translating every spelling of source into the [ASCII, Unicode] names of target,
+    as the old createEnglItTransDicts tables did (e.g. 'Af' -> ['Lab', 'La♭'])
+    """
+    ascii, unicode = TRANSLATIONS[(source, target, False)], TRANSLATIONS[(source, target, True)]
+    return {name: [ascii[name], unicode[name]] for name in ascii}
+
+
+def translate(note, target='italian', unicode=False, source='english'):
+    """
+    Translate a single note name (KeyError if note is not a name of source)
+    e.g. translate('Db') -> 'Reb', translate('Bb', 'german') -> 'B', translate('Sib', 'english', True, 'italian') -> 'B♭'
+    """
+    return TRANSLATIONS[(source, target, unicode)][note]
+
+
+def translateField(text, target='italian', unicode=False, source='english'):
+    """Translate every note of a space-separated field ('Dod Sol'), leaving any other word as it is"""
+    table = TRANSLATIONS[(source, target, unicode)]
+    return ' '.join(table.get(word, word) for word in text.split(' '))
+
+
+def translateColumns(rows, fields, target='italian', unicode=False, source='english'):
+    """
+    Translate whole columns of a table in one pass, in place: each distinct value is translated only once
+    :param rows: iterable of dictionaries (e.g. ChordImporter rows)
+    :param fields: the columns to translate (missing ones are ignored)
+    :return: rows
+    """
+    table = TRANSLATIONS[(source, target, unicode)]
+    translated = {}
+    for row in rows:
+        for field in fields:
+            value = row.get(field)
+            if value:
+                if value not in translated:
+                    translated[value] = ' '.join(table.get(word, word) for word in value.split(' '))
+                row[field] = translated[value]
+    return rows
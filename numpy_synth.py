@@ -0,0 +1,213 @@
+######################################################################################
+# -*- coding: utf-8 -*-
+# Optional NumPy chord synthesizer: mixes soundfont piano samples without any subprocess
+# Copyright (c) 2024 Stefano Franchi <stefano.franchi@gmail.com>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/licenses/gpl.html
+######################################################################################
+
+import struct
+import numpy as np
+from audio_render import FluidSynthRenderer, barEvents
+from media_cache import soundFontDigest
+
+# soundfont generator operators we need (SoundFont 2.04 spec, section 8.1.2)
+GEN_INSTRUMENT = 41
+GEN_KEYRANGE = 43
+GEN_VELRANGE = 44
+GEN_SAMPLEID = 53
+GEN_SAMPLEMODES = 54
+GEN_ROOTKEY = 58
+# generators whose amount is unsigned (an index, a range or a flag word), the others are signed shorts
+UNSIGNED_GENERATORS = (GEN_INSTRUMENT, GEN_KEYRANGE, GEN_VELRANGE, GEN_SAMPLEID, GEN_SAMPLEMODES)
+
+
+class SoundFontSamples(object):
+    """
+    Minimal SoundFont 2 reader: finds the sample (and its root key and loop) that a
+    preset plays for a given pitch and velocity. The sample data is memory mapped,
+    so only the samples actually used are ever read from disk.
+    """
+
+    def __init__(self, soundFont, bank=0, preset=0):
+        self.soundFont = soundFont
+        self.chunks = {}
+        self.smplOffset = 0
+        self.smplFrames = 0
+        with open(soundFont, 'rb') as f:
+            self.readChunks(f)
+        self.zones = self.presetZones(bank, preset)
+        self.samples = np.memmap(soundFont, dtype='<i2', mode='r', offset=self.smplOffset, shape=(self.smplFrames,))
+
+    def readChunks(self, f):
+        """Read the pdta chunks into memory and locate the smpl chunk"""
+        riff, size, form = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or form != b'sfbk':
+            raise ValueError(self.soundFont + ' is not a SoundFont 2 file')
+        end = 8 + size
+        while f.tell() < end:
+            chunkId, chunkSize = struct.unpack('<4sI', f.read(8))
+            listType = f.read(4)
+            listEnd = f.tell() - 4 + chunkSize
+            while f.tell() < listEnd:
+                subId, subSize = struct.unpack('<4sI', f.read(8))
+                if subId == b'smpl':
+                    self.smplOffset = f.tell()
+                    self.smplFrames = subSize // 2
+                    f.seek(subSize + (subSize & 1), 1)
+                elif listType == b'pdta':
+                    self.chunks[subId.decode('ascii')] = f.read(subSize)
+                else:
+                    f.seek(subSize + (subSize & 1), 1)
+
+    def records(self, name, fmt):
+        """Unpack all the records of a pdta chunk"""
+        return list(struct.iter_unpack(fmt, self.chunks[name]))
+
+    def zoneGenerators(self, bags, gens, first, last, terminal):
+        """
+        Generators of each zone in bags[first:last], as dictionaries operator -> amount.
+        A first zone without the terminal generator (instrument or sampleID) is the global
+        zone: it is not returned, its generators are the defaults of all the other zones.
+        """
+        zones = []
+        for b in range(first, last):
+            zone = {}
+            for oper, amount in gens[bags[b][0]:bags[b + 1][0]]:
+                zone[oper] = amount & 0xFFFF if oper in UNSIGNED_GENERATORS else amount
+            zones.append(zone)
+        if zones and terminal not in zones[0]:
+            defaults = zones.pop(0)
+            zones = [{**defaults, **zone} for zone in zones]
+        return zones
+
+    def presetZones(self, bank, preset):
+        """Flatten preset -> instrument -> sample zones into (keyRange, velRange, sample zone)"""
+        phdr = self.records('phdr', '<20sHHHIII')
+        pbag = self.records('pbag', '<HH')
+        pgen = self.records('pgen', '<Hh')
+        inst = self.records('inst', '<20sH')
+        ibag = self.records('ibag', '<HH')
+        igen = self.records('igen', '<Hh')
+        self.sampleHeaders = self.records('shdr', '<20sIIIIIBbHH')
+        for p in range(len(phdr) - 1):
+            if (phdr[p][2], phdr[p][1]) == (bank, preset):
+                break
+        else:
+            raise ValueError('preset %d:%d not found in %s' % (bank, preset, self.soundFont))
+        zones = []
+        for presetZone in self.zoneGenerators(pbag, pgen, phdr[p][3], phdr[p + 1][3], GEN_INSTRUMENT):
+            if GEN_INSTRUMENT not in presetZone:
+                continue
+            i = presetZone[GEN_INSTRUMENT]
+            presetKeys = self.range(presetZone.get(GEN_KEYRANGE))
+            for instZone in self.zoneGenerators(ibag, igen, inst[i][1], inst[i + 1][1], GEN_SAMPLEID):
+                if GEN_SAMPLEID in instZone:
+                    keys = self.range(instZone.get(GEN_KEYRANGE))
+                    zones.append(((max(keys[0], presetKeys[0]), min(keys[1], presetKeys[1])),
+                                  self.range(instZone.get(GEN_VELRANGE)), instZone))
+        return zones
+
+    def range(self, amount):
+        """Decode a range generator amount (lo in the low byte, hi in the high byte)"""
+        if amount is None:
+            return (0, 127)
+        return (amount & 0xFF, amount >> 8)
+
+    def findSample(self, pitch, velocity=64):
+        """
+        :return: (frames as int16 array, sample rate, root key, loop start, loop end or None)
+        """
+        for (keyLo, keyHi), (velLo, velHi), zone in self.zones:
+            if keyLo <= pitch <= keyHi and velLo <= velocity <= velHi:
+                break
+        else:
+            raise KeyError('no sample for pitch %d' % pitch)
+        name, start, end, loopStart, loopEnd, sampleRate, originalPitch, correction, link, kind = \
+            self.sampleHeaders[zone[GEN_SAMPLEID]]
+        rootKey = zone.get(GEN_ROOTKEY, -1)
+        if rootKey < 0:
+            # -1 (the default) means no override: use the sample's own pitch
+            rootKey = originalPitch
+        rootKey = rootKey - correction / 100.0
+        looped = zone.get(GEN_SAMPLEMODES, 0) & 1
+        return (self.samples[start:end], sampleRate, rootKey,
+                loopStart - start, (loopEnd - start) if looped and loopEnd > loopStart else None)
+
+
+class NumpySynthRenderer(FluidSynthRenderer):
+    """
+    Opt-in synth backend for our 2-4 note chords: each note is a soundfont piano sample
+    resampled to its pitch with np.interp (cached per MIDI pitch and length), shaped by
+    a short attack/release envelope, and the notes are summed and normalized.
+    The mp3 encoding is the same as for the fluidsynth renderers.
+    """
+
+    attackTime = 0.005
+    releaseTime = 1.0
+    peak = 0.9
+    subprocessPipeline = False
+
+    def __init__(self, soundFont='/usr/share/soundfonts/FluidR3_GM.sf2', bank=0, preset=0):
+        FluidSynthRenderer.__init__(self, soundFont)
+        self.bank = bank
+        self.preset = preset
+        self.font = None
+        self.noteCache = {}  # (pitch, velocity, held frames) -> float32 mono note
+
+    def __getstate__(self):
+        # pool workers reopen the soundfont themselves rather than pickling the memory map
+        state = dict(self.__dict__)
+        state['font'] = None
+        state['noteCache'] = {}
+        return state
+
+    def cacheKey(self):
+        return ('numpy', soundFontDigest(self.soundFont), self.bank, self.preset, self.sampleRate,
+                self.attackTime, self.releaseTime, self.peak, tuple(self.encoderArgs))
+
+    def renderNote(self, pitch, velocity, heldFrames):
+        """Render (or fetch from the cache) one note held for heldFrames, plus its release"""
+        key = (pitch, velocity, heldFrames)
+        if key not in self.noteCache:
+            if self.font is None:
+                self.font = SoundFontSamples(self.soundFont, self.bank, self.preset)
+            data, sampleRate, rootKey, loopStart, loopEnd = self.font.findSample(pitch, velocity)
+            releaseFrames = int(self.releaseTime * self.sampleRate)
+            frames = heldFrames + releaseFrames
+            step = 2.0 ** ((pitch - rootKey) / 12.0) * sampleRate / self.sampleRate
+            positions = np.arange(frames) * step
+            if loopEnd is not None:
+                loopLength = loopEnd - loopStart
+                past = positions >= loopEnd
+                positions[past] = loopStart + np.mod(positions[past] - loopStart, loopLength)
+            note = np.interp(positions, np.arange(len(data)), data.astype(np.float32), right=0.0)
+            envelope = np.ones(frames, dtype=np.float32)
+            attackFrames = min(int(self.attackTime * self.sampleRate), frames)
+            envelope[:attackFrames] = np.linspace(0.0, 1.0, attackFrames, endpoint=False)
+            envelope[heldFrames:] = np.linspace(1.0, 0.0, frames - heldFrames)
+            self.noteCache[key] = (note * envelope * (velocity / 127.0)).astype(np.float32)
+        return self.noteCache[key]
+
+    def renderPcm(self, bar, bpm=80):
+        """Mix the notes of the bar and return them as 16 bit stereo raw PCM"""
+        events = barEvents(bar, bpm)
+        releaseFrames = int(self.releaseTime * self.sampleRate)
+        totalFrames = int(round(max([end for start, end, notes in events] or [0]) * self.sampleRate)) + releaseFrames
+        mix = np.zeros(totalFrames, dtype=np.float32)
+        for start, end, notes in events:
+            first = int(round(start * self.sampleRate))
+            heldFrames = int(round(end * self.sampleRate)) - first
+            for pitch, velocity, channel in notes:
+                note = self.renderNote(pitch, velocity, heldFrames)
+                mix[first:first + len(note)] += note[:totalFrames - first]
+        loudest = np.abs(mix).max() if totalFrames else 0.0
+        if loudest > 0:
+            mix *= self.peak * 32767 / loudest
+        return np.repeat(mix.astype('<i2'), self.channels).tobytes()
+
+    def renderBar(self, bar, mp3FileOut, bpm=80, scratchDir='.'):
+        """
+        Convert a mingus bar to an mp3 file, synthesizing it in-process
+        :return: True if the mp3 was written
+        """
+        return self.encodePcm(self.renderPcm(bar, bpm), mp3FileOut)
@@ -0,0 +1,142 @@
+######################################################################################
+# -*- coding: utf-8 -*-
+# Array-backed voicings: one matrix of MIDI pitches for every chord and voicing
+# Copyright (c) 2024 Stefano Franchi <stefano.franchi@gmail.com>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/licenses/gpl.html
+######################################################################################
+
+import numpy as np
+from mingus.containers import Note as mNote
+from chord_spelling import ROOTS, QUALITIES, NATURALS, chordSpelling, pitchClass
+
+# Each voicing is defined once, as its voices: (chord degree, octave of the voice).
+# A voice keeps its octave when transposed, which is how Voicing placed mingus notes (mNote(chord[degree], octave)).
+# mingus counts octaves by letter, so B#3 sounds as C4 and Cb4 as B3: a voice sounds at the low end of its octave
+# plus the letter of its note plus the accidentals.
+VOICING_SHAPES = {
+    'FullStandardV': [(0, 3), (1, 4), (2, 4), (3, 4)],
+    'ShellVOff3rd': [(0, 3), (1, 3)],
+    'ShellVOff7th': [(0, 3), (3, 3)],
+}
+
+
+def voicingShape(voicing, degreeCount, bassDegree=0):
+    """
+    Voices of a voicing for a chord of degreeCount degrees with bassDegree in the bass.
+    FullStandardV puts the bass in octave 3 and every other chord tone in octave 4 (the shape above,
+    for a seventh chord in root position); the shell shapes are fixed
+    """
+    if voicing != 'FullStandardV':
+        return VOICING_SHAPES[voicing]
+    return [(bassDegree, 3)] + [(degree, 4) for degree in range(degreeCount) if degree != bassDegree]
+
+
+def shapeLabel(voicing, bassDegree=0):
+    """Voicing column of a matrix row: the voicing name, plus /bassDegree for the inversions"""
+    return voicing if not bassDegree else '%s/%d' % (voicing, bassDegree)
+
+
+def letterPitch(note):
+    """Semitones of a spelled note above the C of its mingus octave (B# -> 12, Cb -> -1)"""
+    return NATURALS[note[0]] + note.count('#') - note.count('b')
+
+
+def spelledNote(note, pitch):
+    """The mingus Note spelled note that sounds at MIDI pitch pitch"""
+    return mNote(note, (pitch - letterPitch(note)) // 12 - 1)
+
+
+class PitchMatrix(object):
+    """
+    MIDI pitches of every root x quality x voicing as one integer matrix, one row per
+    chord/voicing and one column per voice (-1 pads voicings with fewer voices).
+    The rows of a quality are computed for all the roots at once: its shapes are spelled on C, transposed to
+    every root by one broadcast add folded into the voices' octaves, and corrected by an octave where the spelled
+    letter crosses the C (B#, Cb). The matrix starts with the given roots and qualities and grows a block of rows
+    the first time another quality, root or the inversions of a quality are asked for.
+    mingus Notes are built from the rows, for the lilypond/MIDI output.
+    """
+
+    def __init__(self, roots=ROOTS, qualities=list(QUALITIES), voicings=list(VOICING_SHAPES)):
+        self.roots = list(roots)
+        self.voicings = list(voicings)
+        self.pitches = np.full((0, max(len(VOICING_SHAPES[voicing]) for voicing in voicings)), -1, dtype=np.int16)
+        self.rows = []
+        self.index = {}
+        self.built = set()  # (root, quality, inverted) of the blocks computed so far
+        for quality in qualities:
+            self.addBlock(self.roots, quality, False)
+
+    def addBlock(self, roots, quality, inverted):
+        """
+        Append the rows of quality for all roots: each voicing in root position,
+        or FullStandardV with every other chord degree in the bass if inverted
+        """
+        spellings = [chordSpelling(root, quality) for root in roots]
+        degreeCount = len(spellings[0].notes)
+        shapes = [(voicing, bassDegree) for voicing in self.voicings
+                  for bassDegree in (range(1, degreeCount) if inverted and voicing == 'FullStandardV' else
+                                     [] if inverted else [0])
+                  if max(degree for degree, octave in voicingShape(voicing, degreeCount, bassDegree)) < degreeCount]
+        maxVoices = max([len(voicingShape(voicing, degreeCount, bassDegree)) for voicing, bassDegree in shapes] +
+                        [self.pitches.shape[1]])
+        # the low end of each voice's octave and its pitch class above C in the chord on C, padded with -1
+        low = np.zeros((len(shapes), maxVoices), dtype=np.int16)
+        degrees = np.full((len(shapes), maxVoices), -1, dtype=np.int16)
+        for row, (voicing, bassDegree) in enumerate(shapes):
+            for column, (degree, octave) in enumerate(voicingShape(voicing, degreeCount, bassDegree)):
+                low[row, column] = 12 * (octave + 1)
+                degrees[row, column] = degree
+        semitones = np.array(chordSpelling('C', quality).pitchClasses, dtype=np.int16)[degrees]
+        rootPcs = np.array([pitchClass(root) for root in roots], dtype=np.int16)
+        # mingus counts octaves by letter: +1 octave for a B# (and B##), -1 for a Cb (and Cbb)
+        crossings = np.array([[letterPitch(note) // 12 for note in spelling.notes] for spelling in spellings],
+                             dtype=np.int16)
+        transposed = (semitones[None, :, :] + rootPcs[:, None, None]) % 12
+        block = np.where(degrees[None, :, :] < 0, -1, low[None, :, :] + transposed + 12 * crossings[:, degrees])
+        if maxVoices > self.pitches.shape[1]:
+            self.pitches = np.pad(self.pitches, ((0, 0), (0, maxVoices - self.pitches.shape[1])), constant_values=-1)
+        self.pitches = np.concatenate([self.pitches, block.reshape(-1, maxVoices)])
+        for root in roots:
+            for voicing, bassDegree in shapes:
+                self.index[(root, quality, shapeLabel(voicing, bassDegree))] = len(self.rows)
+                self.rows.append((root, quality, shapeLabel(voicing, bassDegree)))
+            self.built.add((root, quality, inverted))
+
+    def row(self, root, quality, voicing, bassDegree=0):
+        """Matrix row of one chord/voicing, adding the block of its quality if needed"""
+        label = (root, quality, shapeLabel(voicing, bassDegree))
+        if label not in self.index:
+            inverted = bassDegree > 0
+            if root not in self.roots:
+                self.roots.append(root)
+            roots = [other for other in self.roots if (other, quality, inverted) not in self.built]
+            if roots:
+                self.addBlock(roots, quality, inverted)
+        return self.index[label]
+
+    def voicingPitches(self, root, quality, voicing, bassDegree=0):
+        """MIDI pitches of one chord/voicing as a list"""
+        row = self.row(root, quality, voicing, bassDegree)
+        return [int(p) for p in self.pitches[row] if p >= 0]
+
+    def notes(self, root, quality, voicing, bassDegree=0):
+        """
+        mingus Notes of one chord/voicing, spelled as in the chord spelling table and placed at the pitches of its row
+        :param bassDegree: chord degree in the bass, for the inversions (see voicingShape)
+        """
+        spelling = chordSpelling(root, quality)
+        shape = voicingShape(voicing, len(spelling.notes), bassDegree)
+        return [spelledNote(spelling.notes[degree], pitch)
+                for (degree, octave), pitch in zip(shape, self.voicingPitches(root, quality, voicing, bassDegree))]
+
+
+_defaultMatrix = None
+
+
+def pitchMatrix():
+    """The matrix of all roots, qualities and voicings, built on first use"""
+    global _defaultMatrix
+    if _defaultMatrix is None:
+        _defaultMatrix = PitchMatrix()
+    return _defaultMatrix
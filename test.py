@@ -3,7 +3,39 @@
 ###
 
 import chord_generation
+import media_cache
+import lilypond_batch
+import audio_render
+import numpy_synth
+import build_graph
+import chord_spelling
+import pitch_matrix
+import card_fields
+import benchmark
+import build_trace
+import async_jobs
+import chord_import
+import note_names
+import chord_vocabulary
+import voice_leading
+import fingering
+import keyboard_diagram
+import multi_deck
+import genanki
+import json
+import zipfile
+import sqlite3
+import zlib
+import numpy
+import struct
 import unittest
+import os
+import io
+import sys
+import shutil
+import tempfile
+import time
+import itertools
 from bs4 import BeautifulSoup as BSHTML
 from string import Template
 
@@ -19,7 +51,20 @@ from  pydub  import AudioSegment
 import subprocess
 soundFont = '/usr/share/soundfonts/FluidR3_GM.sf2'
 
-class TestGenAnkiChords(unittest.TestCase):
+class TmpDirTestCase(unittest.TestCase):
+    """ Base class of the tests that write files: every test runs in its own temporary directory"""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpDir = tempfile.mkdtemp()
+        os.chdir(self.tmpDir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpDir)
+
+
+class TestGenAnkiChords(TmpDirTestCase):
     """ Test main functions of the app"""
 
     roots = ['Gb'] #, 'Db', 'Ab', 'Eb', 'Bb', 'F', 'C', 'G', 'D', 'A', 'E', 'B', 'F#', 'C#', 'G#', 'D#', 'A#']
@@ -56,6 +101,859 @@ class TestGenAnkiChords(unittest.TestCase):
         for chordItem in self.app.chordsDb.values():
             self.assertTrue(set(chordItem.voicings.keys()).issuperset(set(self.voicings)),
                          "GenAnkiChords app's chordsDb should have a voicing instance for all required voicings")
+class TestParallelGeneration(TmpDirTestCase):
+    """ Test generation of the voicings on a process pool"""
+
+    def test_VoicingsGatheredFromWorkers(self):
+        app = chord_generation.GenAnkiChords(['C', 'F'], ['M7', 'm7'], ['ShellV'], workers=2)
+        app.initDb()
+        app.addVoicings()
+        for chordItem in app.chordsDb.values():
+            self.assertEqual(['ShellV'], list(chordItem.voicings.keys()))
+        self.assertEqual(chord_generation.Voicing('F', 'm7').genShellVOff3rdLilyPond(),
+                         app.chordsDb['Fm7'].voicings['ShellV'].shellVOff3rdLilypond,
+                         "Voicings built in the workers should match the serial ones")
+
+    def test_ScratchDirRemoved(self):
+        key, voicing, newVoicing, cacheCounts = chord_generation.renderVoicingJob(('CM7', 'C', 'M7', '', 'ShellV', {},
+                                                                                   None))
+        self.assertEqual('.', newVoicing.scratchDir, "Per-job scratch dir should not outlive the job")
+        self.assertIsNone(cacheCounts)
+
+    def test_CacheCountsMerged(self):
+        cache = media_cache.MediaCache('cache')
+        with benchmark.standInTools():
+            for build in range(2):
+                app = chord_generation.GenAnkiChords(['C', 'F'], ['M7'], ['FullStandardV'], mediaCache=cache, workers=2)
+                app.initDb()
+                app.addVoicings(['fullStandardVPng'])
+        self.assertEqual((2, 2), (cache.hits, cache.misses), "The workers' cache lookups should be counted")
+        self.assertEqual(cache.stats()['bytes'], cache.totalBytes)
+
+    def test_WholeBuildOptionsRejected(self):
+        for option in ['batchLilyPond', 'audioReel', 'dedupMedia', 'asyncJobs']:
+            with self.assertRaises(ValueError):
+                chord_generation.GenAnkiChords(['C'], ['M7'], ['ShellV'], workers=2, **{option: True})
+
+
+class TestLazyVoicing(TmpDirTestCase):
+    """ Test that voicing artifacts are only rendered on first access"""
+
+    def test_AddVoicingRendersNothing(self):
+        chordItem = chord_generation.ChordItem('C', 'M7')
+        chordItem.addVoicing('FullStandardV')
+        voicing = chordItem.voicings['FullStandardV']
+        self.assertEqual([], voicing.mediaFiles(), "No media should be rendered before they are accessed")
+        self.assertFalse(voicing.hasArtifacts(['fullStandardVNotes']))
+        self.assertEqual([('C', 3), ('E', 4), ('G', 4), ('B', 4)], [(n.name, n.octave) for n in voicing.fullStandardVNotes])
+        self.assertTrue(voicing.hasArtifacts(['fullStandardVNotes']))
+        self.assertIs(voicing.fullStandardVNotes, voicing.fullStandardVNotes, "Artifacts should be memoized")
+
+    def test_PartialBuild(self):
+        app = chord_generation.GenAnkiChords(['C', 'F'], ['M7'], ['ShellV'])
+        app.initDb()
+        app.addVoicings(['shellVOff3rdNotes'])
+        voicing = app.chordsDb['FM7'].voicings['ShellV']
+        self.assertTrue(voicing.hasArtifacts(['shellVOff3rdNotes']))
+        self.assertFalse(voicing.hasArtifacts(['shellVOff3rdLilypond']))
+
+    def test_UnknownVoicing(self):
+        with self.assertRaises(NotImplementedError):
+            chord_generation.ChordItem('C', 'M7').addVoicing('NoSuchVoicing')
+
+    def test_VoicingWithoutArtifactsGenerated(self):
+        generated = []
+        chord_generation.Voicing.genNoArtifactsV = lambda voicing: generated.append(voicing.root)
+        try:
+            chord_generation.ChordItem('C', 'M7').addVoicing('NoArtifactsV')
+        finally:
+            del chord_generation.Voicing.genNoArtifactsV
+        self.assertEqual(['C'], generated, "A voicing with no lazy artifacts should be generated by its gen method")
+
+    def test_ReadAfterFlushRendered(self):
+        with benchmark.standInTools():
+            app = chord_generation.GenAnkiChords(['C'], ['M7'], ['FullStandardV'], batchLilyPond=True)
+            app.initDb()
+            app.addVoicings(['fullStandardVNotes'])
+            app.chordsDb['CM7'].voicings['FullStandardV'].fullStandardVPng
+        self.assertEqual([], app.lilyPondBatch.pending, "Nothing should be queued on a flushed batch")
+        self.assertTrue(os.path.isfile('CM7-FullStandardV.png'))
+
+    def test_LoadedVoicingsKeepRenderOptions(self):
+        for build in range(2):
+            app = chord_generation.GenAnkiChords(['C'], ['M7'], ['ShellV'],
+                                                 buildGraph=build_graph.BuildGraph(self.tmpDir),
+                                                 mediaCache=media_cache.MediaCache(os.path.join(self.tmpDir, 'cache')))
+            app.initDb()
+            app.addVoicings(['shellVOff3rdNotes'])
+        self.assertEqual({}, app.buildGraph.rebuilt, "The voicing should come from the buildGraph")
+        self.assertIs(app.mediaCache, app.chordsDb['CM7'].voicings['ShellV'].mediaCache)
+
+
+class TestFieldPruning(unittest.TestCase):
+    """ Test the card templates dependency analysis"""
+    templates = [{'name': 'Card', 'qfmt': '{{Name}}{{#Rootless_V_Off_3rd}}x{{/Rootless_V_Off_3rd}}',
+                  'afmt': '{{FrontSide}}{{text:Rootless_V_Off_3rd-lilypond}}{{GuideTones_V_Off_7th}}'}]
+
+    def test_TemplateFields(self):
+        self.assertEqual({'Name', 'Rootless_V_Off_3rd', 'Rootless_V_Off_3rd-lilypond', 'GuideTones_V_Off_7th'},
+                         card_fields.templateFields(self.templates))
+
+    def test_DeclaredFields(self):
+        csvFields = card_fields.declaredFields('ChordsData.csv')
+        txtFields = card_fields.declaredFields('Fieldnames.txt')
+        self.assertEqual('SortId', csvFields[0])
+        self.assertEqual(len(csvFields), len(set(csvFields)), "Repeated field names should be dropped")
+        self.assertIn('Rootless_V_Off_3rd_LilyPond_Image', txtFields)
+
+    def test_PlanSchedulesOnlyShownArtifacts(self):
+        plan = card_fields.FieldPlan(self.templates, card_fields.declaredFields('ChordsData.csv'),
+                                     chord_generation.Voicing.voicingArtifacts)
+        self.assertEqual({'ShellV': ['shellVOff3rdNotes', 'shellVOff3rdLilypond']}, plan.artifacts)
+        self.assertEqual(['GuideTones_V_Off_7th'], plan.unrenderable)
+        self.assertIn('Rootless_V_Off_7th-lilypondimg', plan.skipped)
+        self.assertNotIn('Name', plan.skipped)
+
+    def test_AppPrunedToTemplates(self):
+        app = chord_generation.GenAnkiChords(['C'], ['M7'], ['FullStandardV', 'ShellV'])
+        plan = app.pruneToTemplates(self.templates)
+        self.assertEqual(['ShellV'], app.voicings, "Voicings no template shows should not be generated")
+        app.initDb()
+        app.addVoicings(plan.artifactNames())
+        voicing = app.chordsDb['CM7'].voicings['ShellV']
+        self.assertTrue(voicing.hasArtifacts(['shellVOff3rdLilypond']))
+        self.assertFalse(voicing.hasArtifacts(['shellVOff7thLilypond']))
+
+
+class TestBenchmark(unittest.TestCase):
+    """ Test the stage benchmarks with the stand-in tools"""
+
+    def test_AllStagesTimed(self):
+        with benchmark.standInTools():
+            results = benchmark.Benchmark(size=10, mediaSample=2).run()
+        self.assertEqual(benchmark.STAGES, list(results.keys()))
+        self.assertEqual(2, results['png']['items'])
+        self.assertEqual(10, results['package']['items'])
+
+    def test_SyntheticChordsDb(self):
+        chordsDb = benchmark.syntheticChordsDb(200)
+        self.assertEqual(200, len(chordsDb))
+        self.assertEqual(('C', 'M7'), (chordsDb['CM7-000000'].root, chordsDb['CM7-000000'].quality))
+
+    def test_RegressionGate(self):
+        baseline = dict(mp3=dict(seconds=1.0, items=10, perItem=0.1))
+        self.assertEqual([], benchmark.compareToBaseline(dict(mp3=dict(seconds=1.1, items=10, perItem=0.11)), baseline))
+        self.assertEqual([('mp3', 0.1, 0.2)],
+                         benchmark.compareToBaseline(dict(mp3=dict(seconds=2.0, items=10, perItem=0.2)), baseline))
+
+
+class TestBuildTrace(TmpDirTestCase):
+    """ Test the per-stage tracing of a build"""
+
+    def test_SpansRecorded(self):
+        tracer = build_trace.BuildTracer()
+        app = chord_generation.GenAnkiChords(['C', 'F'], ['M7'], ['ShellV'], tracer=tracer)
+        app.initDb()
+        app.addVoicings()
+        stages = [record['stage'] for record in tracer.records]
+        self.assertEqual(['initDb'] + ['keyboard', 'keyboard', 'voicing'] * 2 + ['addVoicings'], stages)
+        self.assertEqual('FM7/ShellV', tracer.records[6]['item'])
+        self.assertEqual(2, tracer.summary()['voicing']['count'])
+        self.assertIsNone(tracer.summary()['voicing']['peakMemory'], "Without traceMemory no peak should be reported")
+
+    def test_BytesAndExports(self):
+        tracer = build_trace.BuildTracer(traceMemory=True)
+        outFile = os.path.join(self.tmpDir, 'out.bin')
+        with tracer.span('png', 'CM7') as span:
+            with open(outFile, 'wb') as f:
+                f.write(bytes(1000))
+            span.addOutput(outFile)
+        tracer.close()
+        self.assertEqual(1000, tracer.records[0]['bytes'])
+        tracer.writeJsonLines(os.path.join(self.tmpDir, 'trace.jsonl'))
+        tracer.writeChromeTrace(os.path.join(self.tmpDir, 'trace.json'))
+        with open(os.path.join(self.tmpDir, 'trace.json')) as f:
+            event = json.load(f)['traceEvents'][0]
+        self.assertEqual(('png', 'X', 'CM7'), (event['name'], event['ph'], event['args']['item']))
+
+    def test_NestedPeakMemory(self):
+        tracer = build_trace.BuildTracer(traceMemory=True)
+        with tracer.span('addVoicings'):
+            before = bytearray(4000000)
+            del before
+            with tracer.span('voicing', 'CM7/ShellV'):
+                inner = bytearray(2000000)
+                del inner
+        tracer.close()
+        inner, outer = tracer.records
+        self.assertGreaterEqual(inner['peakMemory'], 2000000)
+        self.assertLess(inner['peakMemory'], 4000000, "A span should not count the allocations before it")
+        self.assertGreaterEqual(outer['peakMemory'], 4000000, "A child span should not hide the peak of its parent")
+
+    def test_ProgressLine(self):
+        stream = io.StringIO()
+        tracer = build_trace.BuildTracer(showProgress=True, progressStream=stream)
+        tracer.startProgress(4, 'voicings')
+        tracer.advance()
+        tracer.endProgress()
+        self.assertIn('1/4 voicings', stream.getvalue())
+
+    def test_DisabledTracerIsDefault(self):
+        self.assertIs(build_trace.NULL_TRACER, chord_generation.GenAnkiChords([], [], []).tracer)
+
+
+class TestAsyncJobs(TmpDirTestCase):
+    """ Test the asyncio runner of the external tools"""
+
+    def test_MediaRenderedConcurrently(self):
+        with benchmark.standInTools():
+            app = chord_generation.GenAnkiChords(['C', 'F'], ['M7'], ['FullStandardV'], asyncJobs=True,
+                                                 audioRenderer=audio_render.FluidSynthRenderer('missing.sf2'))
+            app.initDb()
+            results = app.addVoicings()
+        self.assertEqual({'CM7-FullStandardV.png': True, 'CM7-FullStandardV.mp3': True,
+                          'FM7-FullStandardV.png': True, 'FM7-FullStandardV.mp3': True}, results)
+        self.assertEqual([], app.asyncRunner.errors)
+        self.assertEqual(['CM7-FullStandardV-LH.png', 'CM7-FullStandardV-RH.png', 'CM7-FullStandardV.mp3',
+                          'CM7-FullStandardV.png', 'FM7-FullStandardV-LH.png', 'FM7-FullStandardV-RH.png',
+                          'FM7-FullStandardV.mp3', 'FM7-FullStandardV.png'], sorted(os.listdir('.')),
+                         "Scratch files should be removed")
+
+    def test_PipelineFeedsNextCommand(self):
+        runner = async_jobs.AsyncToolRunner()
+        runner.add('CM7', [[sys.executable, '-c', 'print("abc")'],
+                           [sys.executable, '-c', 'import sys; open("out.txt", "w").write(sys.stdin.read())']],
+                   'out.txt')
+        self.assertEqual({'out.txt': True}, runner.flush())
+        with open('out.txt') as f:
+            self.assertEqual('abc\n', f.read())
+
+    def test_StructuredErrors(self):
+        runner = async_jobs.AsyncToolRunner(timeout=0.5, retries=1, retryDelay=0.0)
+        runner.add('CM7', [[sys.executable, '-c', 'import sys; sys.exit("bad chord")']], 'a.png')
+        runner.add('Dm7', [[sys.executable, '-c', 'import time; time.sleep(5)']], 'b.png')
+        runner.add('G7', [['no-such-tool-genankichords']], 'c.png')
+        self.assertEqual({'a.png': False, 'b.png': False, 'c.png': False}, runner.flush())
+        errors = {error.item: error for error in runner.errors}
+        self.assertEqual(('failed', 1, 'bad chord', 2),
+                         (errors['CM7'].reason, errors['CM7'].returncode, errors['CM7'].stderr, errors['CM7'].attempts))
+        self.assertEqual(('timeout', 2), (errors['Dm7'].reason, errors['Dm7'].attempts))
+        self.assertEqual(('not found', 1), (errors['G7'].reason, errors['G7'].attempts))
+
+    def test_MissingPipelineCommand(self):
+        openFds = len(os.listdir('/proc/self/fd'))
+        runner = async_jobs.AsyncToolRunner(retryDelay=0.0)
+        runner.add('CM7', [[sys.executable, '-c', 'print("abc")'], ['no-such-tool-genankichords']], 'a.mp3')
+        runner.add('Dm7', [['no-such-tool-genankichords'], [sys.executable, '-c', 'pass']], 'b.mp3')
+        self.assertEqual({'a.mp3': False, 'b.mp3': False}, runner.flush())
+        self.assertEqual(['not found', 'not found'], [error.reason for error in runner.errors])
+        self.assertEqual(openFds, len(os.listdir('/proc/self/fd')), "No pipe end should be left open")
+
+
+class TestChordImport(TmpDirTestCase):
+    """ Test the streaming import of chord tables"""
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        for fileName in ['ChordsData.csv', 'ChordData.ods']:
+            shutil.copy(os.path.join(self.cwd, fileName), self.tmpDir)
+
+    def test_ImportCsvAndOds(self):
+        for fileName in ['ChordsData.csv', 'ChordData.ods']:
+            app = chord_generation.GenAnkiChords([], [], [])
+            importer = app.importDb(fileName)
+            self.assertEqual((240, 0), (importer.rowCount, importer.errorCount), fileName)
+            self.assertEqual(('F#', 'm7b5'), (app.chordsDb['F#m7b5'].root, app.chordsDb['F#m7b5'].quality))
+            self.assertIs(app.chordsDb['Adom7'].quality, app.chordsDb['Bdom7'].quality, "Qualities should be interned")
+
+    def test_MalformedRowsReported(self):
+        fileName = os.path.join(self.tmpDir, 'library.csv')
+        with open(fileName, 'w') as f:
+            f.write('SortId;Root;Quality;Rootless_V_Off_3rd\n'
+                    '1;C;M7;Mi Si\n'
+                    '2;H;M7;\n'
+                    'x;D;min 7;Fa Do\n'
+                    '4;E;sus9;\n'
+                    '5;F;7;La Zz\n'
+                    '6;G;7;Si Fa;extra\n')
+        importer = chord_import.ChordImporter()
+        chords = [(line, root, quality) for line, root, quality, inversion, row in importer.chords(fileName)]
+        self.assertEqual([(2, 'C', 'M7')], chords)
+        self.assertEqual([(3, 'Root'), (4, 'SortId'), (5, 'Quality'), (6, 'Rootless_V_Off_3rd'), (7, '-')],
+                         [(error.line, error.field) for error in importer.errors])
+        with self.assertRaises(chord_import.RowError):
+            list(chord_import.ChordImporter(strict=True).chords(fileName))
+
+    def test_InversionsImportedAsBassNotes(self):
+        for fileName in ['ChordsData.csv', 'ChordData.ods']:
+            app = chord_generation.GenAnkiChords([], [], ['FullStandardV'])
+            app.importDb(fileName)
+            app.addVoicings(['fullStandardVNotes'])
+            self.assertEqual(['E', 'G', 'B'], [app.chordsDb['CM7/' + bass].inversion for bass in ['E', 'G', 'B']])
+            self.assertEqual([('B', 3), ('C', 4), ('E', 4), ('G', 4)],
+                             [(note.name, note.octave)
+                              for note in app.chordsDb['CM7/B'].voicings['FullStandardV'].fullStandardVNotes])
+
+    def test_BadInversionReported(self):
+        fileName = os.path.join(self.tmpDir, 'library.csv')
+        with open(fileName, 'w') as f:
+            f.write('Root;Quality;Inversion\n'
+                    'C;M7;6 / 5\n'
+                    'C;M7;G\n'
+                    'C;M7;5\n'
+                    'C;M7;F\n')
+        importer = chord_import.ChordImporter()
+        self.assertEqual(['E', 'G'], [inversion for line, root, quality, inversion, row in importer.chords(fileName)])
+        self.assertEqual([(4, 'Inversion'), (5, 'Inversion')], [(error.line, error.field) for error in importer.errors])
+
+    def test_MissingRequiredColumn(self):
+        with self.assertRaises(chord_import.RowError):
+            list(chord_import.ChordImporter().chords('ChordData.ods', sheet='ChordData'))
+
+
+class TestNoteNames(unittest.TestCase):
+    """ Test the note-name translation tables"""
+
+    def test_Systems(self):
+        self.assertEqual(['Reb', 'Re♭', 'Des', 'Ré♭'],
+                         [note_names.translate('Db'), note_names.translate('Db', unicode=True),
+                          note_names.translate('Db', 'german'), note_names.translate('Db', 'french', True)])
+        self.assertEqual(['H', 'B', 'Heses', 'Fisis'], [note_names.translate(note, 'german')
+                                                       for note in ['B', 'Bb', 'Bbb', 'F##']])
+        self.assertEqual('Dodd', note_names.translate('C##'))
+
+    def test_EverySpellingRoundTrips(self):
+        for system in note_names.SYSTEMS:
+            for unicode in (False, True):
+                for spelling, name in note_names.NAMES[(system, unicode)].items():
+                    self.assertEqual(spelling, note_names.translate(name, 'english', False, system),
+                                     "{} should read back as {}".format(name, spelling))
+
+    def test_OldSpellingsAccepted(self):
+        self.assertEqual(['La♭', 'Do♯', 'Si♭'], [note_names.translate(note, unicode=True) for note in ['Af', 'Cs', 'Bf']])
+
+    def test_GlobalsKeepAsciiUnicodePairs(self):
+        settings = chord_generation.initGlobals()
+        engl2ItNotes, it2EnglNotes = settings[5], settings[6]
+        self.assertEqual(['Lab', 'La♭'], engl2ItNotes['Af'])
+        self.assertEqual(['Dod', 'Do♯'], engl2ItNotes['C#'])
+        self.assertEqual(['Ab', 'A♭'], it2EnglNotes['Lab'])
+
+    def test_BulkColumns(self):
+        importer = chord_import.ChordImporter()
+        rows = [row for line, row in importer.rows('ChordsData.csv')]
+        deck = chord_generation.AnkiDeck({}, '.')
+        deck.useProperMusicNotation(rows)
+        self.assertEqual(('La', 'Do♯ Sol', 'Sol Do♯'),
+                         (rows[0]['Root_it'], rows[0]['Rootless_V_Off_3rd'], rows[0]['Rootless_V_Off_7th']))
+        self.assertEqual('Do Mi Sib', note_names.translateField('C E Bb'))
+
+
+class TestChordVocabulary(unittest.TestCase):
+    """ Test the enumeration of the extended chord vocabulary"""
+
+    def test_SoundAlikesDropped(self):
+        keys = [chord.key for chord in chord_vocabulary.ChordVocabulary().chords()]
+        self.assertEqual(len(keys), len(set(keys)))
+        for kept, dropped in [('DbM7', 'C#M7'), ('C6', 'Am7/C'), ('Ebdim7', 'Cdim7/Eb'), ('BM7', 'CbM7')]:
+            self.assertIn(kept, keys)
+            self.assertNotIn(dropped, keys)
+
+    def test_SharedVoicingsKept(self):
+        chords = {chord.key: chord for chord in chord_vocabulary.ChordVocabulary(inversions=False).chords()}
+        self.assertEqual(('FullStandardV', 'ShellV'), chords['Cdom7'].voicings)
+        self.assertEqual(('FullStandardV', 'ShellV'), chords['C9'].voicings, "C9 keeps the shells it shares with C7")
+        self.assertEqual(('C', 'E', 'G#', 'Bb', 'Db', 'D#'), chord_spelling.chordSpelling('C', '7alt').notes)
+
+    def test_Range(self):
+        vocabulary = chord_vocabulary.ChordVocabulary(qualities=['M7'], voicings=['FullStandardV'], maxSpan=12)
+        self.assertEqual(['CM7/B'], [chord.key for chord in vocabulary.chords() if chord.root == 'C'])
+        self.assertEqual(vocabulary.counts['unique'] + vocabulary.counts['duplicates'] + vocabulary.counts['outOfRange'],
+                         vocabulary.counts['candidates'])
+
+    def test_FullSpaceIsFast(self):
+        start = time.perf_counter()
+        vocabulary = chord_vocabulary.ChordVocabulary()
+        chords = list(vocabulary.chords())
+        self.assertLess(time.perf_counter() - start, 1.0)
+        self.assertGreater(vocabulary.counts['duplicates'], 0)
+        self.assertEqual(len(chords), vocabulary.counts['unique'])
+
+    def test_EnumerateDb(self):
+        app = chord_generation.GenAnkiChords([], [], ['FullStandardV', 'ShellV'])
+        vocabulary = app.enumerateDb()
+        self.assertEqual(vocabulary.counts['unique'], len(app.chordsDb))
+        app.addVoicings(['fullStandardVNotes', 'shellVOff3rdNotes', 'shellVOff7thNotes'])
+        inverted = app.chordsDb['CM7/E']
+        self.assertEqual(['FullStandardV'], list(inverted.voicings))
+        self.assertEqual([('E', 3), ('C', 4), ('G', 4), ('B', 4)],
+                         [(n.name, n.octave) for n in inverted.voicings['FullStandardV'].fullStandardVNotes])
+        self.assertEqual('CM7-on-E', inverted.voicings['FullStandardV'].fileStem())
+
+
+class TestVoiceLeading(unittest.TestCase):
+    """ Test the voice leading of progressions"""
+
+    def test_GuideTonesIiVI(self):
+        leader = voice_leading.VoiceLeader('GuideTones')
+        leadSheet = leader.lead(voice_leading.progression('ii-V-I', 'C'))
+        self.assertEqual(2, leadSheet.movement)  # C -> B, then F -> E
+        self.assertEqual([['F3', 'C4'], ['F3', 'B3'], ['E3', 'B3']],
+                         [[n.name + str(n.octave) for n in bar] for bar in leader.notes(leadSheet)])
+
+    def test_OptimalPath(self):
+        leader = voice_leading.VoiceLeader('FourNotesShExt')
+        chords = voice_leading.progression('iii-VI-ii-V', 'E', 5)
+        candidates = [leader.candidates(root, quality)[0] for root, quality in chords]
+        bruteForce = min(sum(int(numpy.abs(a.astype(int) - b).sum()) for a, b in zip(path, path[1:]))
+                         for path in itertools.product(*candidates))
+        leadSheet = leader.lead(chords)
+        self.assertEqual(bruteForce, leadSheet.movement)
+        self.assertEqual(leadSheet.movement, sum(abs(a - b) for bar, nextBar in zip(leadSheet.pitches, leadSheet.pitches[1:])
+                                                 for a, b in zip(bar, nextBar)))
+
+    def test_SpellingFollowsTheKey(self):
+        leader = voice_leading.VoiceLeader('ShellV')
+        self.assertEqual([('Eb', 'm7'), ('Ab', 'dom7'), ('Db', 'M7'), ('Eb', 'm7')],
+                         voice_leading.progression('ii-V-I', 'Db', 4))
+        for bar, (root, quality) in zip(leader.notes(leader.lead(voice_leading.progression('minor ii-V-i', 'F#'))),
+                                        voice_leading.progression('minor ii-V-i', 'F#')):
+            self.assertEqual(root, bar[0].name)
+
+    def test_ClearErrors(self):
+        with self.assertRaisesRegex(ValueError, 'no chords'):
+            voice_leading.VoiceLeader('ShellV').lead([])
+        with self.assertRaisesRegex(ValueError, 'GuideTones voicing of Dm7 fits in the register 60-64'):
+            voice_leading.VoiceLeader('GuideTones', 60, 64).lead(voice_leading.progression('ii-V-I', 'C'))
+
+    def test_AllKeysAreFast(self):
+        app = chord_generation.GenAnkiChords([], [], ['ShellV', 'GuideTones', 'FourNotesShExt'])
+        start = time.perf_counter()
+        leadSheets = app.leadProgressions(list(voice_leading.PROGRESSIONS), 16)
+        self.assertLess(time.perf_counter() - start, 1.0)
+        self.assertEqual(len(voice_leading.PROGRESSIONS) * 3, len(leadSheets))
+        for keys in leadSheets.values():
+            self.assertEqual(voice_leading.KEYS, list(keys))
+            self.assertTrue(all(len(leadSheet.pitches) == 16 for leadSheet in keys.values()))
+
+
+class TestFingering(unittest.TestCase):
+    """ Test the fingering of the voicings"""
+
+    def test_HandSpans(self):
+        self.assertEqual((1, 3, 5), fingering.handFingering([64, 67, 71], 'RH'))
+        self.assertEqual((5, 3, 1), fingering.handFingering([40, 43, 47], 'LH'))
+        self.assertEqual((5, 1), fingering.handFingering([36, 48], 'LH'))
+        self.assertIsNone(fingering.handFingering([48, 55, 64], 'LH'), "A tenth and more is out of reach")
+
+    def test_FullStandardV(self):
+        voicing = chord_generation.Voicing('C', 'M7')
+        self.assertEqual({'LH': '1', 'RH': '1 3 5'}, voicing.fullStandardVFingering)
+        self.assertIn("<e'-1 g'-3 b'-5>1", voicing.fullStandardVLilyPond)
+        self.assertIn("<c-1>1", voicing.fullStandardVLilyPond)
+        self.assertIn("<c'-1 ef'-2 gf'-4>1", chord_generation.Voicing('Ab', 'dom7').fullStandardVLilyPond)
+        self.assertIn("<fs-1>1", chord_generation.Voicing('F#', 'm7').fullStandardVLilyPond)
+        self.assertEqual({'LH': '2 1', 'RH': ''}, voicing.shellVOff3rdFingering)
+
+    def test_ShapesAreShared(self):
+        fingering.shapeFingering.cache_clear()
+        app = chord_generation.GenAnkiChords([], [], ['FullStandardV', 'ShellV'])
+        app.enumerateDb()
+        app.addVoicings(['fullStandardVFingering', 'shellVOff3rdFingering', 'shellVOff7thFingering'])
+        solved = fingering.shapeFingering.cache_info()
+        self.assertLess(solved.currsize, (solved.hits + solved.misses) / 3)
+
+
+class TestKeyboardDiagram(TmpDirTestCase):
+    """ Test the keyboard diagrams"""
+
+    def readPng(self, fileName):
+        """(width, height, rows of RGB pixels) of a png written by keyboard_diagram.writePng"""
+        with open(fileName, 'rb') as f:
+            data = f.read()
+        self.assertEqual(b'\x89PNG\r\n\x1a\n', data[:8])
+        width, height = struct.unpack('>II', data[16:24])
+        length = struct.unpack('>I', data[33:37])[0]
+        self.assertEqual(b'IDAT', data[37:41])
+        rows = numpy.frombuffer(zlib.decompress(data[41:41 + length]), dtype=numpy.uint8).reshape(height, -1)
+        return width, height, rows[:, 1:].reshape(height, width, 3)
+
+    def test_KeysHighlighted(self):
+        diagram = keyboard_diagram.KeyboardDiagram()
+        diagram.writeDiagram('c.png', [60, 61], [1, 2], 'RH')
+        width, height, pixels = self.readPng('c.png')
+        self.assertEqual(diagram.base.shape, (height, width, 3))
+        self.assertTrue((pixels == diagram.render([60, 61], [1, 2])).all())
+        colored = (pixels == keyboard_diagram.HAND_COLORS['RH']).all(axis=2).ravel()
+        glyphs = (pixels == keyboard_diagram.GLYPH_COLOR).all(axis=2).ravel()
+        for pitch in (60, 61):
+            self.assertTrue((colored | glyphs)[diagram.masks[pitch]].all(), "The whole key should be highlighted")
+            self.assertTrue(glyphs[diagram.masks[pitch]].any(), "The finger number should be drawn on the key")
+        inKeys = numpy.zeros(width * height, dtype=bool)
+        inKeys[numpy.concatenate([diagram.masks[60], diagram.masks[61]])] = True
+        self.assertFalse((pixels != diagram.base).any(axis=2).ravel()[~inKeys].any(), "Other keys should be untouched")
+
+    def test_Fast(self):
+        diagram = keyboard_diagram.keyboardDiagram()
+        start = time.perf_counter()
+        for i in range(100):
+            diagram.writeDiagram('d.png', [48, 64, 67, 71], [1, 1, 3, 5])
+        self.assertLess((time.perf_counter() - start) / 100, 0.01)
+
+    def test_VoicingFields(self):
+        voicing = chord_generation.Voicing('C', 'M7')
+        self.assertEqual({'LH': '<img src="CM7-FullStandardV-LH.png"\\>', 'RH': '<img src="CM7-FullStandardV-RH.png"\\>'},
+                         voicing.fullStandardVKeyboard)
+        self.assertEqual('', voicing.shellVOff7thKeyboard['RH'])
+        self.assertEqual(['CM7-FullStandardV-LH.png', 'CM7-FullStandardV-RH.png', 'CM7-ShellVOff7th-LH.png'],
+                         voicing.mediaFiles())
+        self.assertEqual(('ShellV', 'shellVOff3rdKeyboard'),
+                         card_fields.fieldArtifact('Rootless_V_Off_3rd_RH', chord_generation.Voicing.voicingArtifacts))
+
+    def test_DiagramsCached(self):
+        cache = media_cache.MediaCache('cache')
+        first = chord_generation.Voicing('C', 'M7', mediaCache=cache).fullStandardVKeyboard
+        os.remove('CM7-FullStandardV-LH.png')
+        self.assertEqual(first, chord_generation.Voicing('C', 'M7', mediaCache=cache).fullStandardVKeyboard)
+        self.assertEqual((2, 2), (cache.hits, cache.misses), "The second voicing should fetch both diagrams")
+        self.assertTrue(os.path.isfile('CM7-FullStandardV-LH.png'), "A cached diagram should be fetched")
+
+
+class TestMultiDeck(TmpDirTestCase):
+    """ Test building several decks from one generation pass"""
+    keyboardTemplates = [{'name': 'Keys', 'qfmt': '{{Name}}', 'afmt': '{{FrontSide}}{{Rootless_V_Off_7th_LH}}'}]
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        shutil.copy(os.path.join(self.cwd, 'ChordsData.csv'), self.tmpDir)
+
+    def readDeck(self, fileName):
+        """(field values of each note, media names) of an .apkg"""
+        with zipfile.ZipFile(fileName) as apkg:
+            media = sorted(json.loads(apkg.read('media').decode('utf-8')).values())
+            with open('collection.anki2', 'wb') as f:
+                f.write(apkg.read('collection.anki2'))
+        connection = sqlite3.connect('collection.anki2')
+        try:
+            rows = connection.execute('select flds from notes').fetchall()
+        finally:
+            connection.close()
+        os.remove('collection.anki2')
+        return [flds.split('\x1f') for flds, in rows], media
+
+    def test_UnionRenderedOnce(self):
+        tracer = build_trace.BuildTracer()
+        app = chord_generation.GenAnkiChords(['C', 'F', 'G'], ['M7', 'dom7'], ['FullStandardV', 'ShellV'],
+                                             tracer=tracer)
+        decks = [multi_deck.DeckDefinition('All', chord_generation.AnkiDeck.deckId, fileName='all.apkg'),
+                 multi_deck.DeckDefinition('Beginner', 11, roots=['C'], fileName='beginner.apkg'),
+                 multi_deck.DeckDefinition('Keys', 12, qualities=['dom7'], templates=self.keyboardTemplates,
+                                           fileName='keys.apkg'),
+                 multi_deck.DeckDefinition('Guide tones', 13, voicings=['GuideTones'], fileName='guide.apkg')]
+        written = multi_deck.MultiDeckBuild(app, decks).run()
+        self.assertEqual({'all.apkg': 6, 'beginner.apkg': 2, 'keys.apkg': 3, 'guide.apkg': 6}, written)
+        build = multi_deck.MultiDeckBuild(app, decks)
+        build.prepare()
+        self.assertEqual(['ShellV'], build.voicings, "Voicings no deck shows should not be generated")
+        self.assertEqual(['FullStandardV', 'ShellV'], app.voicings, "The app should keep its own voicings")
+        self.assertEqual([['ShellV']] * 6, [list(chordItem.voicings) for chordItem in app.chordsDb.values()])
+        self.assertEqual([], app.chordsDb['CM7'].voicingsNeeded)
+        self.assertEqual(6, tracer.summary()['voicing']['count'], "Each chord should be voiced once for all decks")
+        notes, media = self.readDeck('beginner.apkg')
+        self.assertEqual(['C-M7', 'C-dom7'], [fields[1] for fields in notes])
+        self.assertEqual([], media)
+        notes, media = self.readDeck('keys.apkg')
+        self.assertEqual(['SortId', 'Name', 'Root', 'Root_it', 'Quality', 'Inversion', 'Rootless_V_Off_7th_LH'],
+                         multi_deck.MultiDeckBuild(app, decks).deckFields(decks[2]))
+        self.assertEqual(['Cdom7-ShellVOff7th-LH.png', 'Fdom7-ShellVOff7th-LH.png', 'Gdom7-ShellVOff7th-LH.png'], media)
+        allNotes, media = self.readDeck('all.apkg')
+        guideNotes, media = self.readDeck('guide.apkg')
+        self.assertTrue(all(fields[6] for fields in allNotes), "Rootless fields should be filled")
+        self.assertEqual([''] * 8, guideNotes[0][6:], "Only guide tones are shown, and no voicing fills them yet")
+
+    def test_NoteIdsPerDeck(self):
+        app = chord_generation.GenAnkiChords(['C'], ['M7'], ['ShellV'])
+        main = multi_deck.DeckDefinition('Main', chord_generation.AnkiDeck.deckId)
+        other = multi_deck.DeckDefinition('Other', 21)
+        build = multi_deck.MultiDeckBuild(app, [main, other])
+        build.prepare()
+        mainNote, = build.deckNotes(main)
+        otherNote, = build.deckNotes(other)
+        self.assertEqual(genanki.guid_for('C-M7', 'C'), mainNote.guid, "The main deck should keep its note ids")
+        self.assertNotEqual(mainNote.guid, otherNote.guid)
+        self.assertNotEqual(main.modelId, other.modelId)
+        self.assertEqual('Do', mainNote.fields[3])
+
+
+class TestStreamingAudio(TmpDirTestCase):
+    """ Test the fluidsynth to encoder pipe"""
+    renderer = audio_render.FluidSynthRenderer('FluidR3_GM.sf2')
+
+    def test_SynthWritesPcmToStdout(self):
+        command = self.renderer.synthCommand('chord.mid')
+        self.assertEqual('-', command[command.index('-F') + 1], "fluidsynth should render to stdout")
+        self.assertEqual('raw', command[command.index('-T') + 1])
+
+    def test_EncoderReadsStdin(self):
+        command = self.renderer.encoderCommand('CM7.mp3')
+        self.assertEqual('pipe:0', command[command.index('-i') + 1], "The encoder should read from the pipe")
+        self.assertEqual('CM7.mp3', command[-1])
+
+    def test_NoTemporaryFilesLeft(self):
+        bar = mBar()
+        bar.place_notes(mNote_container([mNote('C', 3), mNote('E', 4)]), 1)
+        self.renderer.renderBar(bar, os.path.join(self.tmpDir, 'CM7.mp3'), scratchDir=self.tmpDir)
+        leftOver = [f for f in os.listdir(self.tmpDir) if not f.endswith('.mp3')]
+        self.assertEqual([], leftOver, "Only the mp3 file should touch the disk")
+
+
+class TestWarmAudioRenderer(unittest.TestCase):
+    """ Test the pieces of the warm synth renderer that do not need fluidsynth"""
+
+    def test_BarEvents(self):
+        bar = mBar()
+        bar.place_notes(mNote_container([mNote('C', 3), mNote('E', 4)]), 2)
+        bar.place_rest(2)
+        events = audio_render.barEvents(bar, bpm=80)
+        self.assertEqual(1, len(events), "Rests should not produce events")
+        start, end, notes = events[0]
+        self.assertEqual((0.0, 1.5), (start, end), "A half note at 80 bpm lasts 1.5 seconds")
+        self.assertEqual([48, 64], sorted(pitch for pitch, velocity, channel in notes),
+                         "C-3 and E-4 should be MIDI pitches 48 and 64")
+
+    def test_DefaultRendererIsShared(self):
+        self.assertIs(chord_generation.Voicing('C', 'M7').audioRenderer, chord_generation.Voicing('D', 'm7').audioRenderer,
+                      "All voicings should share the same (warm) renderer")
+
+
+class TestAudioReel(TmpDirTestCase):
+    """ Test the queuing and slicing of the single-pass audio reel"""
+
+    def test_VoicingQueuesBar(self):
+        reel = audio_render.AudioReel()
+        voicing = chord_generation.Voicing('C', 'M7', audioReel=reel)
+        self.assertEqual('<snd src="CM7-FullStandardV.mp3" \\>', voicing.genFullStandardVMp3())
+        self.assertEqual(['CM7-FullStandardV.mp3'], [job[1] for job in reel.pending],
+                         "Clip names should match the per-chord mp3 names")
+
+    def test_SampleAccurateOffsets(self):
+        reel = audio_render.AudioReel()
+        bar = mBar()
+        bar.place_notes(mNote_container([mNote('C', 3)]), 1)
+        offsets = reel.clipOffsets([bar, bar, bar], bpm=80)
+        # a whole note plus a whole rest at 80 bpm: 6 seconds of 16 bit stereo
+        self.assertEqual([0, 6 * 44100 * 4, 12 * 44100 * 4, 18 * 44100 * 4], offsets)
+
+    def test_SlicesStream(self):
+        reel = audio_render.AudioReel()
+        reel.readSize = 3
+        stream = io.BytesIO(b'abcdefgh')
+        reel.renderer = audio_render.FluidSynthRenderer()
+        reel.renderer.encoderCommand = lambda mp3FileOut: [sys.executable, '-c',
+                                                            'import sys; sys.stdout.buffer.write(sys.stdin.buffer.read())']
+        self.assertTrue(reel.encodeClip(stream, 5, os.devnull))
+        self.assertEqual(b'fgh', stream.read(), "Each clip should consume exactly its own bytes")
+        self.assertFalse(reel.encodeClip(stream, 5, os.devnull), "A clip cut short by the synth should fail")
+
+    def test_LastClipComplete(self):
+        bar = mBar()
+        bar.place_notes(mNote_container([mNote('C', 3)]), 1)
+        with benchmark.standInTools():
+            # the stand-in synth plays the mingus-written reel for as long as its MIDI file lasts
+            reel = audio_render.AudioReel(audio_render.FluidSynthRenderer('missing.sf2'))
+            for name in ['a.mp3', 'b.mp3']:
+                reel.add(bar, name, 80)
+            self.assertEqual({'a.mp3': True, 'b.mp3': True}, reel.flush(),
+                             "The closing rest the MIDI file leaves out should not fail the last clip")
+        self.assertEqual(os.path.getsize('a.mp3'), os.path.getsize('b.mp3'), "Both clips should be whole")
+
+    def test_FailedSynthNotCached(self):
+        cache = media_cache.MediaCache(os.path.join(self.tmpDir, 'cache'))
+        bar = mBar()
+        bar.place_notes(mNote_container([mNote('C', 3)]), 1)
+        clipBytes = 6 * 44100 * 4
+        for synthOutput, expected in [('bytes(2 * %d)); sys.exit(1' % clipBytes, [False, False]),
+                                      ('bytes(%d)' % clipBytes, [True, False])]:
+            reel = audio_render.AudioReel()
+            reel.renderer = audio_render.FluidSynthRenderer()
+            reel.renderer.synthCommand = lambda midiFile: [
+                sys.executable, '-c', 'import sys; sys.stdout.buffer.write(' + synthOutput + ')']
+            reel.renderer.encoderCommand = lambda mp3FileOut: [
+                sys.executable, '-c', 'import sys; open(sys.argv[1], "wb").write(sys.stdin.buffer.read())',
+                mp3FileOut]
+            for name in ['a.mp3', 'b.mp3']:
+                fileOut = os.path.join(self.tmpDir, name)
+                reel.add(bar, fileOut, 80,
+                         lambda fileOut, success: success and cache.store(media_cache.renderKey(fileOut), fileOut))
+            results = reel.flush()
+            self.assertEqual(expected, [results[os.path.join(self.tmpDir, name)] for name in ['a.mp3', 'b.mp3']])
+            self.assertEqual(expected, [os.path.exists(os.path.join(self.tmpDir, name)) for name in ['a.mp3', 'b.mp3']],
+                             "A failed clip should not be left on disk")
+        self.assertEqual(1, cache.stats()['files'], "Only the complete clip of a clean synth run should be cached")
+
+
+def writeTinySoundFont(fileName, rootKey=69, frames=1000, globalZone=False):
+    """
+    Write a one-preset, one-sample (looped sine) SoundFont 2 file for the synth tests.
+    With globalZone the loop mode and a -1 (no override) root key are in the instrument's global zone.
+    """
+    def chunk(chunkId, data):
+        return struct.pack('<4sI', chunkId, len(data)) + data + b'\x00' * (len(data) & 1)
+    wave = (numpy.sin(2 * numpy.pi * 440 * numpy.arange(frames) / 44100) * 10000).astype('<i2').tobytes()
+    pdta = b''.join([
+        chunk(b'phdr', struct.pack('<20sHHHIII', b'Piano', 0, 0, 0, 0, 0, 0) + struct.pack('<20sHHHIII', b'EOP', 0, 0, 1, 0, 0, 0)),
+        chunk(b'pbag', struct.pack('<HH', 0, 0) + struct.pack('<HH', 1, 0)),
+        chunk(b'pmod', bytes(10)),
+        chunk(b'pgen', struct.pack('<HH', 41, 0) + struct.pack('<HH', 0, 0)),
+        chunk(b'inst', struct.pack('<20sH', b'Piano', 0) + struct.pack('<20sH', b'EOI', 2 if globalZone else 1)),
+        chunk(b'ibag', struct.pack('<HH', 0, 0) + struct.pack('<HH', 2, 0) + struct.pack('<HH', 3, 0) if globalZone
+              else struct.pack('<HH', 0, 0) + struct.pack('<HH', 2, 0)),
+        chunk(b'imod', bytes(10)),
+        chunk(b'igen', struct.pack('<HH', 54, 1) + struct.pack('<Hh', 58, -1) + struct.pack('<HH', 53, 0)
+              + struct.pack('<HH', 0, 0) if globalZone
+              else struct.pack('<HH', 54, 1) + struct.pack('<HH', 53, 0) + struct.pack('<HH', 0, 0)),
+        chunk(b'shdr', struct.pack('<20sIIIIIBbHH', b'Sine', 0, frames, 100, 900, 44100, rootKey, 0, 0, 1)
+              + struct.pack('<20sIIIIIBbHH', b'EOS', 0, 0, 0, 0, 0, 0, 0, 0, 0))])
+    body = b'sfbk' + chunk(b'LIST', b'sdta' + chunk(b'smpl', wave)) + chunk(b'LIST', b'pdta' + pdta)
+    with open(fileName, 'wb') as f:
+        f.write(b'RIFF' + struct.pack('<I', len(body)) + body)
+
+
+class TestNumpySynth(TmpDirTestCase):
+    """ Test the NumPy sample-based chord synthesizer on a tiny generated soundfont"""
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        self.soundFont = os.path.join(self.tmpDir, 'tiny.sf2')
+        writeTinySoundFont(self.soundFont)
+        self.renderer = numpy_synth.NumpySynthRenderer(self.soundFont)
+
+    def tearDown(self):
+        self.renderer.font = None
+        TmpDirTestCase.tearDown(self)
+
+    def test_FindsSample(self):
+        data, sampleRate, rootKey, loopStart, loopEnd = numpy_synth.SoundFontSamples(self.soundFont).findSample(60)
+        self.assertEqual((1000, 44100, 69, 100, 900), (len(data), sampleRate, rootKey, loopStart, loopEnd))
+
+    def test_GlobalZoneDefaults(self):
+        soundFont = os.path.join(self.tmpDir, 'global.sf2')
+        writeTinySoundFont(soundFont, globalZone=True)
+        font = numpy_synth.SoundFontSamples(soundFont)
+        self.assertEqual(1, len(font.zones), "The global zone is not a sample zone")
+        data, sampleRate, rootKey, loopStart, loopEnd = font.findSample(60)
+        # the loop mode comes from the global zone, the signed -1 root key falls back to the sample's pitch
+        self.assertEqual((69, 100, 900), (rootKey, loopStart, loopEnd))
+
+    def test_RendersChord(self):
+        bar = mBar()
+        bar.place_notes(mNote_container([mNote('C', 3), mNote('E', 4), mNote('G', 4)]), 1)
+        pcm = self.renderer.renderPcm(bar, bpm=80)
+        # a whole note at 80 bpm plus one second of release, 16 bit stereo
+        self.assertEqual((3 + 1) * 44100 * 4, len(pcm))
+        samples = numpy.frombuffer(pcm, dtype='<i2')
+        self.assertEqual(int(0.9 * 32767), numpy.abs(samples).max(), "The mix should be normalized")
+        self.assertEqual(3, len(self.renderer.noteCache), "One cached note per pitch")
+
+
+class TestIncrementalBuild(TmpDirTestCase):
+    """ Test that rebuilds only regenerate voicings whose inputs changed"""
+
+    def build(self, qualities):
+        graph = build_graph.BuildGraph(self.tmpDir)
+        app = chord_generation.GenAnkiChords(['C', 'F'], qualities, ['ShellV'], buildGraph=graph,
+                                             audioRenderer=audio_render.FluidSynthRenderer('missing.sf2'))
+        app.initDb()
+        app.addVoicings()
+        return app, graph
+
+    def test_SecondBuildIsClean(self):
+        self.build(['M7'])
+        app, graph = self.build(['M7', 'm7'])
+        self.assertEqual({'voicings': 2}, graph.rebuilt, "Only the two new chords should be generated")
+        self.assertEqual(app.chordsDb['CM7'].voicings['ShellV'].shellVOff3rdLilypond,
+                         chord_generation.Voicing('C', 'M7').genShellVOff3rdLilyPond())
+
+    def test_ChangedFingerprintIsDirty(self):
+        graph = build_graph.BuildGraph(self.tmpDir)
+        graph.record('voicings', 'CM7/ShellV', 'abc')
+        self.assertFalse(graph.isDirty('voicings', 'CM7/ShellV', 'abc'))
+        self.assertTrue(graph.isDirty('voicings', 'CM7/ShellV', 'abd'))
+        graph.record('voicings', 'CM7/ShellV', 'abc', [os.path.join(self.tmpDir, 'missing.png')])
+        self.assertTrue(graph.isDirty('voicings', 'CM7/ShellV', 'abc'), "Missing outputs should make an item dirty")
+
+    def test_UnchangedPackageNotRewritten(self):
+        deck = chord_generation.AnkiDeck({}, self.tmpDir, buildGraph=build_graph.BuildGraph(self.tmpDir))
+        deck.ankiNotes = [chord_generation.ChordNote(model=TestDeltaDeck.model, fields=['1', 'C-M7', ''])]
+        self.assertTrue(deck.writePackage(deck.ankiNotes, 'deck.apkg'))
+        self.assertFalse(deck.writePackage(deck.ankiNotes, 'deck.apkg'), "An unchanged package should not be rewritten")
+        deck.ankiNotes[0].fields[1] = 'C-Maj7'
+        self.assertTrue(deck.writePackage(deck.ankiNotes, 'deck.apkg'))
+        os.remove('deck.apkg')
+        self.assertTrue(deck.writePackage(deck.ankiNotes, 'deck.apkg'), "A missing package should be written again")
+
+    def test_ReelRendererInFingerprint(self):
+        app = chord_generation.GenAnkiChords(['C'], ['M7'], ['ShellV'], audioReel=True,
+                                             audioRenderer=audio_render.FluidSynthRenderer('missing.sf2'))
+        app.initDb()
+        reelKey = app.voicingFingerprint(app.chordsDb['CM7'], 'ShellV')
+        app.audioReel.renderer.sampleRate = 22050
+        self.assertNotEqual(reelKey, app.voicingFingerprint(app.chordsDb['CM7'], 'ShellV'),
+                            "The fingerprint should follow the renderer that writes the reel's mp3s")
+
+    def test_HelpersInFingerprint(self):
+        source = chord_generation.Voicing.definitionSource('ShellV')
+        for helper in ['def barToMp3', 'def keyboardFields', 'def shapeFingering', 'def writePng', 'def chordSpelling']:
+            self.assertIn(helper, source, "Editing a helper should dirty the voicings")
+        self.assertNotIn('def genFullStandardVPng', source)
+
+    def test_FailedRenderNotRecorded(self):
+        lilyPondCmd = lilypond_batch.LilyPondBatch.lilyPondCmd
+        lilypond_batch.LilyPondBatch.lilyPondCmd = ['no-such-tool-genankichords']
+        try:
+            graph = build_graph.BuildGraph(self.tmpDir)
+            app = chord_generation.GenAnkiChords(['C'], ['M7'], ['FullStandardV'], buildGraph=graph)
+            app.initDb()
+            app.addVoicings(['fullStandardVPng'])
+        finally:
+            lilypond_batch.LilyPondBatch.lilyPondCmd = lilyPondCmd
+        self.assertEqual({}, graph.rebuilt, "A voicing whose png was not written should not be recorded as clean")
+
+
+class TestDeltaDeck(TmpDirTestCase):
+    """ Test the package writer and the update package with only new or changed notes"""
+    model = genanki.Model(1607392319, 'Test', fields=[{'name': 'SortId'}, {'name': 'Name'}, {'name': 'Image'}],
+                          templates=[{'name': 'Card', 'qfmt': '{{Name}}', 'afmt': '{{Image}}'}])
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        for name in ['CM7.png', 'Dm7.png']:
+            with open(name, 'wb') as f:
+                f.write(name.encode('ascii'))
+        self.deck = chord_generation.AnkiDeck({}, self.tmpDir)
+        self.deck.ankiNotes = [chord_generation.ChordNote(model=self.model, fields=['1', 'C-M7', '<img src="CM7.png">']),
+                               chord_generation.ChordNote(model=self.model, fields=['2', 'D-m7', '<img src="Dm7.png">'])]
+        self.deck.saveDeck()
+
+    def test_UnchangedDeckGivesEmptyUpdate(self):
+        self.assertEqual([], self.deck.saveDeltaDeck())
+
+    def test_MediaStoredCollectionDeflated(self):
+        with zipfile.ZipFile(self.deck.fileName) as apkg:
+            compression = {info.filename: info.compress_type for info in apkg.infolist()}
+        self.assertEqual(zipfile.ZIP_DEFLATED, compression['collection.anki2'])
+        self.assertEqual(zipfile.ZIP_STORED, compression['0'], "Already compressed media should not be deflated again")
+
+    def test_OnlyChangedNoteAndMedia(self):
+        self.deck.ankiNotes[1].fields[0] = '3'
+        with open('Dm7.png', 'wb') as f:
+            f.write(b'new engraving')
+        changed = self.deck.saveDeltaDeck()
+        self.assertEqual(['D-m7'], [note.fields[1] for note in changed])
+        with zipfile.ZipFile(self.deck.updateFileName) as apkg:
+            self.assertEqual(['Dm7.png'], list(json.loads(apkg.read('media')).values()))
+
+
 class TestChordItemGen(unittest.TestCase):
     """ Test correct generation of a ChordItem"""
     testRoot = 'C'
@@ -81,6 +979,189 @@ class TestChordItemGen(unittest.TestCase):
         self.chordItem.addSortId()
         self.assertEqual(self.sortId, self.chordItem.sortId, "Each ChordItem must have a correct sortId")
 
+    def test_InversionIsAChordTone(self):
+        chordItem = chord_generation.ChordItem('C', 'M7', inversion='E')
+        self.assertEqual('C-M7/E', chordItem.name)
+        with self.assertRaisesRegex(ValueError, 'F is not a note of CM7'):
+            chord_generation.ChordItem('C', 'M7', inversion='F')
+
+class TestMediaCache(TmpDirTestCase):
+    """ Test the content-addressed media store"""
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        self.cache = media_cache.MediaCache(os.path.join(self.tmpDir, 'cache'), maxBytes=8)
+        self.fileOut = os.path.join(self.tmpDir, 'CM7-FullStandardV.png')
+
+    def render(self, content=b'12345'):
+        with open(self.fileOut, 'wb') as f:
+            f.write(content)
+        return True
+
+    def test_MissThenHit(self):
+        key = media_cache.renderKey('png', 'some lilypond')
+        self.assertTrue(self.cache.getOrRender(key, self.fileOut, self.render))
+        os.remove(self.fileOut)
+        self.assertTrue(self.cache.getOrRender(key, self.fileOut, lambda: self.fail("should not render again")))
+        self.assertTrue(os.path.exists(self.fileOut), "A hit should copy the stored file out")
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+
+    def test_KeyDependsOnInputs(self):
+        self.assertNotEqual(media_cache.renderKey('mp3', [60, 64], 80), media_cache.renderKey('mp3', [60, 64], 90),
+                            "Changing the bpm should change the render key")
+
+    def test_LruEviction(self):
+        self.render()
+        self.cache.store('aa', self.fileOut)
+        os.utime(self.cache.blobPath('aa', '.png'), (0, 0))
+        self.cache.store('bb', self.fileOut)
+        self.assertFalse(os.path.exists(self.cache.blobPath('aa', '.png')), "Oldest file should be evicted")
+        self.assertTrue(os.path.exists(self.cache.blobPath('bb', '.png')))
+
+    def test_Invalidate(self):
+        self.render()
+        self.cache.store('aa', self.fileOut)
+        self.assertEqual(1, self.cache.invalidate())
+        self.assertEqual(0, self.cache.stats()['files'])
+        self.assertEqual(0, self.cache.totalBytes)
+
+    def test_FailedRenderNotStored(self):
+        key = media_cache.renderKey('png', 'broken lilypond')
+        self.render(b'stale')  # left over by an earlier run
+        self.assertFalse(self.cache.getOrRender(key, self.fileOut, lambda: False))
+        # mingus' to_png returns True even when lilypond fails to write the png
+        self.assertTrue(self.cache.getOrRender(key, self.fileOut, lambda: True))
+        self.assertEqual(0, self.cache.stats()['files'], "Only a successful render should be stored")
+        self.assertFalse(os.path.exists(self.fileOut), "The stale file should not pass for the render")
+
+
+class TestLilyPondBatch(TmpDirTestCase):
+    """ Test the queuing and chunking of batched lilypond compilation"""
+
+    def test_VoicingQueuesPng(self):
+        batch = lilypond_batch.LilyPondBatch()
+        voicing = chord_generation.Voicing('C', 'M7', lilyPondBatch=batch)
+        self.assertEqual('<img src="CM7-FullStandardV.png"\\>', voicing.genFullStandardVPng())
+        self.assertEqual(['CM7-FullStandardV.png'], [job[1] for job in batch.pending],
+                         "In batch mode the png should be queued, not engraved")
+
+    def test_ChunkedCommands(self):
+        batch = lilypond_batch.LilyPondBatch(maxFilesPerCall=2)
+        for name in ['a', 'b', 'c']:
+            batch.add('{ c1 }', name + '.png')
+        chunks = batch.commands('/tmp/scratch')
+        self.assertEqual(2, len(chunks), "Three snippets with two files per call need two lilypond calls")
+        self.assertEqual(['a.png', 'b.png'], [job[2] for job in chunks[0][1]])
+        self.assertEqual(chunks[1][1][0][0], chunks[1][0][-1], "Each command should list its own .ly files")
+
+    def test_SameImageBatchedOrNot(self):
+        with benchmark.standInTools():
+            chord_generation.Voicing('C', 'M7').genFullStandardVPng()
+            os.rename('CM7-FullStandardV.png', 'single.png')
+            batch = lilypond_batch.LilyPondBatch()
+            chord_generation.Voicing('C', 'M7', lilyPondBatch=batch).genFullStandardVPng()
+            batch.flush()
+        with open('single.png', 'rb') as single, open('CM7-FullStandardV.png', 'rb') as batched:
+            self.assertEqual(single.read(), batched.read(), "Both paths should run the same lilypond command")
+        self.assertEqual(['CM7-FullStandardV.png', 'single.png'], sorted(os.listdir('.')))
+
+
+class TestMediaDedup(unittest.TestCase):
+    """ Test that enharmonic and identical renders share one file"""
+
+    def test_EnharmonicRootsShareMp3(self):
+        dedup = media_cache.MediaDedup()
+        reel = audio_render.AudioReel()
+        gbTag = chord_generation.Voicing('Gb', 'M7', mediaDedup=dedup, audioReel=reel).genFullStandardVMp3()
+        fsTag = chord_generation.Voicing('F#', 'M7', mediaDedup=dedup, audioReel=reel).genFullStandardVMp3()
+        self.assertEqual(gbTag, fsTag, "F#M7 should link to the GbM7 mp3")
+        self.assertEqual(1, len(reel.pending), "Enharmonic chords should be synthesized once")
+        chord_generation.Voicing('G', 'M7', mediaDedup=dedup, audioReel=reel).genFullStandardVMp3()
+        self.assertEqual(2, len(reel.pending))
+
+    def test_IdenticalEngravingSharesPng(self):
+        dedup = media_cache.MediaDedup()
+        batch = lilypond_batch.LilyPondBatch()
+        chord_generation.Voicing('C', '6', mediaDedup=dedup, lilyPondBatch=batch).genFullStandardVPng()
+        # Am7 over C is engraved (and fingered) exactly as C6
+        tag = chord_generation.Voicing('A', 'm7', 'C', mediaDedup=dedup, lilyPondBatch=batch).genFullStandardVPng()
+        self.assertEqual('<img src="C6-FullStandardV.png"\\>', tag)
+        self.assertEqual(1, len(batch.pending))
+
+    def test_FailedRenderNotShared(self):
+        class FailingRenderer(audio_render.FluidSynthRenderer):
+            subprocessPipeline = False
+
+            def renderBar(self, bar, mp3FileOut, bpm=80, scratchDir='.'):
+                return False
+        dedup = media_cache.MediaDedup()
+        renderer = FailingRenderer()
+        chord_generation.Voicing('Gb', 'M7', mediaDedup=dedup, audioRenderer=renderer).genFullStandardVMp3()
+        chord_generation.Voicing('F#', 'M7', mediaDedup=dedup, audioRenderer=renderer).genFullStandardVMp3()
+        self.assertEqual(['GbM7-FullStandardV.mp3', 'F#M7-FullStandardV.mp3'], dedup.failed,
+                         "F#M7 should render again rather than link to the missing GbM7 mp3")
+
+    def test_FailedBatchForgotten(self):
+        dedup = media_cache.MediaDedup()
+        batch = lilypond_batch.LilyPondBatch()
+        chord_generation.Voicing('C', '6', mediaDedup=dedup, lilyPondBatch=batch).genFullStandardVPng()
+        batch.pending[0][2]('C6-FullStandardV.png', False)  # what the flush reports when lilypond fails
+        tag = chord_generation.Voicing('A', 'm7', 'C', mediaDedup=dedup, lilyPondBatch=batch).genFullStandardVPng()
+        self.assertEqual('<img src="Am7-on-C-FullStandardV.png"\\>', tag)
+        self.assertEqual(['C6-FullStandardV.png'], dedup.failed)
+
+    def test_RendererInKey(self):
+        dedup = media_cache.MediaDedup()
+        reels = [audio_render.AudioReel(), audio_render.AudioReel()]
+        reels[1].renderer.sampleRate = 22050
+        for reel in reels:
+            chord_generation.Voicing('C', 'M7', mediaDedup=dedup, audioReel=reel).genFullStandardVMp3()
+        self.assertEqual([1, 1], [len(reel.pending) for reel in reels], "Different renderers should not share a clip")
+
+
+class TestChordSpelling(unittest.TestCase):
+    """ Test the precomputed chord spelling table"""
+
+    def test_TableMatchesMingus(self):
+        for (root, quality), spelling in chord_spelling.CHORD_TABLE.items():
+            self.assertEqual(mChords.from_shorthand(root+quality), list(spelling.notes),
+                             "Spelling of {} should match mingus".format(root+quality))
+
+    def test_SimpleSpellingAndPitchClasses(self):
+        spelling = chord_spelling.chordSpelling('A#', 'M7')
+        self.assertEqual(('A#', 'C##', 'E#', 'G##'), spelling.notes)
+        self.assertEqual(('A#', 'D', 'F', 'A'), spelling.simpleNotes)
+        self.assertEqual((10, 2, 5, 9), spelling.pitchClasses)
+
+    def test_UnsupportedQualityFallsBackToMingus(self):
+        self.assertEqual(mChords.from_shorthand('Cm9'), chord_spelling.chordNotes('C', 'm9'))
+
+
+class TestPitchMatrix(unittest.TestCase):
+    """ Test the vectorized transposition of the voicing shapes"""
+    matrix = pitch_matrix.PitchMatrix()
+
+    def test_MatchesMingusOctavePlacement(self):
+        for root, quality, voicing in self.matrix.rows:
+            chord = chord_spelling.chordNotes(root, quality)
+            degreesAndOctaves = pitch_matrix.VOICING_SHAPES[voicing]
+            expected = [int(mNote(chord[degree], octave)) + 12 for degree, octave in degreesAndOctaves]
+            self.assertEqual(expected, self.matrix.voicingPitches(root, quality, voicing),
+                             "Pitches of {} {} {} should match the mingus notes".format(root, quality, voicing))
+
+    def test_PaddedRows(self):
+        self.assertEqual((len(chord_spelling.ROOTS) * 4 * 3, 4), self.matrix.pitches.shape)
+        self.assertEqual([48, 52], self.matrix.voicingPitches('C', 'M7', 'ShellVOff3rd'))
+        self.assertEqual([-1, -1], list(self.matrix.pitches[self.matrix.index[('C', 'M7', 'ShellVOff3rd')]][2:]))
+
+    def test_NotesFromRows(self):
+        matrix = pitch_matrix.PitchMatrix()
+        notes = matrix.notes('B#', 'm9', 'FullStandardV', 1)
+        self.assertEqual((len(chord_spelling.ROOTS) * 4 * 3 + len(chord_spelling.ROOTS) * 4, 5), matrix.pitches.shape)
+        self.assertEqual(matrix.voicingPitches('B#', 'm9', 'FullStandardV', 1), [int(note) + 12 for note in notes])
+        self.assertEqual(['D#-3', 'B#-4', 'F##-4', 'A#-4', 'C##-4'], [str(note).strip("'") for note in notes])
+
+
 class TestVoicingCreation(unittest.TestCase):
     """ Test generation of Shell voicing"""
     # @classmethod
@@ -0,0 +1,159 @@
+######################################################################################
+# -*- coding: utf-8 -*-
+# Voice leading of progressions: the voicing of each chord that moves the voices the least
+# Copyright (c) 2024 Stefano Franchi <stefano.franchi@gmail.com>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/licenses/gpl.html
+######################################################################################
+
+from dataclasses import dataclass
+from functools import lru_cache
+import numpy as np
+from chord_spelling import QUALITIES, FLAT_NAMES, pitchClass, spellDegree
+from pitch_matrix import spelledNote
+
+# the twelve keys, spelled with the usual key signatures
+KEYS = FLAT_NAMES
+
+# progressions as (letter steps, semitones, quality) of each chord above the key
+PROGRESSIONS = {
+    'ii-V-I': [(1, 2, 'm7'), (4, 7, 'dom7'), (0, 0, 'M7')],
+    'minor ii-V-i': [(1, 2, 'm7b5'), (4, 7, 'dom7'), (0, 0, 'm7')],
+    'I-vi-ii-V': [(0, 0, 'M7'), (5, 9, 'm7'), (1, 2, 'm7'), (4, 7, 'dom7')],
+    'iii-VI-ii-V': [(2, 4, 'm7'), (5, 9, 'dom7'), (1, 2, 'm7'), (4, 7, 'dom7')],
+}
+
+# the voicing families: each of their shapes lists the chord degrees from the lowest voice up,
+# as 'root', '3rd', '5th', '7th' (of chord_spelling.QUALITIES) or '9th'
+FAMILY_SHAPES = {
+    'ShellV': [['root', '3rd'], ['root', '7th']],
+    'GuideTones': [['3rd', '7th'], ['7th', '3rd']],
+    'FourNotesShExt': [['3rd', '5th', '7th', '9th'], ['7th', '9th', '3rd', '5th']],
+}
+# the register each family is played in, as lowest and highest MIDI pitch
+FAMILY_RANGES = {'ShellV': (40, 64), 'GuideTones': (52, 72), 'FourNotesShExt': (50, 76)}
+NINTH = (8, 14)
+
+
+def shapeDegrees(quality, shape):
+    """The (letter steps, semitones) of the named degrees of a shape for a quality"""
+    degrees = dict(zip(['root', '3rd', '5th', '7th'], QUALITIES[quality]), **{'9th': NINTH})
+    return [degrees[name] for name in shape]
+
+
+@lru_cache(maxsize=None)
+def qualityCandidates(quality, family):
+    """
+    Every placement of the shapes of a family for a chord on C, in all octaves, memoized per quality
+    :return: (array of MIDI pitches, one row per placement and one column per voice from the bottom,
+              shape index of each row)
+    """
+    rows = []
+    shapeIndex = []
+    for index, shape in enumerate(FAMILY_SHAPES[family]):
+        stacked = []
+        for letterSteps, semitones in shapeDegrees(quality, shape):
+            pitch = semitones % 12
+            while stacked and pitch <= stacked[-1]:
+                pitch += 12
+            stacked.append(pitch)
+        for octave in range(11):
+            rows.append([pitch + 12 * octave for pitch in stacked])
+            shapeIndex.append(index)
+    return np.array(rows, dtype=np.int16), np.array(shapeIndex)
+
+
+@dataclass
+class LeadSheet(object):
+    """The voicings picked for a progression: MIDI pitches and shape of each chord, and the total movement"""
+    chords: list  # (root, quality) of each bar
+    pitches: list  # tuple of MIDI pitches of each bar, from the bottom
+    shapes: list  # index in FAMILY_SHAPES[family] of each bar
+    movement: int  # semitones moved by all the voices over the progression
+
+
+class VoiceLeader(object):
+    """
+    Voices a progression in one voicing family so that the voices move as little as possible.
+    The candidate voicings of every chord (each shape of the family in each octave of the family's register)
+    come from placements precomputed per quality; the cost of moving between all the candidates
+    of two chords is one array operation (sum of the semitones each voice moves), and the cheapest path
+    through the progression is found by dynamic programming
+    """
+
+    def __init__(self, family='GuideTones', lowest=None, highest=None):
+        """
+        :param family: ShellV, GuideTones or FourNotesShExt
+        :param lowest: lowest MIDI pitch of the register, default FAMILY_RANGES[family]
+        :param highest: highest MIDI pitch of the register
+        """
+        if family not in FAMILY_SHAPES:
+            raise NotImplementedError("Voice leading does not know the `{}` voicings".format(family))
+        self.family = family
+        self.lowest = lowest if lowest is not None else FAMILY_RANGES[family][0]
+        self.highest = highest if highest is not None else FAMILY_RANGES[family][1]
+
+    def candidates(self, root, quality):
+        """
+        The voicings of a chord within the register
+        :return: (array of MIDI pitches, one row per voicing, shape index of each row)
+        """
+        pitches, shapes = qualityCandidates(quality, self.family)
+        pitches = pitches + pitchClass(root)
+        inRange = (pitches.min(axis=1) >= self.lowest) & (pitches.max(axis=1) <= self.highest)
+        return pitches[inRange], shapes[inRange]
+
+    def lead(self, chords):
+        """
+        :param chords: list of (root, quality), one per bar
+        :return: LeadSheet of the voicings moving the least
+        """
+        if not chords:
+            raise ValueError("There are no chords to voice: a progression needs at least one bar")
+        candidates = [self.candidates(root, quality) for root, quality in chords]
+        for (root, quality), (pitches, shapes) in zip(chords, candidates):
+            if not len(pitches):
+                raise ValueError("No {} voicing of {}{} fits in the register {}-{} (MIDI pitches)".format(
+                    self.family, root, quality, self.lowest, self.highest))
+        cost = np.zeros(len(candidates[0][0]), dtype=np.int32)
+        backPointers = []
+        for (previous, _), (current, _) in zip(candidates, candidates[1:]):
+            # movement from every previous voicing (rows) to every current voicing (columns)
+            movement = np.abs(previous[:, None, :].astype(np.int32) - current[None, :, :]).sum(axis=2)
+            total = cost[:, None] + movement
+            best = total.argmin(axis=0)
+            backPointers.append(best)
+            cost = total[best, np.arange(len(best))]
+        picked = [int(cost.argmin())]
+        for best in reversed(backPointers):
+            picked.append(int(best[picked[-1]]))
+        picked.reverse()
+        return LeadSheet(list(chords), [tuple(int(p) for p in pitches[i]) for (pitches, _), i in zip(candidates, picked)],
+                         [int(shapes[i]) for (_, shapes), i in zip(candidates, picked)], int(cost.min()))
+
+    def notes(self, leadSheet):
+        """mingus Notes of each bar of a LeadSheet, spelled as chord degrees of its chord"""
+        bars = []
+        for (root, quality), pitches, shape in zip(leadSheet.chords, leadSheet.pitches, leadSheet.shapes):
+            names = [spellDegree(root, letterSteps, semitones)
+                     for letterSteps, semitones in shapeDegrees(quality, FAMILY_SHAPES[self.family][shape])]
+            bars.append([spelledNote(name, pitch) for name, pitch in zip(names, pitches)])
+        return bars
+
+
+def progression(name, key, bars=None):
+    """
+    The chords of a progression in a key, repeated to fill bars (default once through)
+    :return: list of (root, quality)
+    """
+    pattern = PROGRESSIONS[name]
+    chords = [(spellDegree(key, letterSteps, semitones), quality) for letterSteps, semitones, quality in pattern]
+    return [chords[i % len(chords)] for i in range(bars if bars is not None else len(chords))]
+
+
+def leadInAllKeys(name, family='GuideTones', bars=None, keys=KEYS):
+    """
+    Voice a progression in every key
+    :return: dictionary key -> LeadSheet
+    """
+    leader = VoiceLeader(family)
+    return {key: leader.lead(progression(name, key, bars)) for key in keys}